@@ -0,0 +1,258 @@
+'''CPU microbenchmarks for the transform, diff and serialization hot paths.
+
+Generates synthetic bibs and auths in a mongomock database and reports the
+throughput (records/sec) of each function, the memory it allocates per record
+and still holds when it returns (from tracemalloc snapshot diffs), and the peak
+traced memory of the whole run.
+Baselines are machine dependent, so save them on the machine that will run
+the comparison.
+
+    python benchmarks/bench.py                  # compare with the saved baseline
+    python benchmarks/bench.py --save           # save the results as the baseline
+    python benchmarks/bench.py --threshold .1   # fail if throughput drops more than 10%
+
+Exits with status 1 if any benchmark regresses beyond the threshold.
+'''
+
+import sys, os, json, time, uuid, tracemalloc
+from argparse import ArgumentParser
+from copy import deepcopy
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+ap = ArgumentParser('bench')
+ap.add_argument('--records', type=int, default=500, help='number of synthetic bibs and auths')
+ap.add_argument('--repeat', type=int, default=5, help='the best of this many runs is reported')
+ap.add_argument('--threshold', type=float, default=.2, help='max allowed drop in throughput relative to the baseline')
+ap.add_argument('--baseline', default=BASELINE, help='baseline file')
+ap.add_argument('--save', action='store_true', help='save the results as the baseline')
+ap.add_argument('--only', nargs='+', help='only run these benchmarks')
+
+class NullDispatcher():
+    """Takes the place of `Dispatcher` so that `compare_and_update` builds its
+    submission without posting it"""
+
+    def submit(self, key, fn, *args, **kwargs):
+        return
+
+    def close(self):
+        return
+
+def setup(n):
+    from dlx import DB
+    from dlx.marc import Bib, Auth
+    from dlx_dl.scripts import export
+
+    DB.connect('mongomock://localhost', database='dlx_dl_bench')
+
+    for col in (DB.bibs, DB.auths, DB.files):
+        col.drop()
+
+    auths = []
+
+    for i in range(1, n + 1):
+        auth = Auth().set('100', 'a', f'Name, {i}').set('400', 'a', f'Alias {i}').set('670', 'a', f'Source {i}')
+        auth.set('035', 'a', f'(OLD){i}').set('035', 'a', f'(SYS){i}', address=['+'])
+        auth.commit()
+        auths.append(auth)
+
+    bibs, now = [], datetime.now(timezone.utc)
+
+    for i in range(1, n + 1):
+        bib = Bib().set('001', None, str(i)).set('005', None, '20240101000000.0')
+        bib.set('035', 'a', f'(OLD){i}').set('035', 'a', f'(DHL){i}', address=['+'])
+        bib.set('245', 'a', f'Report of the Secretary-General {i}').set('245', 'b', 'addendum').set('245', 'c', ' ')
+        bib.set('269', 'a', '2024-01-01')
+
+        for j in range(8):
+            symbol = f'A/{i}/ADD.{j}'
+            bib.set('191', 'a', symbol, address=['+'])
+            bib.set('191', 'b', 'A/', address=[j]).set('191', 'c', '79', address=[j])
+            _file(DB, symbol, 'symbol', now)
+
+        for j in range(3):
+            uri = f'https://undocs.org/uri/{i}/{j}'
+            bib.set('561', 'u', uri, address=['+'])
+            _file(DB, uri, 'uri', now)
+
+        for j, domain in enumerate(export.WHITELIST[:3]):
+            bib.set('856', 'u', f'https://{domain}/files/A_{i}_{j}-EN.pdf', address=['+']).set('856', '3', 'English', address=[j])
+
+        bib.set('856', 'u', 'https://example.org/page', address=['+'])
+
+        for j in range(6):
+            bib.set('650', 'a', auths[(i + j) % n].id, address=['+'])
+
+        for j in range(3):
+            bib.set('700', 'a', auths[(i * 7 + j) % n].id, address=['+'])
+
+        bib.set('991', 'a', '', address=['+']) # blank value to clean
+        bib.commit()
+        bibs.append(bib)
+
+    # DL versions of the records for the diff, with one field changed
+    dl_bibs = []
+
+    for bib in bibs:
+        dl = Bib.from_xml(bib.to_xml(xref_prefix='(DHLAUTH)', write_id=False), auth_control=False)
+        dl.set('245', 'a', 'changed in DL')
+        dl_bibs.append(dl)
+
+    return bibs, auths, dl_bibs
+
+def _file(DB, value, itype, timestamp):
+    fid = uuid.uuid4().hex
+
+    DB.files.insert_one(
+        {
+            '_id': fid,
+            'filename': f'{fid}.pdf',
+            'original_filename': f'{value.replace("/", "_")}-EN.pdf',
+            'identifiers': [{'type': itype, 'value': value}],
+            'languages': ['EN'],
+            'mimetype': 'application/pdf',
+            'size': 1024,
+            'source': 'bench',
+            'timestamp': timestamp,
+            'uri': f'mock_bucket.s3.amazonaws.com/{fid}',
+        }
+    )
+
+def benchmarks(bibs, auths, dl_bibs):
+    """name -> (function taking a list of records, the records). The records
+    are copied before each run"""
+
+    from dlx_dl.scripts import export, sync
+    from dlx_dl.util import FileResolver
+
+    args = SimpleNamespace(type='bib', START=datetime.now(timezone.utc), blacklisted=[], dispatcher=NullDispatcher())
+
+    def process_bibs(records):
+        for i in range(0, len(records), 100):
+            batch = records[i:i+100]
+            files = FileResolver(batch)
+
+            for bib in batch:
+                export.process_bib(bib, blacklisted=[], files_only=False, files=files)
+
+    def process_auths(records):
+        for auth in records:
+            export.process_auth(auth)
+
+    def clean_dlx_values(records):
+        for record in records:
+            sync.clean_dlx_values(record)
+
+    def compare_and_update(pairs):
+        for i in range(0, len(pairs), 100):
+            batch = pairs[i:i+100]
+            files = FileResolver([bib for bib, _ in batch])
+
+            for bib, dl in batch:
+                sync.compare_and_update(args, dlx_record=bib, dl_record=dl, files=files)
+
+    def filenames(records):
+        for bib in records:
+            for symbol in bib.get_values('191', 'a'):
+                export.encode_fn(export.clean_fn(symbol).split(' '), 'EN', 'pdf')
+
+    def to_xml(records):
+        for record in records:
+            record.to_xml(xref_prefix='(DHLAUTH)', write_id=False)
+
+    return {
+        'process_bib': (process_bibs, bibs),
+        'process_auth': (process_auths, auths),
+        'clean_dlx_values': (clean_dlx_values, bibs),
+        'compare_and_update': (compare_and_update, list(zip(bibs, dl_bibs))),
+        'clean_fn/encode_fn': (filenames, bibs),
+        'to_xml': (to_xml, bibs),
+    }
+
+def measure(fn, records, repeat):
+    """Returns (records/sec of the best run, KiB and blocks allocated per
+    record and still held when the function returns, peak traced KiB of the
+    run)"""
+
+    best = float('inf')
+
+    for _ in range(repeat):
+        copies = deepcopy(records)
+        start = time.perf_counter()
+        fn(copies)
+        best = min(best, time.perf_counter() - start)
+
+    copies = deepcopy(records)
+    tracemalloc.start()
+    # tracemalloc's own allocations are not counted
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = tracemalloc.take_snapshot().filter_traces(filters)
+    fn(copies)
+    after = tracemalloc.take_snapshot().filter_traces(filters)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+    allocated = sum(x.size_diff for x in diff)
+    blocks = sum(x.count_diff for x in diff)
+
+    return len(records) / best, allocated / 1024 / len(records), blocks / len(records), peak / 1024
+
+def run() -> int:
+    args = ap.parse_args()
+    baseline = {}
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # suppress the scripts' per-record output while timing
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    try:
+        suite = benchmarks(*setup(args.records))
+        results = {}
+
+        for name, (fn, records) in suite.items():
+            if args.only and name not in args.only:
+                continue
+
+            results[name] = measure(fn, records, args.repeat)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    regressions = 0
+    print(f'{"benchmark":<20}{"records/sec":>14}{"KiB/record":>12}{"blocks/record":>15}{"peak KiB":>12}{"baseline":>14}{"change":>9}')
+
+    for name, (rate, kib, blocks, peak) in results.items():
+        base = baseline.get(name, {}).get('records_per_sec')
+        change = (rate - base) / base if base else None
+        regressed = change is not None and change < -args.threshold
+        regressions += regressed
+        print(
+            f'{name:<20}{rate:>14,.0f}{kib:>12,.1f}{blocks:>15,.1f}{peak:>12,.0f}'
+            + (f'{base:>14,.0f}{change:>+9.1%}' if base else f'{"-":>14}{"-":>9}')
+            + (' REGRESSED' if regressed else '')
+        )
+
+    if args.save:
+        baseline.update(
+            {
+                name: {'records_per_sec': rate, 'allocated_kib_per_record': kib, 'allocated_blocks_per_record': blocks, 'peak_kib': peak}
+                for name, (rate, kib, blocks, peak) in results.items()
+            }
+        )
+
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4)
+
+        print(f'Saved baseline to {args.baseline}')
+
+    return 1 if regressions else 0
+
+###
+
+if __name__ == '__main__':
+    sys.exit(run())
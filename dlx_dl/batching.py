@@ -0,0 +1,70 @@
+'''Sizes the batches of records searched for in DL from the search API's responses'''
+
+import math, threading
+
+SIZE = 100
+MIN_SIZE = 10
+MAX_SIZE = 500
+MAX_URL = 8000 # characters. servers commonly reject request lines over 8K
+TARGET_SECONDS = 10 # responses slower than this shrink the batch
+MAX_BYTES = 20 * 1024 * 1024 # responses larger than this shrink the batch
+GROWTH = 1.25
+
+class AdaptiveBatchSize():
+    def __init__(self, size: int = SIZE, *, minimum: int = MIN_SIZE, maximum: int = MAX_SIZE, max_url: int = MAX_URL, target_seconds: float = TARGET_SECONDS, max_bytes: int = MAX_BYTES):
+        """The number of records to search for per request. The size grows
+        while responses are fast and small, and grows faster when requests are
+        rate limited, since then the number of requests is what matters. It
+        shrinks on timeouts, 5xx responses, slow responses and large payloads.
+        A batch is also full when the search URL would exceed `max_url`"""
+
+        if not minimum <= size <= maximum: raise Exception('"size" must be between "minimum" and "maximum"')
+
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_url = max_url
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def full(self, count: int, url_length: int) -> bool:
+        """Whether a batch of `count` records with a search URL of `url_length`
+        characters should be sent"""
+
+        with self._lock:
+            return count >= self.size or url_length >= self.max_url
+
+    def cap(self, maximum: int) -> None:
+        """Lowers the maximum, e.g. to the number of results the API returns per
+        page, beyond which bigger batches save no requests"""
+
+        with self._lock:
+            self.maximum = max(min(self.maximum, maximum), self.minimum)
+            self.size = min(self.size, self.maximum)
+
+    def record(self, *, seconds: float, nbytes: int, retried: list = (), ok: bool = True) -> int:
+        """Adjusts the size from a response that took `seconds` and returned
+        `nbytes`. `retried` is the status codes or exception names of retried
+        attempts (see `client.request`). Returns the new size"""
+
+        failed = not ok or any(x != 429 for x in retried)
+        rate_limited = 429 in retried
+
+        with self._lock:
+            if failed:
+                size = self.size // 2
+            elif nbytes > self.max_bytes:
+                size = self.size * self.max_bytes // nbytes
+            elif seconds > self.target_seconds:
+                size = self.size * 3 // 4
+            elif rate_limited:
+                size = self.size * 2
+            elif seconds < self.target_seconds / 2 and nbytes < self.max_bytes / 2:
+                size = math.ceil(self.size * GROWTH)
+            else:
+                size = self.size
+
+            self.size = min(max(size, self.minimum), self.maximum)
+
+            return self.size
@@ -0,0 +1,47 @@
+'''Buffers writes to the log and queue collections'''
+
+import time, threading
+from pymongo import InsertOne
+
+MAX_OPS = 100
+MAX_SECONDS = 5
+
+class BulkBuffer():
+    def __init__(self, max_ops: int = MAX_OPS, max_seconds: float = MAX_SECONDS):
+        """Collects write operations and flushes them with one `bulk_write` per
+        collection when `max_ops` operations are buffered or `max_seconds` have
+        passed since the last flush. Flushes on exit when used as a context
+        manager"""
+
+        self.max_ops = max_ops
+        self.max_seconds = max_seconds
+        self._ops = {} # collection name -> (collection, [ops])
+        self._count = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def insert(self, collection, doc: dict) -> None:
+        # the doc is copied so the caller can modify it after it is buffered
+        self.add(collection, InsertOne(dict(doc)))
+
+    def add(self, collection, op) -> None:
+        with self._lock:
+            self._ops.setdefault(collection.full_name, (collection, []))[1].append(op)
+            self._count += 1
+
+            if self._count >= self.max_ops or time.monotonic() - self._last_flush >= self.max_seconds:
+                self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            ops, self._ops, self._count = self._ops, {}, 0
+            self._last_flush = time.monotonic()
+
+            for collection, batch in ops.values():
+                collection.bulk_write(batch)
@@ -0,0 +1,169 @@
+'''Pooled HTTP client for UNDL API traffic'''
+
+import os, time, gzip, threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+TIMEOUT = (10, 300) # connect, read
+MAX_RETRIES = 5
+BACKOFF = 5
+RATE_LIMIT_WAIT = 310
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 20
+LIMITED_ENDPOINTS = ('/search',) # paths, by suffix, that share the API rate limit. record submissions are not limited
+# the API's support for gzipped request bodies has to be confirmed before this is on by default
+GZIP_REQUESTS = bool(os.environ.get('DLX_DL_GZIP_REQUESTS'))
+
+_session = None
+_lock = threading.Lock()
+_latency = {}
+_limiter = None
+
+def session() -> requests.Session:
+    """The shared session. Connections are kept alive and reused"""
+
+    global _session
+
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+    return _session
+
+def set_limiter(limiter) -> None:
+    """Requests to `LIMITED_ENDPOINTS` wait for a token from `limiter` (a
+    `ratelimit.RateLimiter`), and their outcomes are recorded for its circuit
+    breaker. `None` removes the limiter"""
+
+    global _limiter
+
+    _limiter = limiter
+
+def get(url, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+def post(url, *, data=None, compress=None, **kwargs) -> requests.Response:
+    """POSTs `data`, gzipped if `compress` (default `GZIP_REQUESTS`)"""
+
+    if (GZIP_REQUESTS if compress is None else compress) and data:
+        data = gzip.compress(data.encode('utf-8') if isinstance(data, str) else data)
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Encoding': 'gzip'})
+
+    return request('POST', url, data=data, **kwargs)
+
+def request(method, url, *, max_retries=MAX_RETRIES, **kwargs) -> requests.Response:
+    """Retries connection errors, 5xx and 429 responses with backoff, honouring
+    the Retry-After header. Returns the last response if retries run out. The
+    status codes, or exception names, of the retried attempts are set on the
+    response as `retried`. If a limiter is set and the endpoint is limited,
+    each attempt waits for it, and rate limited requests wait for the limiter
+    instead of `RATE_LIMIT_WAIT`"""
+
+    kwargs.setdefault('timeout', TIMEOUT)
+    endpoint = urlparse(url).path
+    retries = 0
+    retried = []
+
+    limited = endpoint.endswith(LIMITED_ENDPOINTS)
+
+    while 1:
+        limiter = _limiter if limited else None
+
+        if limiter:
+            limiter.acquire()
+
+        start = time.perf_counter()
+
+        try:
+            response = session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record(endpoint, time.perf_counter() - start, error=True)
+
+            if limiter:
+                limiter.record(ok=False)
+
+            if retries >= max_retries:
+                raise e
+
+            wait = BACKOFF * 2 ** retries
+            retried.append(type(e).__name__)
+            print(f'{type(e).__name__} from {endpoint}. Retrying in {wait} seconds')
+        else:
+            _record(endpoint, time.perf_counter() - start, error=not response.ok)
+
+            if limiter:
+                limiter.record(ok=response.status_code < 500)
+
+                if is_rate_limited(response):
+                    # other processes wait too. without a Retry-After, the penalty is waited out
+                    limiter.drain(seconds=RATE_LIMIT_WAIT if (wait := retry_after(response)) is None else wait)
+
+            if not is_retryable(response) or retries >= max_retries:
+                response.retried = retried
+
+                return response
+
+            wait = retry_after(response)
+
+            if wait is None:
+                if is_rate_limited(response):
+                    # the wait is in the drained limiter
+                    wait = 0 if limiter else RATE_LIMIT_WAIT
+                else:
+                    wait = BACKOFF * 2 ** retries
+
+            retried.append(429 if is_rate_limited(response) else response.status_code)
+            print(f'{response.status_code} from {endpoint}. Retrying in {wait} seconds')
+
+        _record(endpoint, retry=True)
+        time.sleep(wait)
+        retries += 1
+
+def is_rate_limited(response: requests.Response) -> bool:
+    return response.status_code == 429 or (not response.ok and 'Max 100 requests per 5 minutes' in response.text)
+
+def is_retryable(response: requests.Response) -> bool:
+    return response.status_code in RETRY_STATUSES or is_rate_limited(response)
+
+def retry_after(response: requests.Response) -> float | None:
+    """Seconds to wait from the Retry-After header, if any"""
+
+    if (value := response.headers.get('Retry-After')) is None:
+        return
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return
+
+def latency() -> dict:
+    """Request count, errors, retries and total/max seconds per endpoint"""
+
+    with _lock:
+        return {k: dict(v) for k, v in _latency.items()}
+
+def reset_latency() -> None:
+    with _lock:
+        _latency.clear()
+
+def _record(endpoint, seconds=0, *, error=False, retry=False):
+    with _lock:
+        stats = _latency.setdefault(endpoint, {'count': 0, 'errors': 0, 'retries': 0, 'seconds': 0, 'max_seconds': 0})
+
+        if retry:
+            stats['retries'] += 1
+        else:
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
@@ -0,0 +1,75 @@
+'''Compares the fields of a DLX record with the fields of its DL record'''
+
+import unicodedata
+from collections import Counter
+from urllib.parse import urlparse
+
+class FieldDiff():
+    def __init__(self):
+        """The differences between the fields of a DLX record and its DL record.
+        `changes` is the (kind, MRK) of each difference found, in the order
+        found, where kind is "UPDATE", "SUPERSEDED" or "TO DELETE"."""
+
+        self.take_tags = set() # tags to send from DLX in full
+        self.delete_fields = [] # DL fields with their values blanked, to delete the field in DL
+        self.duplicates = [] # (MRK, count) of fields duplicated in DL but not in DLX
+        self.changes = []
+
+def diff_fields(dlx_fields: list, dl_fields: list, *, whitelist, take_tags=None) -> FieldDiff:
+    """Each field is serialized and normalized once, and fields are matched
+    through hashed multisets. Fields whose tag and indicators are not in the
+    DLX record are blanked in place to be returned in `delete_fields`.
+    `take_tags` are tags already known to need sending. 856 fields for files
+    sent as FFT (from the `whitelist` hosts, or in DL) are not compared"""
+
+    diff = FieldDiff()
+    diff.take_tags = set(take_tags or [])
+    dlx_serialized = [x.to_mrk() for x in dlx_fields]
+    dl_serialized = [x.to_mrk() for x in dl_fields]
+    dlx_normalized = Counter(unicodedata.normalize('NFD', x) for x in dlx_serialized)
+    dl_normalized = Counter(unicodedata.normalize('NFD', x) for x in dl_serialized)
+    dlx_tag_inds = {x.tag + ''.join(x.indicators) for x in dlx_fields}
+
+    # dlx -> dl
+    for field, mrk in zip(dlx_fields, dlx_serialized):
+        if field.tag == '856' and urlparse(field.get_value('u')).netloc in whitelist:
+            # files in these fields have been sent as FFT
+            continue
+
+        if unicodedata.normalize('NFD', mrk) not in dl_normalized:
+            diff.changes.append(('UPDATE', mrk))
+            diff.take_tags.add(field.tag)
+
+    # dl -> dlx
+    for field, mrk in zip(dl_fields, dl_serialized):
+        if field.tag == '856' and 'digitallibrary.un.org' in field.get_value('u'):
+            # FFT file
+            continue
+
+        if unicodedata.normalize('NFD', mrk) not in dlx_normalized:
+            # compare tag + indicators
+            if field.tag + ''.join(field.indicators) in dlx_tag_inds:
+                if field.tag not in diff.take_tags:
+                    # this should already be taken care of in dlx->dl
+                    diff.changes.append(('SUPERSEDED', mrk))
+                    diff.take_tags.add(field.tag)
+            else:
+                # delete fields where the tag + indicators combo does not exist in dl record
+                diff.changes.append(('TO DELETE', mrk))
+
+                # use the field in the export to delete the field in DL by setting values to empty string
+                for subfield in field.subfields:
+                    subfield.value = ""
+
+                diff.delete_fields.append(field)
+
+    # duplicated dl fields
+    dlx_counts = Counter(dlx_serialized)
+
+    for mrk, count in Counter(dl_serialized).items():
+        # check if field is also duplicated in dlx
+        if count > 1 and dlx_counts[mrk] != count:
+            diff.duplicates.append((mrk, count))
+            diff.take_tags.add(mrk[1:4])
+
+    return diff
@@ -0,0 +1,80 @@
+'''Hands DL API submissions to a pool of threads'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+class Dispatcher():
+    def __init__(self, concurrency: int = 1):
+        """Runs submissions with at most `concurrency` requests in flight.
+        Submissions with the same key (record ID) run in the order they were
+        submitted. With a concurrency of 1, submissions run inline"""
+
+        self.concurrency = int(concurrency)
+
+        if self.concurrency < 1: raise Exception('"concurrency" must be at least 1')
+
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='dlx-dl') if self.concurrency > 1 else None
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._lock = threading.Lock()
+        self._last = {} # key -> the latest future submitted with the key
+        self._errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, key, fn, *args, **kwargs) -> Future:
+        """Schedules `fn(*args, **kwargs)`. Blocks while the max number of
+        requests are in flight. Raises the first exception raised by a previous
+        submission, if any"""
+
+        self._raise()
+
+        if self._executor is None:
+            future = Future()
+            future.set_result(fn(*args, **kwargs))
+
+            return future
+
+        self._slots.acquire()
+
+        with self._lock:
+            previous = self._last.get(key)
+            future = self._executor.submit(self._call, previous, fn, args, kwargs)
+            self._last[key] = future
+
+        future.add_done_callback(lambda f: self._done(key, f))
+
+        return future
+
+    def close(self) -> None:
+        """Waits for the submissions in flight to complete"""
+
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+        self._raise()
+
+    @staticmethod
+    def _call(previous, fn, args, kwargs):
+        if previous:
+            # keep the order of submissions for the same record
+            wait([previous])
+
+        return fn(*args, **kwargs)
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._last.get(key) is future:
+                self._last.pop(key)
+
+            if future.exception():
+                self._errors.append(future.exception())
+
+        self._slots.release()
+
+    def _raise(self):
+        if self._errors:
+            raise self._errors[0]
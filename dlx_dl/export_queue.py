@@ -0,0 +1,172 @@
+'''The queue of records waiting to be exported to DL (`dlx_dl_queue`)'''
+
+import uuid
+from datetime import datetime, timezone, timedelta
+from itertools import islice
+from pymongo import ASCENDING, UpdateOne, DeleteMany
+from pymongo.errors import OperationFailure
+from dlx import DB
+from dlx.marc import Marc
+
+QUEUE_COLLECTION = 'dlx_dl_queue'
+PRIORITY = {'DELETE': 0, 'NEW': 1, 'UPDATE': 2} # lower is taken first
+CHUNK_SIZE = 1000
+VISIBILITY_TIMEOUT = 3600
+LEASE_LIMIT = 10000
+
+class ExportQueue():
+    def __init__(self, *, type: str, source: str = None, buffer=None):
+        """Queue items are unique by (type, record_id). `source` is recorded on
+        enqueue and, if set, limits the items that are leased. If a `BulkBuffer`
+        is given, acks are written through it"""
+
+        if not DB.connected:
+            raise Exception('Not connected to DB')
+
+        if type not in ('bib', 'auth'): raise Exception('"type" must be "bib" or "auth"')
+
+        self.type = type
+        self.source = source
+        self.collection = DB.handle[QUEUE_COLLECTION]
+        self.buffer = buffer
+        self.leases = []
+        self.ensure_indexes()
+
+    def ensure_indexes(self) -> None:
+        try:
+            self.collection.create_index([('type', ASCENDING), ('record_id', ASCENDING)], unique=True)
+        except OperationFailure:
+            # items queued before the index existed may be duplicated
+            self._dedupe()
+            self.collection.create_index([('type', ASCENDING), ('record_id', ASCENDING)], unique=True)
+
+        self.collection.create_index([('source', ASCENDING), ('type', ASCENDING), ('priority', ASCENDING), ('time', ASCENDING)])
+        # items queued before priorities existed
+        self.collection.update_many({'priority': {'$exists': False}}, {'$set': {'priority': PRIORITY['UPDATE']}})
+
+    def enqueue(self, records, *, priority: str = 'UPDATE') -> int:
+        """Adds records (or record IDs) to the queue in chunked bulk upserts.
+        Deleted records go in the DELETE lane. Items already in the queue are
+        moved to the higher priority lane if necessary. Returns the number of
+        items added"""
+
+        if priority not in PRIORITY: raise Exception(f'"priority" must be one of {list(PRIORITY.keys())}')
+
+        records, added = iter(records), 0
+
+        while chunk := list(islice(records, CHUNK_SIZE)):
+            updates = []
+
+            for record in chunk:
+                if isinstance(record, Marc):
+                    lane = 'DELETE' if record.get_value('980', 'a') == 'DELETED' else priority
+                    record_id = record.id
+                else:
+                    lane, record_id = priority, int(record)
+
+                data = {'time': datetime.now(timezone.utc), 'source': self.source, 'type': self.type, 'record_id': record_id}
+                updates.append(
+                    UpdateOne(
+                        {'type': self.type, 'record_id': record_id},
+                        {'$setOnInsert': data, '$min': {'priority': PRIORITY[lane]}},
+                        upsert=True
+                    )
+                )
+
+            added += self.collection.bulk_write(updates, ordered=False).upserted_count
+
+        return added
+
+    def lease(self, limit: int = LEASE_LIMIT, *, visibility_timeout: int = VISIBILITY_TIMEOUT, priorities: list[str] = None) -> 'Lease':
+        """Takes up to `limit` items, highest priority and oldest first, from
+        the `priorities` lanes if given. The items are not available to other
+        leases until they are acknowledged, released, or `visibility_timeout`
+        seconds have passed"""
+
+        now = datetime.now(timezone.utc)
+        available = {'type': self.type, '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]}
+        self.source and available.setdefault('source', self.source)
+
+        if priorities:
+            if any(x not in PRIORITY for x in priorities): raise Exception(f'"priorities" must be in {list(PRIORITY.keys())}')
+
+            available['priority'] = {'$in': [PRIORITY[x] for x in priorities]}
+        candidates = [x['_id'] for x in self.collection.find(available, projection={'_id': 1}, sort=[('priority', 1), ('time', 1)], limit=limit)]
+        lease = Lease(self, str(uuid.uuid4()))
+
+        if candidates:
+            # items taken by a concurrent lease since the find no longer match `available`
+            self.collection.update_many(
+                dict(available, _id={'$in': candidates}),
+                {'$set': {'lease_id': lease.id, 'lease_until': now + timedelta(seconds=visibility_timeout)}}
+            )
+            lease.items = list(self.collection.find({'lease_id': lease.id}, sort=[('priority', 1), ('time', 1)]))
+
+        self.leases.append(lease)
+
+        return lease
+
+    def release(self) -> None:
+        """Releases all the leases taken from this queue"""
+
+        if self.buffer:
+            # acked items have to be gone before their lease is released
+            self.buffer.flush()
+
+        for lease in self.leases:
+            lease.release()
+
+        self.leases = []
+
+    def ack(self, record_ids) -> None:
+        """Removes the items from the queue"""
+
+        record_ids = iter(record_ids)
+
+        while chunk := list(islice(record_ids, CHUNK_SIZE)):
+            op = DeleteMany({'type': self.type, 'record_id': {'$in': chunk}})
+
+            if self.buffer:
+                self.buffer.add(self.collection, op)
+            else:
+                self.collection.bulk_write([op])
+
+    def count(self) -> int:
+        return self.collection.count_documents({'type': self.type})
+
+    def _dedupe(self) -> None:
+        dups = self.collection.aggregate(
+            [
+                {'$group': {'_id': {'type': '$type', 'record_id': '$record_id'}, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+                {'$match': {'count': {'$gt': 1}}}
+            ],
+            allowDiskUse=True
+        )
+
+        for dup in dups:
+            self.collection.delete_many({'_id': {'$in': dup['ids'][1:]}})
+
+def queued() -> int:
+    """The number of items in the queue, of any type"""
+
+    return DB.handle[QUEUE_COLLECTION].count_documents({})
+
+class Lease():
+    def __init__(self, queue: ExportQueue, lease_id: str):
+        """Items taken from the queue by `ExportQueue.lease`"""
+
+        self.queue = queue
+        self.id = lease_id
+        self.items = []
+
+    @property
+    def record_ids(self) -> list[int]:
+        return [x['record_id'] for x in self.items]
+
+    def ids_by_priority(self, priority: str) -> list[int]:
+        return [x['record_id'] for x in self.items if x.get('priority') == PRIORITY[priority]]
+
+    def release(self) -> None:
+        """Makes the items still in the queue available to other leases"""
+
+        self.queue.collection.update_many({'lease_id': self.id}, {'$unset': {'lease_id': '', 'lease_until': ''}})
@@ -0,0 +1,119 @@
+'''Fingerprints of records as last found to be in sync with DL (`dlx_dl_fingerprint`), to skip comparing records that have not changed'''
+
+import hashlib, time, unicodedata
+from datetime import datetime, timezone
+from pymongo import ASCENDING, ReplaceOne
+from dlx import DB
+from dlx.file import File
+
+FINGERPRINT_COLLECTION = 'dlx_dl_fingerprint'
+CALLBACK_COLLECTION = 'undl_callback_log' # see export.CALLBACK_COLLECTION
+MIRROR_COLLECTION = 'dlx_dl_mirror' # see mirror.MIRROR_COLLECTION
+MAX_AGE = 30 * 24 * 60 * 60 # seconds. older fingerprints are compared again regardless, in case the record was edited in DL
+
+class Fingerprints():
+    def __init__(self, *, type: str, max_age: int = MAX_AGE):
+        """A fingerprint of each record's exported fields and files, keyed by
+        (type, record_id), with the DL 005 of the record when it was found to
+        be in sync, or the ID of the export that brought it in sync"""
+
+        if not DB.connected:
+            raise Exception('Not connected to DB')
+
+        if type not in ('bib', 'auth'): raise Exception('"type" must be "bib" or "auth"')
+
+        self.type = type
+        self.max_age = max_age
+        self.collection = DB.handle[FINGERPRINT_COLLECTION]
+        self.collection.create_index([('type', ASCENDING), ('record_id', ASCENDING)], unique=True)
+
+    @staticmethod
+    def fingerprint(fields: list[str], files: list[File]) -> str:
+        """A hash of the NFD-normalized MRK of the fields, in any order, and the
+        ID and size of the files"""
+
+        h = hashlib.sha256()
+
+        for mrk in sorted(unicodedata.normalize('NFD', x) for x in fields):
+            h.update(mrk.encode('utf-8') + b'\n')
+
+        for f in sorted(files, key=lambda x: x.id):
+            h.update(f'{f.id}:{f.size}\n'.encode('utf-8'))
+
+        return h.hexdigest()
+
+    def unchanged(self, fingerprints: dict[int, str]) -> set[int]:
+        """The IDs of the records whose fingerprint, as {record ID: fingerprint},
+        matches the stored one, if DL has not changed the record since: no
+        callback from DL after the fingerprint was stored (other than for the
+        export that brought the record in sync, if it succeeded), no different
+        005 in the DL mirror, and within `max_age`"""
+
+        if not fingerprints:
+            return set()
+
+        oldest = time.time() - self.max_age
+        entries = {
+            x['record_id']: x for x in self.collection.find({'type': self.type, 'record_id': {'$in': list(fingerprints.keys())}})
+            if x['fingerprint'] == fingerprints[x['record_id']] and x['time'] > oldest
+        }
+
+        if not entries:
+            return set()
+
+        ids = list(entries.keys())
+        # the latest callback per record
+        callbacks = DB.handle[CALLBACK_COLLECTION].aggregate(
+            [
+                {'$match': {'record_type': self.type, 'record_id': {'$in': ids}}},
+                {'$sort': {'time': -1}},
+                {'$group': {'_id': '$record_id', 'time': {'$first': '$time'}, 'export_id': {'$first': '$nonce.export_id'}, 'results': {'$first': '$results'}}}
+            ]
+        )
+
+        for callback in callbacks:
+            entry = entries[callback['_id']]
+
+            if isinstance(callback.get('time'), datetime) and _timestamp(callback['time']) > entry['time']:
+                success = (callback.get('results') or [{}])[0].get('success')
+
+                if not (entry.get('export_id') and callback.get('export_id') == entry['export_id'] and success):
+                    entries.pop(callback['_id'])
+
+        # DL records fetched since
+        for mirrored in DB.handle[MIRROR_COLLECTION].find({'type': self.type, 'record_id': {'$in': list(entries.keys())}}, projection={'record_id': 1, '005': 1, 'time': 1}):
+            entry = entries[mirrored['record_id']]
+
+            if entry.get('005') and _timestamp(mirrored['time']) > entry['time'] and mirrored.get('005') != entry['005']:
+                entries.pop(mirrored['record_id'])
+
+        return set(entries.keys())
+
+    def put(self, entries: list[tuple[int, str, str | None, str | None]]) -> None:
+        """Stores the fingerprints of records found to be in sync with DL, as
+        (record ID, fingerprint, DL 005, export ID). The export ID is of the
+        export that brought the record in sync, if any"""
+
+        if not entries:
+            return
+
+        now = time.time()
+        updates = [
+            ReplaceOne(
+                {'type': self.type, 'record_id': record_id},
+                {'type': self.type, 'record_id': record_id, 'fingerprint': fingerprint, '005': _005, 'export_id': export_id, 'time': now},
+                upsert=True
+            )
+            for record_id, fingerprint, _005, export_id in entries
+        ]
+
+        self.collection.bulk_write(updates, ordered=False)
+
+    def invalidate(self, record_ids: list[int]) -> None:
+        """Removes the fingerprints, so that the records are compared again"""
+
+        self.collection.delete_many({'type': self.type, 'record_id': {'$in': list(record_ids)}})
+
+def _timestamp(dt: datetime) -> float:
+    # datetimes are naive UTC when read back from the DB
+    return (dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt).timestamp()
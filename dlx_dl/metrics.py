@@ -0,0 +1,139 @@
+'''Run metrics emitted as CloudWatch Embedded Metric Format (EMF) JSON lines'''
+
+import sys, json, time, math, threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pymongo import monitoring
+
+NAMESPACE = 'dlx-dl'
+PERCENTILES = (50, 90, 99)
+MONGO_COMMANDS = ('find', 'getMore', 'aggregate', 'count', 'insert', 'update', 'delete')
+
+_current = None # the Metrics of the run in progress, for the Mongo command listener
+
+class Metrics():
+    def __init__(self, *, dimensions: dict, namespace: str = NAMESPACE, stream=None):
+        """Collects counts, latency samples and time per stage for a run. `emit`
+        writes them as one EMF JSON line to `stream` (default STDERR, so that
+        XML written to STDOUT is not affected). Mongo commands are counted
+        while this is the current run"""
+
+        global _current
+
+        self.dimensions = {k: str(v) for k, v in dimensions.items()}
+        self.namespace = namespace
+        self.stream = stream
+        self.counts = Counter()
+        self.samples = defaultdict(list) # name -> [milliseconds]
+        self.stages = Counter() # name -> seconds
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        _current = self
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += n
+
+    def timing(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[name].append(seconds * 1000)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Adds the time spent in the block to the stage"""
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages[name] += time.perf_counter() - start
+
+    @contextmanager
+    def timed(self, name: str):
+        """Records the time spent in the block as a latency sample"""
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def emit(self) -> dict:
+        """Writes the metrics as an EMF document and returns it"""
+
+        global _current
+
+        if _current is self:
+            _current = None
+
+        elapsed = time.perf_counter() - self.start
+        values, units = {}, {}
+
+        with self._lock:
+            for name, n in self.counts.items():
+                values[name], units[name] = n, 'Count'
+
+            for name, samples in self.samples.items():
+                ordered = sorted(samples)
+
+                for p in PERCENTILES:
+                    values[f'{name}P{p}'], units[f'{name}P{p}'] = percentile(ordered, p), 'Milliseconds'
+
+                values[f'{name}Count'], units[f'{name}Count'] = len(ordered), 'Count'
+
+            for name, seconds in self.stages.items():
+                values[f'{name}Seconds'], units[f'{name}Seconds'] = round(seconds, 3), 'Seconds'
+
+        values['RunSeconds'], units['RunSeconds'] = round(elapsed, 3), 'Seconds'
+
+        if scanned := self.counts.get('RecordsScanned'):
+            values['RecordsPerSecond'], units['RecordsPerSecond'] = round(scanned / elapsed, 3) if elapsed else 0, 'Count/Second'
+
+        doc = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': self.namespace,
+                        'Dimensions': [list(self.dimensions.keys())],
+                        'Metrics': [{'Name': name, 'Unit': units[name]} for name in values]
+                    }
+                ]
+            },
+            **self.dimensions,
+            **values
+        }
+
+        stream = self.stream or sys.stderr
+        stream.write(json.dumps(doc) + '\n')
+        stream.flush()
+
+        return doc
+
+def percentile(ordered: list, p: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+
+    if not ordered:
+        return 0
+
+    rank = max(math.ceil(p / 100 * len(ordered)) - 1, 0)
+
+    return round(ordered[rank], 3)
+
+class _MongoCommands(monitoring.CommandListener):
+    def started(self, event):
+        if _current and event.command_name in MONGO_COMMANDS:
+            _current.count('MongoCommands')
+            _current.count(f'Mongo{event.command_name[0].upper()}{event.command_name[1:]}')
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# applies to clients created after this module is imported
+monitoring.register(_MongoCommands())
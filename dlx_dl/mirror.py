@@ -0,0 +1,111 @@
+'''A local mirror of DL records (`dlx_dl_mirror`), to avoid re-fetching unchanged records through the DL search API'''
+
+import re, zlib
+from datetime import datetime, timezone, timedelta
+from xml.etree import ElementTree
+from pymongo import ASCENDING, ReplaceOne
+from dlx import DB
+from dlx.marc import Marc, Bib
+
+MIRROR_COLLECTION = 'dlx_dl_mirror'
+CALLBACK_COLLECTION = 'undl_callback_log' # see export.CALLBACK_COLLECTION
+MAX_AGE = 7 * 24 * 60 * 60 # seconds. older entries are re-fetched regardless, in case the record was edited in DL
+
+class DLMirror():
+    def __init__(self, *, type: str, max_age: int = MAX_AGE):
+        """The DL version of records as last returned by the search API, keyed
+        by (type, record_id), where the record ID is from the DL record's
+        (DHL)/(DHLAUTH) 035. Entries are removed when the record is submitted
+        to DL, and are not used if fetched before the record's last callback"""
+
+        if not DB.connected:
+            raise Exception('Not connected to DB')
+
+        if type not in ('bib', 'auth'): raise Exception('"type" must be "bib" or "auth"')
+
+        self.type = type
+        self.max_age = max_age
+        self.collection = DB.handle[MIRROR_COLLECTION]
+        self.collection.create_index([('type', ASCENDING), ('record_id', ASCENDING)], unique=True)
+
+    def get(self, records: list[Marc]) -> dict[int, Marc]:
+        """Returns the mirrored DL records, by ID, that are current for the
+        given DLX records: fetched after the DLX record was last updated, after
+        the last callback for the record from DL, and within `max_age`"""
+
+        updated = {r.id: _utc(r.updated) for r in records}
+        oldest = datetime.now(timezone.utc) - timedelta(seconds=self.max_age)
+        entries = list(self.collection.find({'type': self.type, 'record_id': {'$in': list(updated.keys())}}))
+        callbacks = self.last_callbacks([x['record_id'] for x in entries])
+        found = {}
+
+        for entry in entries:
+            fetched = _utc(entry['time'])
+            dlx_updated = updated.get(entry['record_id'])
+            callback = callbacks.get(entry['record_id'])
+
+            if dlx_updated and fetched > dlx_updated and fetched > oldest and (callback is None or fetched > callback):
+                dl_record = Bib.from_xml_raw(ElementTree.fromstring(zlib.decompress(entry['xml'])), auth_control=False, delete_subfield_zero=False)
+                dl_record.id = entry['record_id']
+                found[dl_record.id] = dl_record
+
+        return found
+
+    def last_callbacks(self, record_ids: list[int]) -> dict[int, datetime]:
+        """The time of the last callback from DL for each record. A record
+        fetched before its last callback may not reflect the update that DL
+        made in the callback's import"""
+
+        if not record_ids:
+            return {}
+
+        callbacks = DB.handle[CALLBACK_COLLECTION].aggregate(
+            [
+                {'$match': {'record_type': self.type, 'record_id': {'$in': record_ids}}},
+                {'$group': {'_id': '$record_id', 'time': {'$max': '$time'}}}
+            ]
+        )
+
+        return {x['_id']: _utc(x['time']) for x in callbacks if isinstance(x.get('time'), datetime)}
+
+    def put(self, entries: list[tuple[int, ElementTree.Element | bytes]]) -> None:
+        """Stores the DL record XML elements returned by the search API, as
+        (record ID, element), or the elements serialized with
+        `ElementTree.tostring`"""
+
+        if not entries:
+            return
+
+        now = datetime.now(timezone.utc)
+        updates = []
+
+        for record_id, element in entries:
+            xml = element if isinstance(element, bytes) else ElementTree.tostring(element)
+            _005 = re.search(rb'<(?:\w+:)?controlfield tag="005">([^<]*)<', xml)
+            updates.append(
+                ReplaceOne(
+                    {'type': self.type, 'record_id': record_id},
+                    {
+                        'type': self.type,
+                        'record_id': record_id,
+                        '005': _005.group(1).decode('utf-8') if _005 else None,
+                        'time': now,
+                        'xml': zlib.compress(xml)
+                    },
+                    upsert=True
+                )
+            )
+
+        self.collection.bulk_write(updates, ordered=False)
+
+    def invalidate(self, record_ids: list[int]) -> None:
+        """Removes the entries, so that the records are fetched from DL again"""
+
+        self.collection.delete_many({'type': self.type, 'record_id': {'$in': list(record_ids)}})
+
+def _utc(dt: datetime | None) -> datetime | None:
+    # datetimes are naive UTC when read back from the DB
+    if dt is None:
+        return
+
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
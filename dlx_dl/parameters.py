@@ -0,0 +1,62 @@
+'''AWS SSM parameters, fetched only when needed and cached in the process, so that warm Lambda invocations don't call SSM'''
+
+import time, threading
+from itertools import islice
+from boto3 import client as botoclient
+
+REGION = 'us-east-1'
+TTL = 900 # seconds a fetched value is used before it is fetched again
+MAX_NAMES = 10 # names per GetParameters request
+
+_ssm = None # created on first use
+_cache = {} # name -> (value, time fetched)
+_lock = threading.Lock()
+
+def get_parameters(names, *, ttl: int = TTL) -> dict[str, str | None]:
+    """The values of the parameters, as {name: value}. Values fetched less
+    than `ttl` seconds ago are taken from the cache, and the rest are fetched
+    together. The value of a parameter that doesn't exist is None"""
+
+    global _ssm
+
+    names, values = list(dict.fromkeys(names)), {}
+    now = time.monotonic()
+
+    with _lock:
+        for name in names:
+            if name in _cache and now - _cache[name][1] < ttl:
+                values[name] = _cache[name][0]
+
+        missing = iter([x for x in names if x not in values])
+
+        while chunk := list(islice(missing, MAX_NAMES)):
+            _ssm = _ssm or botoclient('ssm', region_name=REGION)
+            response = _ssm.get_parameters(Names=chunk)
+
+            for param in response['Parameters']:
+                values[param['Name']] = param['Value']
+                _cache[param['Name']] = (param['Value'], now)
+
+            for name in response.get('InvalidParameters', []):
+                values[name] = None
+
+    return values
+
+def get_parameter(name: str, *, ttl: int = TTL) -> str | None:
+    return get_parameters([name], ttl=ttl)[name]
+
+def resolve(args, parameters: dict[str, str], *, ttl: int = TTL) -> None:
+    """Sets the attributes of `args` that are None from the parameters, as
+    {attribute: parameter name}. Nothing is fetched if they are all set"""
+
+    missing = {attr: name for attr, name in parameters.items() if getattr(args, attr, None) is None}
+
+    if missing:
+        values = get_parameters(missing.values(), ttl=ttl)
+
+        for attr, name in missing.items():
+            setattr(args, attr, values[name])
+
+def clear_cache() -> None:
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,157 @@
+'''Runs the stages of a process in threads connected by bounded queues'''
+
+import threading
+from queue import Queue, Empty, Full
+
+class Pipeline():
+    def __init__(self, source, *stages, depth: int = 0):
+        """Passes each item from the iterable `source` through the functions in
+        `stages`, in order. Each stage, and the draining of `source`, runs in
+        its own thread, with at most `depth` items waiting between stages, so
+        that network waits overlap with CPU work. Items are yielded in the
+        order of `source`. With a depth of 0, the stages run inline as items
+        are taken"""
+
+        self.depth = int(depth)
+
+        if self.depth < 0: raise Exception('"depth" must be at least 0')
+
+        self.source = iter(source)
+        self.stages = stages
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._held = {} # sequence number -> source item, for items in a thread's hands when stopped
+        self._queues = []
+        self._threads = []
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        if self.depth == 0:
+            for item in self.source:
+                for stage in self.stages:
+                    item = stage(item)
+
+                yield item
+
+            return
+
+        self._start()
+        last = self._queues[-1]
+
+        while 1:
+            entry = self._get(last)
+
+            if entry is _END or entry is None:
+                break
+            elif entry is _ERROR:
+                raise self._error
+
+            yield entry[2]
+
+    def close(self) -> list:
+        """Stops the threads. Returns the source items that were taken from
+        `source` but not yielded, in order"""
+
+        self._stop.set()
+
+        for thread in self._threads:
+            thread.join()
+
+        leftover = dict(self._held)
+
+        for q in self._queues:
+            while 1:
+                try:
+                    entry = q.get_nowait()
+                except Empty:
+                    break
+
+                if isinstance(entry, tuple):
+                    leftover[entry[0]] = entry[1]
+
+        self._held = {}
+
+        return [leftover[seq] for seq in sorted(leftover)]
+
+    def _start(self):
+        self._queues = [Queue(maxsize=self.depth) for _ in range(len(self.stages) + 1)]
+        self._threads = [threading.Thread(target=self._drain, daemon=True, name='dlx-dl-pipeline-0')]
+
+        for i, stage in enumerate(self.stages):
+            thread = threading.Thread(target=self._work, args=(stage, self._queues[i], self._queues[i + 1]), daemon=True, name=f'dlx-dl-pipeline-{i + 1}')
+            self._threads.append(thread)
+
+        for thread in self._threads:
+            thread.start()
+
+    def _drain(self):
+        # entries are (sequence number, source item, value)
+        seq = 0
+
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = next(self.source)
+                except StopIteration:
+                    self._put(self._queues[0], _END)
+                    return
+
+                self._put(self._queues[0], (seq, item, item))
+                seq += 1
+        except Exception as e:
+            self._fail(self._queues[0], e)
+
+    def _work(self, stage, q_in, q_out):
+        while 1:
+            entry = self._get(q_in)
+
+            if entry is None:
+                # stopped
+                return
+            elif entry is _END or entry is _ERROR:
+                self._put(q_out, entry)
+                return
+
+            seq, item, value = entry
+
+            try:
+                self._put(q_out, (seq, item, stage(value)))
+            except Exception as e:
+                self._hold(entry)
+                self._fail(q_out, e)
+                return
+
+    def _put(self, q, entry):
+        while not self._stop.is_set():
+            try:
+                q.put(entry, timeout=.1)
+                return
+            except Full:
+                continue
+
+        if isinstance(entry, tuple):
+            self._hold(entry)
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=.1)
+            except Empty:
+                continue
+
+    def _hold(self, entry):
+        with self._lock:
+            self._held[entry[0]] = entry[1]
+
+    def _fail(self, q, e):
+        self._error = self._error or e
+        self._put(q, _ERROR)
+
+_END = object()
+_ERROR = object()
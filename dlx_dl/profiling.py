@@ -0,0 +1,92 @@
+'''Profiles export and sync runs (--profile)'''
+
+import io, sys, cProfile, pstats, threading, tracemalloc
+from contextlib import contextmanager
+from dlx_dl import client
+
+TOP = 40
+
+@contextmanager
+def profiled(output: str = None, *, top: int = TOP):
+    """Runs the block under cProfile and tracemalloc if `output` is set, then
+    writes the hotspots sorted by cumulative and own time, the peak memory with
+    the largest allocation sites, and the time spent on each API endpoint to
+    `output` (a file path, "STDERR" or "STDOUT"). Threads started in the block,
+    such as the submission and pipeline workers, are profiled too, and their
+    hotspots are merged into the report. Does nothing if `output` is not set"""
+
+    if not output:
+        yield
+        return
+
+    client.reset_latency()
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profilers = [profiler]
+    lock = threading.Lock()
+
+    def profile_thread(frame, event, arg):
+        # runs once at the start of each new thread, and is replaced by the thread's own profiler
+        thread_profiler = cProfile.Profile()
+
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            # the interpreter allows only one profiler at a time
+            threading.setprofile(None)
+            return
+
+        with lock:
+            profilers.append(thread_profiler)
+
+    profiler.enable()
+    threading.setprofile(profile_thread)
+
+    try:
+        yield
+    finally:
+        threading.setprofile(None)
+        profiler.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        with lock:
+            report = _report(profilers, peak, snapshot, top)
+
+        if output.upper() == 'STDOUT':
+            print(report)
+        elif output.upper() == 'STDERR':
+            print(report, file=sys.stderr)
+        else:
+            with open(output, 'w') as f:
+                f.write(report)
+
+            # STDOUT may be the XML output
+            print(f'Profile written to {output}', file=sys.stderr)
+
+def _report(profilers, peak, snapshot, top) -> str:
+    out = io.StringIO()
+    out.write(f'threads profiled: {len(profilers)}\n')
+
+    for sort in ('cumulative', 'tottime'):
+        out.write(f'### hotspots by {sort} time\n')
+        stats = pstats.Stats(profilers[0], stream=out)
+
+        for thread_profiler in profilers[1:]:
+            stats.add(thread_profiler)
+
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+    out.write(f'### memory\npeak: {peak / 1024 / 1024:.1f} MiB\n')
+    out.write('largest allocation sites still held at the end of the run:\n')
+
+    for stat in snapshot.statistics('lineno')[:10]:
+        out.write(f'{stat}\n')
+
+    out.write('\n### API requests\n')
+
+    for endpoint, stats in client.latency().items():
+        out.write(f'{endpoint}: {stats["count"]} requests, {stats["errors"]} errors, {stats["retries"]} retries, {stats["seconds"]:.1f}s total, {stats["max_seconds"]:.1f}s max\n')
+
+    return out.getvalue()
@@ -0,0 +1,126 @@
+'''A sliding window rate limiter and circuit breaker for the UNDL search API, shared by all dlx-dl processes through the DB'''
+
+import time
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from dlx import DB
+
+RATE_LIMIT_COLLECTION = 'dlx_dl_rate_limit'
+KEY = 'undl-api' # one window per API key
+CAPACITY = 100 # the API allows 100 requests per 5 minutes
+PERIOD = 300 # seconds
+FAILURE_THRESHOLD = 5 # consecutive failures that open the circuit
+COOLDOWN = 30 # seconds the circuit stays open the first time. doubles each time it opens again without a success in between
+MAX_COOLDOWN = 300
+MAX_WAIT = 10 # seconds between checks while waiting, so that waits shortened by other processes are noticed
+
+class RateLimiter():
+    def __init__(self, *, key: str = KEY, capacity: int = CAPACITY, period: float = PERIOD, failure_threshold: int = FAILURE_THRESHOLD, cooldown: float = COOLDOWN, max_cooldown: float = MAX_COOLDOWN):
+        """Allows at most `capacity` requests in any `period` seconds across
+        all processes using the same `key`. The times of the requests in the
+        last `period` are kept in one document, which is updated atomically.
+        After `failure_threshold` consecutive failed requests the circuit
+        opens, and requests wait for the cooldown"""
+
+        if not DB.connected:
+            raise Exception('Not connected to DB')
+
+        self.key = key
+        self.capacity = capacity
+        self.period = period
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.collection = DB.handle[RATE_LIMIT_COLLECTION]
+
+    def acquire(self) -> float:
+        """Waits until a request is allowed and the circuit is closed. Returns
+        the number of seconds waited"""
+
+        waited = 0
+
+        while 1:
+            wait = self.try_acquire()
+
+            if wait == 0:
+                return waited
+
+            wait = min(wait, MAX_WAIT)
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self) -> float:
+        """Counts a request if fewer than `capacity` were made in the last
+        `period` and the circuit is closed. Returns 0 if the request was
+        counted, otherwise the number of seconds until it may be"""
+
+        doc = self._state()
+        now = time.time()
+
+        if doc.get('open_until') and doc['open_until'] > now:
+            return doc['open_until'] - now
+
+        if doc.get('held_until') and doc['held_until'] > now:
+            return doc['held_until'] - now
+
+        times = [t for t in doc.get('times', []) if t > now - self.period]
+
+        if len(times) >= self.capacity:
+            # until the oldest request that counts against the limit leaves the window
+            return times[-self.capacity] + self.period - now
+
+        # only succeeds if no other process has made a request since the state was read
+        result = self.collection.update_one(
+            {'_id': self.key, 'version': doc['version']},
+            {'$set': {'times': times + [now]}, '$inc': {'version': 1}}
+        )
+
+        # try again immediately if another process got there first
+        return 0 if result.modified_count else .001
+
+    def drain(self, seconds: float = 0) -> None:
+        """Holds back all requests for `seconds`, e.g. when the API reports
+        that the rate limit was exceeded anyway by clients that don't use this
+        limiter"""
+
+        doc = self._state()
+        held_until = max(doc.get('held_until') or 0, time.time() + seconds)
+        self.collection.update_one({'_id': self.key}, {'$set': {'held_until': held_until}, '$inc': {'version': 1}})
+
+    def record(self, ok: bool) -> None:
+        """Records the outcome of a request for the circuit breaker. Requests
+        that fail because of the API (5xx, timeouts) are not ok"""
+
+        if ok:
+            self.collection.update_one(
+                {'_id': self.key, '$or': [{'failures': {'$gt': 0}}, {'trips': {'$gt': 0}}]},
+                {'$set': {'failures': 0, 'trips': 0}}
+            )
+
+            return
+
+        self._state()
+        doc = self.collection.find_one_and_update({'_id': self.key}, {'$inc': {'failures': 1}}, return_document=ReturnDocument.AFTER)
+
+        if doc['failures'] >= self.failure_threshold:
+            cooldown = min(self.cooldown * 2 ** doc.get('trips', 0), self.max_cooldown)
+            self.collection.update_one(
+                {'_id': self.key},
+                {'$set': {'open_until': time.time() + cooldown, 'failures': 0}, '$inc': {'trips': 1}}
+            )
+
+            print(f'UNDL API circuit open for {cooldown} seconds after {doc["failures"]} consecutive failures')
+
+    def _state(self) -> dict:
+        if doc := self.collection.find_one({'_id': self.key}):
+            return doc
+
+        doc = {'_id': self.key, 'times': [], 'held_until': None, 'version': 0, 'failures': 0, 'trips': 0, 'open_until': None}
+
+        try:
+            self.collection.insert_one(doc)
+        except DuplicateKeyError:
+            # created by another process
+            return self.collection.find_one({'_id': self.key})
+
+        return doc
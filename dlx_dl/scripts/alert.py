@@ -6,11 +6,7 @@ from botocore.exceptions import ClientError, NoCredentialsError
 from dlx import DB
 from dlx.marc import Marc, Bib, Auth
 from dlx_dl.util import elapsed, PendingStatus
-
-SSM = client('ssm')
-
-def param(name):
-    return SSM.get_parameter(Name=name)['Parameter']['Value']
+from dlx_dl.parameters import resolve
 
 AP = ArgumentParser()
 AP.add_argument('--connect')
@@ -23,9 +19,8 @@ mg.add_argument('--phone_number', help='AWS SNS topic phone number')
 
 def run() -> dict:
     args = AP.parse_args()
-    # Default args - assign them here so that the code can compile withinut conecting to SSM
-    args.connect = args.connect or param('prodISSU-admin-connect-string')
-    args.topic_arn = args.topic_arn or param('dlx-dl-notifications-topicARN')
+    # Default args - assign them here so that the code can compile withinut conecting to SSM. Only the missing ones are fetched
+    resolve(args, {'connect': 'prodISSU-admin-connect-string', 'topic_arn': 'dlx-dl-notifications-topicARN'})
     DB.connect(args.connect, database=args.database) if DB.connected is False else None # if testing, already connected to DB
     statuses = []
 
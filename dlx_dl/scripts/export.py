@@ -1,6 +1,6 @@
-import os, sys, math, re, requests, json
+import os, sys, math, re, json, time
+from itertools import islice, chain
 from io import StringIO
-import boto3
 from warnings import warn
 from urllib.parse import urlparse, urlunparse, quote, unquote
 from datetime import datetime, timezone, timedelta
@@ -11,15 +11,37 @@ from dlx.file import File, Identifier
 from pymongo import MongoClient, DESCENDING
 from mongomock import MongoClient as MockClient
 from bson import SON
+from dlx_dl.util import FileResolver, FileIndex, FILE_LANGUAGES, compress_log_entry, deleted_since
+from dlx_dl.export_queue import ExportQueue, QUEUE_COLLECTION
+from dlx_dl.dispatch import Dispatcher
+from dlx_dl.buffer import BulkBuffer
+from dlx_dl.profiling import profiled
+from dlx_dl.metrics import Metrics
+from dlx_dl.mirror import DLMirror
+from dlx_dl import client
+from dlx_dl.parameters import resolve
 
 API_URL = 'https://digitallibrary.un.org/api/v1/record/'
 LOG_COLLECTION = 'dlx_dl_log'
-QUEUE_COLLECTION = 'dlx_dl_queue'
 CALLBACK_COLLECTION = 'undl_callback_log'
 BLACKLIST_COLLECTION = 'blacklist'
 WHITELIST = ['digitization.s3.amazonaws.com', 'undl-js.s3.amazonaws.com', 'un-maps.s3.amazonaws.com', 'dag.un.org']
 LIMIT = math.inf
+BATCH_MAX_RECORDS = 1000
+BATCH_MAX_BYTES = 10_000_000
+FILE_BATCH_SIZE = 100
 THESAURUS_URL = 'http://metadata.un.org/thesaurus'
+BLANK = re.compile(r'\s*')
+UPPER = re.compile(r'[A-Z]')
+FN_CHARS = str.maketrans(' [];', '_^^!')
+SYMBOL_CHARS = str.maketrans(' /[]*:;', '__^^!#%')
+CREDENTIALS = {
+    'connection_string': 'prodISSU-admin-connect-string',
+    'database': 'prodISSU-admin-database-name',
+    'api_key': 'undl-dhl-metadata-api-key',
+    'callback_url': 'undl-callback-url',
+    'nonce_key': 'undl-callback-nonce'
+} # arg -> SSM parameter
 
 AUTH_TYPE = {
     '100': 'PERSONAL',
@@ -53,6 +75,10 @@ def get_args(**kwargs):
     parser.add_argument('--queue', help='number of records at which to limit export and place in queue')
     parser.add_argument('--batch', action='store_true', help='write records to API as batch')
     parser.add_argument('--email', help='receive batch results by email instead of callback')
+    parser.add_argument('--batch_size', type=int, default=BATCH_MAX_RECORDS, help='max number of records per batch submission')
+    parser.add_argument('--concurrency', type=int, default=1, help='max number of API submissions in flight')
+    parser.add_argument('--batch_bytes', type=int, default=BATCH_MAX_BYTES, help='max size in bytes of the XML per batch submission')
+    parser.add_argument('--profile', nargs='?', const='STDERR', help='write a profile of the run to this file, or STDERR if no file is given')
     
     r = parser.add_argument_group('required')
     r.add_argument('--source', required=True, help='an identity to use in the log')
@@ -73,23 +99,17 @@ def get_args(**kwargs):
     om.add_argument('--xml', help='write XML as batch to this file. use "STDOUT" to print in console')
     om.add_argument('--use_api', '--api', action='store_true', help='submit records to DL through the API (boolean)')
     
-    # get from AWS if not provided
-    session = boto3.Session()
-    ssm = session.client("ssm")
-    
-    def param(name):
-        return None if os.environ.get('DLX_DL_TESTING') else ssm.get_parameter(Name=name)['Parameter']['Value'] 
-    
     c = parser.add_argument_group('credentials', description='these arguments are automatically supplied by AWS SSM if AWS credentials are configured')
-    c.add_argument('--connection_string', default=param('prodISSU-admin-connect-string'), help='MongoDB connection string')
-    c.add_argument('--database', default=param('prodISSU-admin-database-name'), help='The database to connect to, if the name can\'t be parsed from the connect string')
-    c.add_argument('--api_key', help='UNDL-issued api key', default=param('undl-dhl-metadata-api-key'))
-    c.add_argument('--callback_url', help="A URL that can receive the results of a submitted task.", default=param('undl-callback-url'))
-    c.add_argument('--nonce_key', help='A validation key that will be passed to and from the UNDL API.', default=param('undl-callback-nonce'))
+    c.add_argument('--connection_string', help='MongoDB connection string')
+    c.add_argument('--database', help='The database to connect to, if the name can\'t be parsed from the connect string')
+    c.add_argument('--api_key', help='UNDL-issued api key')
+    c.add_argument('--callback_url', help="A URL that can receive the results of a submitted task.")
+    c.add_argument('--nonce_key', help='A validation key that will be passed to and from the UNDL API.')
     
     # if run as function convert args to sys.argv
     if kwargs:
         ids, since_log, fonly, preview, api, batch = [kwargs.get(x) and kwargs.pop(x) for x in ('ids', 'modified_since_log', 'files_only', 'preview', 'use_api', 'batch')]
+        profile = kwargs.pop('profile') if kwargs.get('profile') is True else None
         
         sys.argv[1:] = ['--{}={}'.format(key, val) for key, val in kwargs.items()]
         
@@ -98,16 +118,31 @@ def get_args(**kwargs):
         if fonly: sys.argv.append('--files_only')
         if preview: sys.argv.append('--preview')
         if since_log: sys.argv.append('--modified_since_log')
+        if profile: sys.argv.append('--profile')
         if ids:
             sys.argv.append('--ids')
             sys.argv += ids
      
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    # get from AWS if not provided
+    if not os.environ.get('DLX_DL_TESTING'):
+        resolve(args, CREDENTIALS)
+
+    return args
 
 def run(**kwargs):
     START = datetime.now(timezone.utc)
     args = get_args(**kwargs)
-    
+    args.metrics = Metrics(dimensions={'Script': 'export', 'Source': args.source, 'RecordType': args.type})
+
+    with profiled(args.profile):
+        try:
+            return _run(args, START, kwargs)
+        finally:
+            args.metrics.emit()
+
+def _run(args, START, kwargs):
     ### connect to DB
     
     if isinstance(kwargs.get('connect'), (MongoClient, MockClient)):
@@ -117,91 +152,81 @@ def run(**kwargs):
         DB.connect(args.connection_string, database=args.database)
 
     log = DB.handle[LOG_COLLECTION]
-    queue = DB.handle[QUEUE_COLLECTION]
+    buffer = BulkBuffer()
+    queue = ExportQueue(type=args.type, source=args.source, buffer=buffer)
     blacklist = DB.handle[BLACKLIST_COLLECTION]
     blacklisted = [x['symbol'] for x in blacklist.find({})]
+    # submissions invalidate the records in the DL mirror used by sync
+    args.mirror = DLMirror(type=args.type) if args.use_api else None
     
     ### criteria
     
-    records = get_records(args, log, queue)
+    with args.metrics.stage('GetRecords'):
+        records = get_records(args, log, queue)
         
     ### write
     
     out = output_handle(args)
     export_start = START
-    seen = []
+    seen = set()
+    batch = Batch(args, log, export_start) if args.use_api and args.batch else None
     
     out.write('<collection>')
     
-    for record in records:
-        if record.id in seen:
-            continue
-
-        if args.type == 'bib':
-            if record.get_value('245', 'a')[0:16].lower() == 'work in progress':
+    # the buffer is flushed after the submissions in flight complete, including on error
+    with buffer, Dispatcher(args.concurrency) as dispatcher:
+        for record, files in with_files(records or [], args.type, index=FileIndex.current()):
+            if record.id in seen:
                 continue
+
+            args.metrics.count('RecordsScanned')
+
+            if args.type == 'bib':
+                if record.get_value('245', 'a')[0:16].lower() == 'work in progress':
+                    continue
             
-            record = process_bib(record, blacklisted=blacklisted, files_only=args.files_only)
+                record = process_bib(record, blacklisted=blacklisted, files_only=args.files_only, files=files)
             
-            if args.files_only and not record.get_fields('FFT'):
-                print(f'[{record.id}] No files detected')
-                continue
+                if args.files_only and not record.get_fields('FFT'):
+                    print(f'[{record.id}] No files detected')
+                    continue
                 
-        elif args.type == 'auth':
-            record = process_auth(record)
+            elif args.type == 'auth':
+                record = process_auth(record)
         
-        # clean
+            # clean
         
-        skip_and_add_to_queue = False
-        
-        for field in record.datafields:
-            for sub in field.subfields:
-                if hasattr(sub, 'xref') and sub.value is None:            
-                    # the xref auth is not in the system yet
-                    skip_and_add_to_queue = True
-                elif not hasattr(sub, 'xref'):
-                    if re.match(r'^-+$', sub.value):
-                        sub.value.replace('-', '_')
-                    elif sub.value == '' or re.match(r'^\s+$', sub.value):
-                        field.subfields.remove(sub)
-                        
-            if len(field.subfields) == 0:
-                record.fields.remove(field)
-
-        if args.use_api and skip_and_add_to_queue:
-            if queue.count_documents({'type': args.type, 'record_id': record.id}) == 0:
-                queue.insert_one(
-                    {'time': datetime.now(timezone.utc), 'source': args.source, 'type': args.type, 'record_id': record.id}
-                )
+            skip_and_add_to_queue = clean(record, check_xrefs=True)
+
+            if args.use_api and skip_and_add_to_queue:
+                queue.enqueue([record])
+                args.metrics.count('RecordsQueued')
             
-            continue
+                continue
             
-        # export
-        xml = record.to_xml(xref_prefix='(DHLAUTH)', write_id=False)
+            # export
+            xml = record.to_xml(xref_prefix='(DHLAUTH)', write_id=False)
         
-        if args.use_api:
-            if args.batch:
-                pass
-            else:    
-                logdata = submit_to_dl(record, export_start, args)
-                queue.delete_many({'type': args.type, 'record_id': record.id})     
-                log.insert_one(logdata)
-            
-                # clean for JSON serialization
-                logdata.pop('_id', None) # pymongo adds the _id key to the dict on insert??
-                logdata['export_start'] = str(logdata['export_start'])
-                logdata['time'] = str(logdata['time'])
-                print(json.dumps(logdata))
-            
-                queue.delete_many({'type': args.type, 'record_id': record.id})
+            if args.use_api:
+                if batch:
+                    # submitted when the batch fills
+                    batch.add(record.id, xml)
+                else:    
+                    # logged when the response is received
+                    dispatcher.submit(record.id, submit_and_log, record, export_start, args, xml=xml, log=log, queue=queue, buffer=buffer)
         
-        seen.append(record.id)
-        out.write(xml)
+            seen.add(record.id)
+            args.metrics.count('RecordsExported')
+            out.write(xml)
 
     out.write('</collection>')
     
-    if args.use_api and args.batch:
-        submit_batch(out.getvalue(), args)
+    if batch:
+        # submit the remainder
+        batch.flush()
+
+    # items taken from the queue but not exported
+    queue.release()
 
     if args.use_api:
         log.insert_one({'source': args.source, 'record_type': args.type, 'export_start': export_start, 'export_end': datetime.now(timezone.utc)})
@@ -210,6 +235,18 @@ def run(**kwargs):
     
 ###
 
+def with_files(records, record_type, batch_size=FILE_BATCH_SIZE, index=None):
+    """Yields each record paired with a FileResolver prefetched for the batch 
+    it belongs to (None for auths)"""
+
+    records = iter(records)
+
+    while batch := list(islice(records, batch_size)):
+        files = FileResolver(batch, index=index) if record_type == 'bib' else None
+
+        for record in batch:
+            yield record, files
+
 def get_records(args, log, queue):
     cls = BibSet if args.type == 'bib' else AuthSet
     since, to = None, None
@@ -249,37 +286,35 @@ def get_records(args, log, queue):
         exit()
 
     ### queue
+
+    if args.queue is None:
+        # no limit, so stream the records straight from the cursor
+        return records
     
     to_process = []
     limit = int(args.queue or 0) or LIMIT
+    records = iter(records)
 
-    for i, r in enumerate(records):       
-        if i < limit:
-            to_process.append(r)
-        else:
-            if i == limit:
-                warn(f'Limiting export set to {limit} and adding the rest to the queue')
-            
-            queue.insert_one(
-                {'time': datetime.now(timezone.utc), 'source': args.source, 'type': args.type, 'record_id': r.id}
-            )
+    for r in records:
+        to_process.append(r)
+
+        if len(to_process) >= limit:
+            break
+
+    if (r := next(records, None)) is not None:
+        warn(f'Limiting export set to {limit} and adding the rest to the queue')
+        queue.enqueue(chain([r], records))
     
-    if args.queue is not None and len(to_process) < limit:
-        free_space = limit - len(to_process)
-        queued = queue.find({'source': args.source, 'type': args.type}, limit=free_space)
-        
-        i = None
+    if limit != LIMIT and len(to_process) < limit:
+        # deleted records are no longer in the collection. they are exported by sync from their history
+        lease = queue.lease(limit - len(to_process), priorities=['NEW', 'UPDATE'])
         
-        for i, d in enumerate(queued):
-            record = next(cls.from_query({'_id': d['record_id']}), None)
-            
-            if record:
-                to_process.append(record)
-            else:
-                queue.delete_many({'type': args.type, 'record_id': d['record_id']})
-                
-        if i:
-            warn(f'Took {i + 1} from queue')
+        if lease.items:
+            found = list(cls.from_query({'_id': {'$in': lease.record_ids}}))
+            to_process += found
+            # queued records that no longer exist
+            queue.ack(set(lease.record_ids) - set([x.id for x in found]))
+            warn(f'Took {len(lease.items)} from queue')
 
     return to_process
 
@@ -306,32 +341,28 @@ def output_handle(args):
                 out = sys.stdout
         else:
             out = open(args.xml, 'w', encoding='utf-8')
-    elif args.batch:
-        out = StringIO()
     else:
         out = open(os.devnull, 'w', encoding='utf-8')
         
     return out
 
-def process_bib(bib, *, blacklisted, files_only):
+def process_bib(bib, *, blacklisted, files_only, files=None):
     if bib.get_value('245', 'a')[0:16].lower() == 'work in progress':
         return bib
     
+    files = files or FileResolver([bib])
     flags = list(filter(lambda x: x in blacklisted, bib.get_values('191', 'a')))
     
     if not flags and 'RES' not in bib.get_values('091', 'a'):   
-        _fft_from_files(bib)
+        _fft_from_files(bib, files=files)
     
     if files_only and not bib.get_fields('FFT'):
         return bib
     
-    while bib.get_value('001'):
-        bib.delete_field('001')
-    
-    bib.delete_field('005')
-    bib = _035(bib)
-    bib = _561(bib)
-    bib = _856(bib)
+    _035s, _856s = _partition(bib)
+    bib = _035(bib, fields=_035s)
+    bib = _561(bib, files=files)
+    bib = _856(bib, fields=_856s)
     
     if bib.get_value('980', 'a') == 'DELETED':
         return bib
@@ -341,11 +372,8 @@ def process_bib(bib, *, blacklisted, files_only):
     return bib
     
 def process_auth(auth):
-    while auth.get_value('001'):
-        auth.delete_field('001')
-        
-    auth.delete_field('005')
-    auth = _035(auth)
+    _035s, _ = _partition(auth, files=False)
+    auth = _035(auth, fields=_035s)
     
     if auth.get_value('980', 'a') == 'DELETED':
         return auth
@@ -354,34 +382,98 @@ def process_auth(auth):
                 
     return auth
     
-def _035(record):
-    place = 0
-    
-    for field in record.get_fields('035'):
+def _partition(record, files=True):
+    """One pass over the fields that removes the 001s and the first 005, and
+    returns the 035s and, if `files`, the whitelisted 856s (which are also 
+    removed)"""
+
+    fields, _035s, _856s = [], [], []
+    drop_001, drop_005 = True, True
+
+    for field in record.fields:
+        tag = field.tag
+
+        if tag == '001' and drop_001:
+            if field.value:
+                continue
+
+            # 001s are only removed up to the first one without a value
+            drop_001 = False
+        elif tag == '005' and drop_005:
+            drop_005 = False
+            continue
+        elif tag == '035':
+            _035s.append(field)
+        elif tag == '856' and files and urlparse(field.get_value('u')).netloc in WHITELIST:
+            _856s.append(field)
+            continue
+
+        fields.append(field)
+
+    record.fields[:] = fields
+
+    return _035s, _856s
+
+def clean(record, *, check_xrefs=False) -> bool:
+    """Removes blank subfields, and fields left without subfields. Returns 
+    True if `check_xrefs` and an xref subfield has no value (the xref auth is
+    not in the system yet)"""
+
+    missing_xref, empty = False, set()
+
+    for field in record.datafields:
+        kept, skip = [], False
+
+        for sub in field.subfields:
+            if skip:
+                # the subfield following a removed one is not checked
+                kept.append(sub)
+                skip = False
+            elif hasattr(sub, 'xref'):
+                if check_xrefs and sub.value is None:
+                    missing_xref = True
+
+                kept.append(sub)
+            elif BLANK.fullmatch(sub.value):
+                skip = True
+            else:
+                kept.append(sub)
+
+        if len(kept) != len(field.subfields):
+            field.subfields = kept
+
+        if len(field.subfields) == 0:
+            empty.add(id(field))
+
+    if empty:
+        record.fields[:] = [x for x in record.fields if id(x) not in empty]
+
+    return missing_xref
+
+def _035(record, fields=None):
+    for field in (record.get_fields('035') if fields is None else fields):
         ctr = field.get_value('a')
         pre = ctr[0]
         new = str(record.id) + 'X'
         
-        if re.match(r'[A-Z]', pre):
+        if UPPER.match(pre):
             new = pre + new
         
-        record.set('035', 'a', new, address=[place])
-        record.set('035', 'z', ctr, address=[place])
-        
-        place += 1
+        field.set('a', new)
+        field.set('z', ctr)
     
     pre = '(DHL)' if isinstance(record, Bib) else '(DHLAUTH)'
     record.set('035', 'a', pre + str(record.id), address=['+'])
     
     return record
     
-def _561(bib):
+def _561(bib, files=None):
     uris = bib.get_values('561', 'u')
     place, seen = 0, []
+    files = files or FileResolver([bib])
 
     for uri in uris:
-        if files := list(File.find_by_identifier(Identifier('uri', uri))):
-            latest = sorted(files, key=lambda x: x.timestamp, reverse=True)[0]
+        if latest := files.latest_by_identifier(Identifier('uri', uri)):
             _fft = Datafield('FFT', record_type='bib')
             _fft.set('a', 'https://' + latest.uri)
             _fft.set('d', ', '.join([ISO_STR.get(x, '') for x in latest.languages]))
@@ -404,11 +496,15 @@ def _561(bib):
 
     return bib
 
-def _856(bib):
+def _856(bib, fields=None):
     place = len(bib.get_fields('FFT'))
     seen = []
+
+    if fields is None:
+        fields = [x for x in bib.get_fields('856') if urlparse(x.get_value('u')).netloc in WHITELIST]
+        bib.fields[:] = [x for x in bib.fields if not any(x is y for y in fields)]
     
-    for field in bib.get_fields('856'):
+    for field in fields:
         url = field.get_value('u')
         parsed = urlparse(url)
         
@@ -419,7 +515,8 @@ def _856(bib):
             if unquote(url_path) == url_path:
                 url_path = quote(url_path)
             
-            bib.set('FFT', 'a', urlunparse([parsed.scheme, parsed.netloc, url_path, None, None, None]), address=['+'])
+            _fft = Datafield('FFT', record_type='bib')
+            _fft.set('a', urlunparse([parsed.scheme, parsed.netloc, url_path, None, None, None]))
             old_fn = url.split('/')[-1]
             new_fn = clean_fn(old_fn)
             parts = new_fn.split('.')
@@ -432,18 +529,18 @@ def _856(bib):
             else:
                 seen.append(base)
             
-            bib.set('FFT', 'n', new_fn, address=[place])
+            _fft.set('n', new_fn)
 
             if parsed.path.split('.')[-1] == 'tiff':
-                bib.set('FFT', 'r', 'tiff', address=[place])
+                _fft.set('r', 'tiff')
                 
             lang = field.get_value('3')
             
             if lang:
                 lang = 'English' if lang == 'Eng' else lang
-                bib.set('FFT', 'd', lang, address=[place])
+                _fft.set('d', lang)
             
-            bib.fields.remove(field)
+            bib.fields.append(_fft)
             place += 1
             
     return bib
@@ -494,44 +591,33 @@ def get_records_by_date(cls, date_from, date_to=None, delete_only=False):
     )
     
     rcls = Bib if cls == BibSet else Auth
-    hist = DB.handle['bib_history'] if cls == BibSet else DB.handle['auth_history']
-    deleted = list(hist.find({'deleted.time': {'$gte': date_from}}, {'_id': 1, 'deleted.time': 1}))
-    restored = []
-    
-    for i in range(0, len(deleted), 10000):
-        restored += cls.from_query({'_id': {'$in': [x['_id'] for x in deleted[i:i+10000]]}}, {'_id': 1}).records
-        
-    filtered_ids = list(set([x['_id'] for x in deleted]) - set([x.id for x in restored]))
-    deleted = list(filter(lambda x: x['_id'] in filtered_ids, deleted))
-    
-    print(f'found: {len(deleted)}')
+    deleted = deleted_since('bib' if cls == BibSet else 'auth', date_from)
 
-    if deleted:
-        if delete_only:
-            rset.records = []
-            
-        records = list(rset.records)
-        to_delete = []
-        
+    def to_delete():
         for d in deleted:
             r = rcls({'_id': d['_id']})
             r.set('980', 'a', 'DELETED')
             r.updated = d['deleted']['time']
-            to_delete.append(r)
 
-        rset.records = (r for r in records + to_delete) # program is expecting an iterable
-    else:
-        if delete_only:
-            rset.records = []
+            yield r
+
+    records = [] if delete_only else rset.records
+    rset.records = chain(records, to_delete()) # program is expecting an iterable
 
     return rset
     
-def _new_file_symbols(date_from, date_to=None):
-    fft_symbols = []
+def _new_files_query(date_from, date_to=None) -> dict:
+    """The query for the files added or updated in the time range"""
+
     criteria = {'$gte': date_from}
     date_to and criteria.setdefault('$lte', date_to)
 
-    for f in DB.files.find({'$or': [{'timestamp': criteria}, {'updated': criteria}]}):
+    return {'$or': [{'timestamp': criteria}, {'updated': criteria}]}
+
+def _new_file_symbols(date_from, date_to=None):
+    fft_symbols = []
+
+    for f in DB.files.find(_new_files_query(date_from, date_to)):
         for idx in f['identifiers']:
             if idx['type'] == 'symbol' and idx['value'] != '' and idx['value'] != ' ' and idx['value'] != '***': # note: clean these up in db
                 fft_symbols.append(idx['value'])
@@ -540,18 +626,17 @@ def _new_file_symbols(date_from, date_to=None):
 
 def _new_file_uris(date_from: datetime, date_to=None) -> list:
     uris = []
-    criteria = {'$gte': date_from}
-    date_to and criteria.setdefault('$lte', date_to)
 
-    for f in DB.files.find({'$or': [{'timestamp': criteria}, {'updated': criteria}]}):
+    for f in DB.files.find(_new_files_query(date_from, date_to)):
         for idx in f['identifiers']:
             if idx['type'] == 'uri' and idx['value'] != '' and idx['value'] != ' ' and idx['value'] != '***': # note: clean these up in db
                 uris.append(idx['value'])
                 
     return list(set(uris))
     
-def _fft_from_files(bib):
+def _fft_from_files(bib, files=None):
     symbols = bib.get_values('191', 'a') + bib.get_values('191', 'z')
+    files = files or FileResolver([bib])
 
     seen = []
     
@@ -559,8 +644,8 @@ def _fft_from_files(bib):
         if symbol == '' or symbol == ' ' or symbol == '***': # note: clean these up in db
             continue
            
-        for lang in ('AR', 'ZH', 'EN', 'FR', 'RU', 'ES', 'DE'):
-            xfile = File.latest_by_identifier_language(Identifier('symbol', symbol), lang)
+        for lang in FILE_LANGUAGES:
+            xfile = files.latest_by_identifier_language(Identifier('symbol', symbol), lang)
             
             if xfile and lang not in seen:
                 field = Datafield(record_type='bib', tag='FFT', ind1=' ', ind2=' ')
@@ -576,7 +661,7 @@ def _fft_from_files(bib):
 def clean_fn(fn):
     parts = fn.split('.')
     fn = '-'.join(parts[:-1]) + '.' + parts[-1]
-    fn = fn.translate(str.maketrans(' [];', '_^^!'))
+    fn = fn.translate(FN_CHARS)
     return fn
     
 def encode_fn(symbols, language, extension):
@@ -584,12 +669,12 @@ def encode_fn(symbols, language, extension):
     
     ISO6391.codes[language.lower()]
     symbols = [symbols] if isinstance(symbols, str) else symbols
-    xsymbols = [sym.translate(str.maketrans(' /[]*:;', '__^^!#%')) for sym in symbols]
+    xsymbols = [sym.translate(SYMBOL_CHARS) for sym in symbols]
 
     return '{}-{}.{}'.format('--'.join(xsymbols), language.upper(), extension)
 
-def submit_to_dl(record, export_start, args):
-    xml = record.to_xml(xref_prefix='(DHLAUTH)', write_id=False)
+def submit_to_dl(record, export_start, args, xml=None):
+    xml = xml or record.to_xml(xref_prefix='(DHLAUTH)', write_id=False)
     
     headers = {
         'Authorization': 'Token ' + args.api_key,
@@ -604,7 +689,16 @@ def submit_to_dl(record, export_start, args):
         'nonce': json.dumps(nonce)
     } 
 
-    response = requests.post(API_URL, params=params, headers=headers, data=xml.encode('utf-8'))
+    if mirror := getattr(args, 'mirror', None):
+        # the DL record is about to change
+        mirror.invalidate([record.id])
+
+    start = time.perf_counter()
+    response = client.post(API_URL, params=params, headers=headers, data=xml.encode('utf-8'))
+
+    if metrics := getattr(args, 'metrics', None):
+        metrics.timing('SubmitLatency', time.perf_counter() - start)
+        metrics.count(f'Response{response.status_code}')
     
     logdata = {
         'export_start': export_start,
@@ -619,6 +713,83 @@ def submit_to_dl(record, export_start, args):
     
     return logdata
 
+def submit_and_log(record, export_start, args, *, xml, log, queue, buffer=None):
+    logdata = submit_to_dl(record, export_start, args, xml=xml)
+    queue.ack([record.id])
+    entry = compress_log_entry(logdata)
+    buffer.insert(log, entry) if buffer else log.insert_one(entry)
+
+    # clean for JSON serialization
+    logdata.pop('_id', None) # pymongo adds the _id key to the dict on insert??
+    logdata['export_start'] = str(logdata['export_start'])
+    logdata['time'] = str(logdata['time'])
+    print(json.dumps(logdata))
+
+    return logdata
+
+class Batch():
+    def __init__(self, args, log, export_start):
+        """Collects record XML and submits it to the API in chunks capped by 
+        record count (--batch_size) and bytes (--batch_bytes)"""
+
+        if not args.email:
+            raise Exception('--email required with batch')
+        
+        self.args = args
+        self.log = log
+        self.export_start = export_start
+        self.max_records = int(args.batch_size)
+        self.max_bytes = int(args.batch_bytes)
+        self.number = 0
+        self._ids, self._xml, self._size = [], [], 0
+
+    def add(self, record_id, xml):
+        size = len(xml.encode('utf-8'))
+
+        if self._ids and (len(self._ids) >= self.max_records or self._size + size > self.max_bytes):
+            self.flush()
+
+        self._ids.append(record_id)
+        self._xml.append(xml)
+        self._size += size
+
+    def flush(self):
+        if not self._ids:
+            return
+        
+        self.number += 1
+        xml = '<collection>' + ''.join(self._xml) + '</collection>'
+        if mirror := getattr(self.args, 'mirror', None):
+            mirror.invalidate(self._ids)
+
+        start = time.perf_counter()
+        response = submit_batch(xml, self.args)
+
+        if metrics := getattr(self.args, 'metrics', None):
+            metrics.timing('BatchSubmitLatency', time.perf_counter() - start)
+            metrics.count(f'Response{response.status_code}')
+
+        logdata = {
+            'export_start': self.export_start,
+            'time': datetime.now(timezone.utc),
+            'source': self.args.source,
+            'record_type': self.args.type,
+            'batch': self.number,
+            'record_ids': self._ids,
+            'size': len(xml.encode('utf-8')),
+            'response_code': response.status_code,
+            'response_text': response.text.replace('\n', '')
+        }
+
+        self.log.insert_one(logdata)
+        self._ids, self._xml, self._size = [], [], 0
+        
+        # clean for JSON serialization
+        logdata.pop('_id', None)
+        logdata['export_start'] = str(logdata['export_start'])
+        logdata['time'] = str(logdata['time'])
+        print(json.dumps(logdata))
+
 def submit_batch(xml, args):
     if not args.email:
         raise Exception('--email required with batch')
@@ -635,9 +806,11 @@ def submit_batch(xml, args):
         'callback_email': args.email
     }
 
-    response = requests.post(API_URL, params=params, headers=headers, data=xml.encode('utf-8'))
+    response = client.post(API_URL, params=params, headers=headers, data=xml.encode('utf-8'))
     
     print(response.text)
+
+    return response
     
 ###
 
@@ -0,0 +1,31 @@
+'''Builds and refreshes the materialized index of the latest file per identifier and language'''
+
+from argparse import ArgumentParser
+from dlx import DB
+from dlx_dl.util import FileIndex
+
+ap = ArgumentParser('dlx-dl-file-index')
+ap.add_argument('command', choices=['rebuild', 'refresh'], help='rebuild the whole index, or update it from files added or updated since the last build/refresh')
+ap.add_argument('--connect', required=True, help='MongoDB connection string')
+ap.add_argument('--database', help='The database to connect to, if the name can\'t be parsed from the connect string')
+
+def run() -> int:
+    args = ap.parse_args()
+    DB.connect(args.connect, database=args.database) if DB.connected is False else None # if testing, already connected to DB
+    index = FileIndex()
+
+    if args.command == 'rebuild':
+        count = index.rebuild()
+        print(f'Indexed {count} identifiers')
+    else:
+        count = index.refresh()
+        print(f'Refreshed {count} identifiers')
+
+    print(f'Current to {index.watermark}')
+
+    return count
+
+###
+
+if __name__ == '__main__':
+    run()
@@ -1,16 +1,18 @@
 '''Writes a report of records that have been deleted in unbis but are still in undl'''
 
-import sys, os, re, json, requests, time
+import sys, os, re, json, time
 from argparse import ArgumentParser
 from xml.etree import ElementTree
 from dlx import DB
 from dlx.marc import Bib, Auth
 from dlx_dl.scripts import sync
-from boto3 import client as botoclient
+from dlx_dl import client
+from dlx_dl.ratelimit import RateLimiter
+from dlx_dl.search import SearchResults
+from dlx_dl.parameters import get_parameter
 
 API_SEARCH_URL = 'https://digitallibrary.un.org/api/v1/search'
 NS = '{http://www.loc.gov/MARC21/slim}'
-API_KEY = botoclient('ssm', region_name='us-east-1').get_parameter(Name='undl-dhl-metadata-api-key')['Parameter']['Value']
 
 def get_args():
     ap = ArgumentParser()
@@ -19,15 +21,18 @@ def get_args():
     ap.add_argument('--type', choices=['bib', 'auth'])
     ap.add_argument('--query', help='UNDL query string')
     ap.add_argument('--output_file', help='Path to the file to write results to')
+    ap.add_argument('--api_key', help='UNDL-issued api key. supplied by AWS SSM if not given')
 
     return ap.parse_args()
 
 def run():
     args = get_args()
     DB.connect(args.connect, database=args.database)
+    # API requests are rate limited together with the other dlx-dl processes
+    client.set_limiter(RateLimiter())
     output_file = args.output_file or f'{time.time()}.txt'
     OUT = open(output_file, 'w')
-    HEADERS = {'Authorization': 'Token ' + API_KEY}
+    HEADERS = {'Authorization': 'Token ' + (args.api_key or get_parameter('undl-dhl-metadata-api-key'))}
     search_id = ''
     url = f'{API_SEARCH_URL}?search_id={search_id}&p={args.query or ""}&format=xml'
     page = 1
@@ -40,38 +45,17 @@ def run():
         if args.type == 'auth':
             url += '&c=Authorities'
 
-        response = requests.get(url, headers=HEADERS)
+        # waits for the rate limiter, and retries rate limit and bad gateway errors
+        response = client.get(url, headers=HEADERS, stream=True)
        
-        if response.status_code == 429:
-            print('\nRate limit reached. Waiting five mintues to retry...')
-            time.sleep(60 * 5)
-            print('OK, resuming.')
-            continue
-        elif response.status_code == 502:
-            # bad gateway
-            print('\nBad gateway. Waiting five mintues to retry...')
-            time.sleep(60 * 5)
-            print('OK, resuming.')
-            continue
-        elif not response.ok:
+        if not response.ok:
             raise Exception(f'{response.status_code}: {response.text}')
 
-        root = ElementTree.fromstring(response.text)
-        col = root.find(f'{NS}collection')
-
-        if len(col) == 0:
-            break
-        
-        search_id = root.find('search_id').text
-        total = int(root.find('total').text or 0)
-
-        if page == 1:
-            print(f'Found {total} records')
-            print('Writing results to ' + output_file)
-
+        # parsed as the page is downloaded
+        results = SearchResults(response)
         dl_ids = []
     
-        for rec in col:
+        for rec in results:
             seen += 1
             dl_record = (Bib if args.type == 'bib' else Auth).from_xml_raw(rec)
             _035 = next(filter(lambda x: re.match('^\(DHL', x), dl_record.get_values('035', 'a')), '')
@@ -81,6 +65,16 @@ def run():
                     dl_record.id = int(match.group(2))
                     dl_ids.append(dl_record.id)
 
+        if results.count == 0:
+            break
+
+        search_id = results.search_id
+        total = results.total or 0
+
+        if page == 1:
+            print(f'Found {total} records')
+            print('Writing results to ' + output_file)
+
         dlx_ids = [x['_id'] for x in (DB.bibs if args.type == 'bib' else DB.auths).find({'_id': {'$in': dl_ids}}, projection={'_id': 1})]
         
         if not_in_dlx := [x for x in dl_ids if x not in dlx_ids]:
@@ -97,7 +91,6 @@ def run():
     if total == 0:
         print('No records meeting search criteria found')
     elif seen != total:
-        print(response.text)
         print(f'Only {seen}/{total} of the DL records were seen. The API may not have returned all the results. Found {to_delete_count} records to delete. Results in {output_file}')
     else:
         print(f'Found {to_delete_count} records to delete. Results in {output_file}')
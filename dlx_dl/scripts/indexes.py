@@ -0,0 +1,179 @@
+'''Creates the indexes behind the scripts' hot queries and checks that the queries use them'''
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone, timedelta
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from dlx import DB, Config
+from dlx.marc import BibSet, AuthSet
+from dlx_dl.scripts.export import LOG_COLLECTION, CALLBACK_COLLECTION, _new_files_query
+from dlx_dl.scripts.sync import date_query
+from dlx_dl.util import deleted_since_pipeline
+from dlx_dl.export_queue import ExportQueue, QUEUE_COLLECTION
+
+# collection -> index keys
+INDEXES = {
+    LOG_COLLECTION: [
+        [('source', ASCENDING), ('time', DESCENDING)],
+        [('source', ASCENDING), ('record_type', ASCENDING), ('time', DESCENDING)],
+        [('source', ASCENDING), ('record_type', ASCENDING), ('export_start', DESCENDING)],
+        [('export_start', ASCENDING), ('export_type', ASCENDING), ('time', DESCENDING)],
+    ],
+    CALLBACK_COLLECTION: [
+        [('record_type', ASCENDING), ('record_id', ASCENDING), ('nonce.export_id', ASCENDING)],
+        [('record_type', ASCENDING), ('record_id', ASCENDING), ('time', DESCENDING)],
+    ],
+    'bib_history': [[('deleted.time', ASCENDING)]],
+    'auth_history': [[('deleted.time', ASCENDING)]],
+    'bibs': [
+        [('updated', ASCENDING)],
+        [('191.subfields.value', ASCENDING)],
+        [('561.subfields.value', ASCENDING)],
+    ],
+    'auths': [[('updated', ASCENDING)]],
+    'files': [
+        [('timestamp', ASCENDING)],
+        [('updated', ASCENDING)],
+        [('identifiers.type', ASCENDING), ('identifiers.value', ASCENDING)],
+    ],
+    'dlx_dl_alert': [[('collection', ASCENDING), ('time', DESCENDING)]],
+}
+
+# collection -> index keys, for the record queries that are run with `Config.marc_index_default_collation`.
+# a query with a collation can only use an index with the same collation for string comparisons
+COLLATED_INDEXES = {
+    'bibs': [
+        [('updated', ASCENDING)],
+        [('191.subfields.value', ASCENDING)],
+        [('561.subfields.value', ASCENDING)],
+    ],
+    'auths': [[('updated', ASCENDING)]],
+}
+
+INDEX_EXISTS = (85, 86) # IndexOptionsConflict, IndexKeySpecsConflict
+
+ap = ArgumentParser('dlx-dl-indexes')
+ap.add_argument('--connect', required=True, help='MongoDB connection string')
+ap.add_argument('--database', help='The database to connect to, if the name can\'t be parsed from the connect string')
+ap.add_argument('--check_only', action='store_true', help='only explain the queries, don\'t create any indexes')
+
+def run() -> int:
+    """Returns the number of hot queries that fall back to a collection scan"""
+
+    args = ap.parse_args()
+    DB.connect(args.connect, database=args.database) if DB.connected is False else None # if testing, already connected to DB
+
+    if not args.check_only:
+        for name in ensure_indexes():
+            print(f'Ensured {name}')
+
+    scans = 0
+
+    for name, plan in explain():
+        stages = collscans(plan)
+        scans += bool(stages)
+        print(f'{"COLLSCAN" if stages else "OK"}: {name}')
+
+    print(f'{scans} queries fall back to a collection scan')
+
+    return scans
+
+def ensure_indexes() -> list[str]:
+    """Creates the indexes that don't exist yet. Returns the index names"""
+
+    names = []
+    collated = {col: [(keys, {'collation': Config.marc_index_default_collation, 'name': index_name(keys) + '_collated'}) for keys in indexes] for col, indexes in COLLATED_INDEXES.items()}
+
+    for col, indexes in INDEXES.items():
+        for keys, options in [(keys, {}) for keys in indexes] + collated.pop(col, []):
+            try:
+                names.append(f'{col}.{DB.handle[col].create_index(keys, **options)}')
+            except OperationFailure as e:
+                # the same keys are already indexed under another name or with other options
+                if e.code not in INDEX_EXISTS:
+                    raise e
+
+                names.append(f'{col}.{keys} (exists)')
+
+    # the queue manages its own indexes
+    ExportQueue(type='bib')
+    names.append(f'{QUEUE_COLLECTION} (queue indexes)')
+
+    return names
+
+def index_name(keys: list[tuple]) -> str:
+    # the name MongoDB gives the index by default
+    return '_'.join(f'{key}_{direction}' for key, direction in keys)
+
+def hot_queries() -> list[tuple]:
+    """The query shapes used by `sync.run`, `get_records_by_date`,
+    `PendingStatus` and `alert.run`, with representative values, as
+    (name, collection, filter, sort, collation). The record and file queries
+    of `get_records_by_date` are built by the functions that build them for
+    the scripts"""
+
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(hours=1)
+    collation = Config.marc_index_default_collation
+
+    return [
+        ('sync preflight', LOG_COLLECTION, {'source': 'dlx-dl-lambda'}, [('time', -1)], None),
+        ('sync last new export', LOG_COLLECTION, {'export_start': since, 'export_type': 'NEW', 'response_code': 200}, [('time', -1)], None),
+        ('sync callback by export_id', CALLBACK_COLLECTION, {'record_type': 'bib', 'record_id': 1, 'nonce.export_id': 'x'}, [('time', -1)], None),
+        ('last export end', LOG_COLLECTION, {'source': 'dlx-dl-lambda', 'record_type': 'bib', 'export_end': {'$exists': 1}}, [('export_start', -1)], None),
+        ('PendingStatus last export', LOG_COLLECTION, {'source': 'dlx-dl-lambda', 'record_type': 'bib'}, [('time', -1)], None),
+        ('PendingStatus pending records', 'bibs', {'updated': {'$gt': since}}, [('updated', 1)], None),
+        ('get_records_by_date bibs', 'bibs', date_query(BibSet, since, fft_symbols=['X'], fft_uris=['X']), [('updated', -1)], collation),
+        ('get_records_by_date bibs in range', 'bibs', date_query(BibSet, since, now), [('updated', -1)], collation),
+        ('get_records_by_date auths', 'auths', date_query(AuthSet, since), [('updated', -1)], collation),
+        ('get_records_by_date new files', 'files', _new_files_query(since), None, None),
+        ('alert last updated bib', 'bibs', {}, [('updated', -1)], None),
+        ('alert last updated auth', 'auths', {}, [('updated', -1)], None),
+        ('alert last alert', 'dlx_dl_alert', {'collection': 'bibs'}, [('time', -1)], None),
+    ]
+
+def hot_aggregations() -> list[tuple]:
+    """The aggregations used by `get_records_by_date`, as (name, collection,
+    pipeline)"""
+
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+
+    return [
+        ('deleted_since bibs', 'bib_history', deleted_since_pipeline('bib', since, exclude_user='HZN')),
+        ('deleted_since auths', 'auth_history', deleted_since_pipeline('auth', since, exclude_user='HZN')),
+    ]
+
+def explain():
+    """Yields (name, winning plan) for each of the hot queries and
+    aggregations. Queries are explained with the collation they are run with"""
+
+    for name, col, query, sort, collation in hot_queries():
+        cursor = DB.handle[col].find(query, limit=1, collation=collation)
+        sort and cursor.sort(sort)
+        explained = cursor.explain()
+
+        yield name, explained.get('queryPlanner', {}).get('winningPlan', {})
+
+    for name, col, pipeline in hot_aggregations():
+        explained = DB.handle.command('aggregate', col, pipeline=pipeline, explain=True)
+        # the plan of the initial $match is in the $cursor stage, unless the whole pipeline is pushed down to the query engine
+        planner = explained.get('queryPlanner') or next((x['$cursor']['queryPlanner'] for x in explained.get('stages', []) if '$cursor' in x), {})
+
+        yield name, planner.get('winningPlan', {})
+
+def collscans(plan: dict) -> list[dict]:
+    """Returns the COLLSCAN stages in the plan"""
+
+    found = [plan] if plan.get('stage') == 'COLLSCAN' else []
+
+    # the classic and slot based engines nest stages differently
+    for child in [plan.get('inputStage'), plan.get('queryPlan')] + plan.get('inputStages', []):
+        if isinstance(child, dict):
+            found += collscans(child)
+
+    return found
+
+###
+
+if __name__ == '__main__':
+    run()
@@ -5,6 +5,7 @@ from time import sleep
 from dlx import DB
 from dlx.marc import Auth
 from dlx_dl.scripts import sync
+from dlx_dl.export_queue import queued
 
 ap = ArgumentParser('dlx-dl-retro')
 ap.add_argument('connect')
@@ -47,7 +48,7 @@ def run() -> None:
         DB.connect(args.connect, database=args.database)
 
         # don't run if there are records in the dlx-dl queue
-        while DB.handle['dlx_dl_queue'].find_one({}):
+        while queued():
             print('waiting for queue to clear...')
             sleep(600)
 
@@ -61,7 +62,9 @@ def run() -> None:
                 type=args.type, 
                 query=query,
                 time_limit=0,
-                limit=increment
+                limit=increment,
+                # skip records that haven't changed since the last pass
+                use_fingerprints=True
             )
         except Exception as e:
             traceback.print_exc()
@@ -0,0 +1,133 @@
+import os, socket, threading, traceback, multiprocessing
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from time import sleep
+from warnings import warn
+from dlx import DB
+from dlx_dl.scripts import sync, export
+from dlx_dl.scripts.retro import get_wait_time
+from dlx_dl.shards import ShardLeases, LEASE_TIME, id_shards, date_shards
+from dlx_dl.util import FileIndex
+
+POLL = 60 # seconds between checks for a shard to claim, while other workers' shards are running
+
+ap = ArgumentParser('dlx-dl-shard')
+ap.add_argument('connect')
+ap.add_argument('database')
+ap.add_argument('type', choices=['bib', 'auth'])
+ap.add_argument('job', help='name of the job. running the same job again resumes it')
+ap.add_argument('--ids', nargs=2, type=int, metavar=('START', 'END'), help='shard the record IDs from START to END')
+ap.add_argument('--shard_size', type=int, default=1000, help='number of record IDs per shard')
+ap.add_argument('--modified_from', help='ISO datetime. shard the records updated from this time to --modified_to')
+ap.add_argument('--modified_to', help='ISO datetime')
+ap.add_argument('--window', type=int, default=86400, help='seconds of updates per shard')
+ap.add_argument('--workers', type=int, default=4, help='number of worker processes')
+ap.add_argument('--lease_time', type=int, default=LEASE_TIME, help='seconds before the shard of a worker that has stopped is reclaimed')
+ap.add_argument('--source', default='dlx-dl-shard', help='each worker logs as this with its number appended')
+ap.add_argument('--force', action='store_true', help='skip the sync preflight check')
+
+def run() -> None:
+    args = ap.parse_args()
+
+    DB.connect(args.connect, database=args.database)
+    leases = ShardLeases(job=args.job, lease_time=args.lease_time)
+
+    if args.ids:
+        shards = id_shards(*args.ids, args.shard_size)
+    elif args.modified_from and args.modified_to:
+        shards = date_shards(datetime.fromisoformat(args.modified_from), datetime.fromisoformat(args.modified_to), timedelta(seconds=args.window))
+    elif args.modified_from or args.modified_to:
+        raise Exception('--modified_from and --modified_to are required together')
+    else:
+        shards = []
+
+    print(f'{leases.create(shards)} shards added to job "{args.job}"')
+
+    if not leases.unfinished():
+        print(f'nothing to do: {leases.progress()}')
+        return
+
+    # refreshed once here, instead of by each worker at the same time
+    FileIndex.current()
+
+    # separate interpreters, so that each worker has its own DB connection and API client
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=work, args=(args.connect, args.database, args.type, args.job, f'{args.source}-{i}', args.force, args.lease_time)) for i in range(args.workers)]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    print(f'done: {leases.progress()}')
+
+def work(connect: str, database: str, type: str, job: str, source: str, force: bool, lease_time: int = LEASE_TIME) -> None:
+    """Claims and syncs shards of the job until none are left. The worker
+    logs its exports as `source`, so that the sync preflight check only waits
+    for this worker's last export. API requests are rate limited together with
+    the other workers by `sync`. The file index is used as it was refreshed by
+    `run`, so that the workers don't refresh it at the same time"""
+
+    DB.connect(connect, database=database)
+    leases = ShardLeases(job=job, lease_time=lease_time)
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    last_updated_count = None
+
+    while 1:
+        shard = leases.claim(worker)
+
+        if shard is None:
+            if leases.unfinished():
+                # pending shards that are waiting, or shards being worked on that may be given up
+                sleep(POLL)
+                continue
+
+            return
+
+        print(f'{worker} running shard {shard["number"]}: {shard["criteria"]}')
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=renew, args=(leases, shard, worker, stop), daemon=True)
+        heartbeat.start()
+
+        try:
+            kwargs = dict(shard['criteria'], connect=connect, db=database, source=source, type=type, time_limit=0, limit=0, use_fingerprints=True, no_file_index_refresh=True)
+
+            if force or not DB.handle[export.LOG_COLLECTION].find_one({'source': source}, projection={'_id': 1}):
+                # the preflight check needs an export by this source
+                kwargs['force'] = True
+
+            updated_count = sync.run(**kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            # stop renewing the claim before giving it up. the shard can be claimed again in one minute
+            stop.set()
+            heartbeat.join()
+            leases.release(shard, worker, error=repr(e), delay=60)
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if updated_count == -1:
+            # the run was aborted while DL catches up with this worker's last export. other workers can take the shard meanwhile
+            leases.release(shard, worker)
+            sleep(get_wait_time(updated_count, last_updated_count))
+        else:
+            if updated_count > 0:
+                last_updated_count = updated_count
+
+            if not leases.complete(shard, worker, {'updated': updated_count}):
+                warn(f'The claim on shard {shard["number"]} expired before it was completed')
+
+def renew(leases: ShardLeases, shard: dict, worker: str, stop: threading.Event) -> None:
+    # keeps the claim while the shard is being synced
+    while not stop.wait(leases.lease_time / 3):
+        if not leases.renew(shard, worker):
+            warn(f'Lost the claim on shard {shard["number"]}')
+            return
+
+###
+
+if __name__ == '__main__':
+    run()
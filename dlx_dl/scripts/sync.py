@@ -1,31 +1,48 @@
 """Sync DL from DLX"""
 
-import sys, os, re, json, time, argparse, unicodedata, requests, pytz, uuid
+import sys, os, re, json, time, argparse, unicodedata, pytz, uuid
 from collections import Counter
 from copy import deepcopy
-from itertools import chain
+from itertools import chain, islice
 from warnings import warn
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse, quote, unquote
-from boto3 import client as botoclient
 from botocore.exceptions import ClientError, NoCredentialsError
 from math import inf
 from io import StringIO
 from xml.etree import ElementTree
 from mongomock import MongoClient as MockClient
-from pymongo import UpdateOne, DeleteOne
 from bson import SON, Regex
 from dlx import DB, Config
 from dlx.marc import Query, Bib, BibSet, Auth, AuthSet
 from dlx.file import File, Identifier
 from dlx.util import Tokenizer
 from dlx_dl.scripts import export
+from dlx_dl.util import FileResolver, FileIndex, FILE_LANGUAGES, compress_log_entry, log_xml, deleted_since
+from dlx_dl.export_queue import ExportQueue
+from dlx_dl.dispatch import Dispatcher
+from dlx_dl.buffer import BulkBuffer
+from dlx_dl.profiling import profiled
+from dlx_dl.metrics import Metrics
+from dlx_dl.mirror import DLMirror
+from dlx_dl.pipeline import Pipeline
+from dlx_dl.batching import AdaptiveBatchSize
+from dlx_dl.ratelimit import RateLimiter
+from dlx_dl.diff import diff_fields
+from dlx_dl.fingerprint import Fingerprints
+from dlx_dl.xrefs import XrefPrefetcher
+from dlx_dl.search import SearchResults
+from dlx_dl.parameters import resolve
+from dlx_dl import client
 
 API_SEARCH_URL = 'https://digitallibrary.un.org/api/v1/search'
 API_RECORD_URL = 'https://digitallibrary.un.org/api/v1/record/'
 NS = '{http://www.loc.gov/MARC21/slim}'
 LOG_COLLECTION = export.LOG_COLLECTION
 LANGMAP = {'AR': 'العربية', 'ZH': '中文', 'EN': 'English', 'FR': 'Français', 'RU': 'Русский', 'ES': 'Español', 'T': 'test'}
+SKIP_FIELDS = ['035', '909', '949', '998'] # not compared
+CHECK_FIELDS = '001,005,035,980,998' # fetched in the first phase of --two_phase
+CREDENTIALS = {'connect': 'prodISSU-admin-connect-string', 'api_key': 'undl-dhl-metadata-api-key', 'callback_url': 'undl-callback-url', 'nonce_key': 'undl-callback-nonce'} # arg -> SSM parameter
 LANGMAP_REVERSE = {Tokenizer.scrub(v).replace(' ', ''): k for k, v in LANGMAP.items()}
 
 def get_args(**kwargs):
@@ -38,8 +55,18 @@ def get_args(**kwargs):
     parser.add_argument('--time_limit', help='runtime limit in seconds', type=int, default=600)
     parser.add_argument('--queue', action='store_true', help='try to export records in queue and add to queue if export exceeds limits')
     parser.add_argument('--delete_only', action='store_true')
-    parser.add_argument('--use_auth_cache', action='store_true')
+    parser.add_argument('--use_auth_cache', action='store_true', help='deprecated. the auths referenced by each batch are prefetched')
+    parser.add_argument('--auth_cache_size', type=int, default=100000, help='max number of auth headings to keep cached across batches')
+    parser.add_argument('--use_mirror', action='store_true', help='take DL records from the local mirror instead of the search API if they are current')
+    parser.add_argument('--use_fingerprints', action='store_true', help='skip records that have not changed since they were last found to be in sync with DL')
     parser.add_argument('--missing_only', action='store_true')
+    parser.add_argument('--two_phase', action='store_true', help='fetch only 001, 005, 035, 980 and 998 from DL first, and the full records only for those that may be out of date')
+    parser.add_argument('--concurrency', type=int, default=1, help='max number of API submissions in flight')
+    parser.add_argument('--batch_size', type=int, default=100, help='number of records to search for in DL per request to start with. adjusted during the run')
+    parser.add_argument('--max_batch_size', type=int, default=500)
+    parser.add_argument('--prefetch', type=int, default=0, help='number of batches to fetch from DL ahead of the batch being compared (0 to run in sequence)')
+    parser.add_argument('--no_file_index_refresh', action='store_true', help='use the file index without refreshing it first, e.g. when it was refreshed by the process that started this one')
+    parser.add_argument('--profile', nargs='?', const='STDERR', help='write a profile of the run to this file, or STDERR if no file is given')
 
     r = parser.add_argument_group('required')
     r.add_argument('--source', required=True, help='an identity to use in the log')
@@ -57,25 +84,12 @@ def get_args(**kwargs):
     qm.add_argument('--query', help='JSON MongoDB query')
     qm.add_argument('--querystring', help='dlx querystring syntax')
 
-    # get from AWS if not provided
-    ssm = botoclient('ssm', region_name='us-east-1')
-
-    def param(name):
-        try:
-            return ssm.get_parameter(Name=name)['Parameter']['Value']
-        except NoCredentialsError:
-            warn('in mock environment')
-            return 'mocked'
-        except ClientError:
-            warn('valid AWS credentials not found or unable to connect')
-            return None
-
     c = parser.add_argument_group('credentials', description='these arguments are automatically supplied by AWS SSM if AWS credentials are configured')
-    c.add_argument('--connect', default=param('prodISSU-admin-connect-string'), help='MongoDB connection string')
+    c.add_argument('--connect', help='MongoDB connection string')
     c.add_argument('--db', default='undlFiles')
-    c.add_argument('--api_key', help='UNDL-issued api key', default=param('undl-dhl-metadata-api-key'))
-    c.add_argument('--callback_url', help="A URL that can receive the results of a submitted task.", default=param('undl-callback-url'))
-    c.add_argument('--nonce_key', help='A validation key that will be passed to and from the UNDL API.', default=param('undl-callback-nonce'))
+    c.add_argument('--api_key', help='UNDL-issued api key')
+    c.add_argument('--callback_url', help="A URL that can receive the results of a submitted task.")
+    c.add_argument('--nonce_key', help='A validation key that will be passed to and from the UNDL API.')
     
     # if run as function convert args to sys.argv so they can be parsed by ArgumentParser
     if kwargs:
@@ -91,7 +105,21 @@ def get_args(**kwargs):
             else:
                 sys.argv.append(f'--{key}={val}')
      
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    # get from AWS if not provided
+    try:
+        resolve(args, CREDENTIALS)
+    except NoCredentialsError:
+        warn('in mock environment')
+
+        for attr in CREDENTIALS:
+            if getattr(args, attr) is None:
+                setattr(args, attr, 'mocked')
+    except ClientError:
+        warn('valid AWS credentials not found or unable to connect')
+
+    return args
 
 def run(**kwargs) -> int:
     """
@@ -101,280 +129,424 @@ def run(**kwargs) -> int:
     """
 
     args = get_args(**kwargs)
+    args.metrics = Metrics(dimensions={'Script': 'sync', 'Source': args.source, 'RecordType': args.type})
 
-    if isinstance(kwargs.get('connect'), MockClient):
-        # required for testing 
-        DB.client = kwargs['connect']
-    else:
-        DB.connect(args.connect, database=args.db)
-
-    args.START = datetime.now(timezone.utc)
-    blacklist = DB.handle[export.BLACKLIST_COLLECTION]
-    args.blacklisted = [x['symbol'] for x in blacklist.find({})]
+    with profiled(args.profile):
+        if isinstance(kwargs.get('connect'), MockClient):
+            # required for testing 
+            DB.client = kwargs['connect']
+        else:
+            DB.connect(args.connect, database=args.db)
+
+        args.START = datetime.now(timezone.utc)
+        blacklist = DB.handle[export.BLACKLIST_COLLECTION]
+        args.blacklisted = [x['symbol'] for x in blacklist.find({})]
+        args.file_index = FileIndex.current(refresh=not args.no_file_index_refresh)
+        args.mirror = DLMirror(type=args.type)
+        args.fingerprints = Fingerprints(type=args.type) if args.use_fingerprints else None
+        args.fingerprinted = {} # record ID -> fingerprint, for records being compared or exported
+        args.dispatcher = Dispatcher(args.concurrency)
+        args.buffer = BulkBuffer()
+        # the xrefs in each batch are resolved in one query, into a cache that is kept across batches
+        args.xrefs = XrefPrefetcher(max_size=args.auth_cache_size)
+        # API requests are rate limited together with the other dlx-dl processes
+        client.set_limiter(RateLimiter())
 
+        try:
+            return _run(args)
+        finally:
+            # wait for the submissions in flight, then write their log entries
+            try:
+                args.dispatcher.close()
+            finally:
+                client.set_limiter(None)
+                args.xrefs.restore()
+                args.buffer.flush()
+                args.metrics.emit()
+
+def _run(args) -> int:
+    queue = ExportQueue(type=args.type, source=args.source, buffer=args.buffer)
+
+    try:
+        return _sync(args, queue)
+    finally:
+        # leased items that were not processed, including when the run is aborted
+        queue.release()
+
+def _sync(args, queue: ExportQueue) -> int:
     HEADERS = {'Authorization': 'Token ' + args.api_key}
-    marcset, deleted = get_records(args) # returns an interator  (dlx.Marc.BibSet/AuthSet)
+
+    with args.metrics.stage('GetRecords'):
+        marcset, deleted = get_records(args, DB.handle[LOG_COLLECTION], queue) # returns an interator  (dlx.Marc.BibSet/AuthSet)
+
     TOTAL = marcset.count + len(deleted)
     #deleted = get_deleted_records(args)
-    BATCH = []
-    BATCH_SIZE = 100
-    SEEN = 0
     UPDATED_COUNT = 0
     print(f'Checking {marcset.count} records')
 
     # check if last update cleared in DL yet
-    if args.force:
-        pass
-    else:
-        to_check = 50
-        last_n = list(DB.handle[export.LOG_COLLECTION].find({'source': args.source}, sort=[('time', -1)], limit=to_check)) or []
+    with args.metrics.stage('Preflight'):
+        if args.force:
+            pass
+        else:
+            to_check = 50
+            # the payloads are only needed for the entry that is checked
+            last_n = list(DB.handle[export.LOG_COLLECTION].find({'source': args.source}, projection={'xml': 0, 'response_text': 0}, sort=[('time', -1)], limit=to_check)) or []
 
-        if not last_n:
-            raise Exception('No log data found for this source. Run with --force to skip this check')
+            if not last_n:
+                raise Exception('No log data found for this source. Run with --force to skip this check')
 
-        last_exported = next(filter(lambda x: x.get('response_code') == 200, last_n))
+            last_exported = next(filter(lambda x: x.get('response_code') == 200, last_n))
 
-        if not last_exported:
-            raise Exception(f'The last {to_check - len(last_n)} exports have been rejected by the DL subission API. Check data and API status')
+            if not last_exported:
+                raise Exception(f'The last {to_check - len(last_n)} exports have been rejected by the DL subission API. Check data and API status')
 
-        # check if any record in the last export were new records
-        last_export_start = last_n[0]['export_start']
+            # check if any record in the last export were new records
+            last_export_start = last_n[0]['export_start']
         
-        if last_new := DB.handle[export.LOG_COLLECTION].find_one({'export_start': last_export_start, 'export_type': 'NEW', 'response_code': 200}, sort=[('time', -1)]):
-            last_exported = last_new
-
-        # use DL search API to find the record in DL
-        pre = '035__a:(DHL)' if last_exported['record_type'] == 'bib' else '035__a:(DHLAUTH)'
-        url = f'{API_SEARCH_URL}?search_id=&p={pre}{last_exported["record_id"]}&format=xml'
+            if last_new := DB.handle[export.LOG_COLLECTION].find_one({'export_start': last_export_start, 'export_type': 'NEW', 'response_code': 200}, sort=[('time', -1)]):
+                last_exported = last_new
+            else:
+                last_exported = DB.handle[export.LOG_COLLECTION].find_one({'_id': last_exported['_id']})
 
-        if last_exported['record_type'] == 'auth':
-            url += '&c=Authorities'
+            # use DL search API to find the record in DL
+            pre = '035__a:(DHL)' if last_exported['record_type'] == 'bib' else '035__a:(DHLAUTH)'
+            url = f'{API_SEARCH_URL}?search_id=&p={pre}{last_exported["record_id"]}&format=xml'
 
-        if response := requests.get(url, headers=HEADERS):
-            try:
-                root = ElementTree.fromstring(response.text)
-            except:
-                print(f'Bad UNDL XML?\n{response.text}')
-                response_text = "".join(re.split(r"(^\s+|\s+$)", response.text))
-                raise Exception(f'Invalid XML?\n{response_text}')
+            if last_exported['record_type'] == 'auth':
+                url += '&c=Authorities'
 
-            col = root.find(f'{NS}collection')
-            record_xml = col.find(f'{NS}record')
-        else:
-            raise Exception('API request failed')
+            if response := client.get(url, headers=HEADERS, stream=True):
+                try:
+                    record_xml = SearchResults(response).first()
+                except ElementTree.ParseError as e:
+                    print(f'Bad UNDL XML? {e}')
+                    raise Exception(f'Invalid XML?\n{e}')
+            else:
+                raise Exception('API request failed')
 
-        # check if the record has been updated in DL yet
-        flag = None 
+            # check if the record has been updated in DL yet
+            flag = None 
         
-        try:
-            last = Bib.from_xml(last_exported['xml'], auth_control=False)
-        except:
-            print(f'Bad XML in log data?\n{last_exported}')
-            raise Exception(f'Invalid XML?')
-                            
-        if 'DELETED' in (last.get_value('980', 'a'), last.get_value('980', 'c')):
             try:
-                last_dl_record = Bib.from_xml_raw(record_xml, auth_control=False)
+                last = Bib.from_xml(log_xml(last_exported), auth_control=False)
+            except:
+                print(f'Bad XML in log data?\n{last_exported}')
+                raise Exception(f'Invalid XML?')
+                            
+            if 'DELETED' in (last.get_value('980', 'a'), last.get_value('980', 'c')):
+                try:
+                    last_dl_record = Bib.from_xml_raw(record_xml, auth_control=False)
                 
-                # the record is hasn't been purged from DL yet
-                if 'DELETED' not in (last_dl_record.get_value('980', 'a'), last_dl_record.get_value('980', 'c')):
-                    flag = 'DELETE'
-            except AssertionError:
-                # the record doesnt exist, presumably already purged
-                pass
-        else:
-            try:
-                last_dl_record = Bib.from_xml_raw(record_xml, auth_control=False)
-            except AssertionError as e:
-                if status := last_exported.get('export_type') == 'NEW':
-                    # last record not in DL yet
-                    flag = 'NEW'
-                    last_dl_record = None
-                elif status == None:
-                    # record was probably exported by dlx-dl-export
+                    # the record is hasn't been purged from DL yet
+                    if 'DELETED' not in (last_dl_record.get_value('980', 'a'), last_dl_record.get_value('980', 'c')):
+                        flag = 'DELETE'
+                except AssertionError:
+                    # the record doesnt exist, presumably already purged
                     pass
-                else:
-                    raise Exception(f'Last updated record not found by DL search API: {last_exported["record_type"]} {last_exported["record_id"]}')
-            
-            if last_dl_record:
-                # DL record last updated time is in 005
-                dl_last_updated = str(int(float(last_dl_record.get_value('005'))))
-                dl_last_updated = datetime.strptime(dl_last_updated, '%Y%m%d%H%M%S')
-                # 005 is in local time
-                dl_last_updated += timedelta(hours=4 if pytz.timezone('US/Eastern').localize(dl_last_updated).dst() else 5)
-
-                if last_exported['time'] > dl_last_updated:
-                    flag = 'UPDATE'
-        
-        if flag:
-            # check callback log to see if the last export had an import error in DL
-            q = {'record_type': last_exported['record_type'], 'record_id': last_exported['record_id']}
-
-            if export_id := last_exported.get('export_id'):
-                q['nonce.export_id'] = export_id
             else:
-                # todo: get rid of this when possible to transition to using only export_id
-                q['nonce.export_start'] = Regex('^' + str(last_export_start)[:19]) # time strings might not match at microsecond level for some reason
+                try:
+                    last_dl_record = Bib.from_xml_raw(record_xml, auth_control=False)
+                except AssertionError as e:
+                    if status := last_exported.get('export_type') == 'NEW':
+                        # last record not in DL yet
+                        flag = 'NEW'
+                        last_dl_record = None
+                    elif status == None:
+                        # record was probably exported by dlx-dl-export
+                        pass
+                    else:
+                        raise Exception(f'Last updated record not found by DL search API: {last_exported["record_type"]} {last_exported["record_id"]}')
+            
+                if last_dl_record:
+                    # DL record last updated time is in 005
+                    dl_last_updated = dl_005_utc(last_dl_record.get_value('005'))
 
-            callback_data = DB.handle[export.CALLBACK_COLLECTION].find_one(q, sort=[('time', -1)])
+                    if last_exported['time'] > dl_last_updated:
+                        flag = 'UPDATE'
+        
+            if flag:
+                # check callback log to see if the last export had an import error in DL
+                q = {'record_type': last_exported['record_type'], 'record_id': last_exported['record_id']}
 
-            if callback_data:
-                if callback_data['results'][0]['success'] == False:
-                    # the last export was exported succesfully, but failed on import to DL. proceed with export
-                    print(f'There was an error in DL processing the last {flag} record. Proceeding.')
-                    pass
-                elif flag == 'NEW':
-                    # the record has been imported to DL but isn't searchable yet
-                    print(f'Awaiting search indexing of last new record: {last_exported["record_type"]}# {last_exported["record_id"]}. Callback received indicating sucessful import @ {callback_data["time"]}.')
-                    return -1
+                if export_id := last_exported.get('export_id'):
+                    q['nonce.export_id'] = export_id
                 else:
-                    # the record was exported and imported to DL succesfully, but DL did not record the update in
-                    # the 005 field. this can happen if there were no changes to be made to the DL record.
-                    warn(f'Possible redundant export not recorded in DL: {flag} {last_exported["record_type"]}# {last_exported["record_id"]}')
-            else:
-                print(f'Last update not cleared in DL yet ({flag}) ({last_exported["record_type"]}# {last_exported["record_id"]} @ {last_exported["time"]})')
-                return -1
+                    # todo: get rid of this when possible to transition to using only export_id
+                    q['nonce.export_start'] = Regex('^' + str(last_export_start)[:19]) # time strings might not match at microsecond level for some reason
+
+                callback_data = DB.handle[export.CALLBACK_COLLECTION].find_one(q, sort=[('time', -1)])
+
+                if callback_data:
+                    if callback_data['results'][0]['success'] == False:
+                        # the last export was exported succesfully, but failed on import to DL. proceed with export
+                        print(f'There was an error in DL processing the last {flag} record. Proceeding.')
+                        pass
+                    elif flag == 'NEW':
+                        # the record has been imported to DL but isn't searchable yet
+                        print(f'Awaiting search indexing of last new record: {last_exported["record_type"]}# {last_exported["record_id"]}. Callback received indicating sucessful import @ {callback_data["time"]}.')
+                        return -1
+                    else:
+                        # the record was exported and imported to DL succesfully, but DL did not record the update in
+                        # the 005 field. this can happen if there were no changes to be made to the DL record.
+                        warn(f'Possible redundant export not recorded in DL: {flag} {last_exported["record_type"]}# {last_exported["record_id"]}')
+                else:
+                    print(f'Last update not cleared in DL yet ({flag}) ({last_exported["record_type"]}# {last_exported["record_id"]} @ {last_exported["time"]})')
+                    return -1
 
     # cycle through records in batches 
     enqueue, to_remove = False, []
 
-    if args.use_auth_cache:
-        print('building auth cache...')
-        Auth.build_cache()
-    
-    for i, record in enumerate(chain(marcset.records, (d for d in deleted))):
-        if record.user is None:
-            record.user = 'system'
+    pending = [] # records taken from the cursor that are not in a batch yet
+    # the batch size adapts to the search API's responses
+    size = min(args.batch_size, args.max_batch_size)
+    batch_size = AdaptiveBatchSize(size, minimum=min(10, size), maximum=args.max_batch_size)
+    pre = '035__a:(DHL)' if args.type == 'bib' else '035__a:(DHLAUTH)'
 
-        if record.user[:10] == 'batch_edit':
-            # skip syncing batch edited records for now so as not to overwhelm DL queue
-            continue
+    def search_url(ids, search_id='', fields=None):
+        url = f'{API_SEARCH_URL}?search_id={search_id}&p={" OR ".join([f"{pre}{x}" for x in ids])}&format=xml'
 
-        BATCH.append(record)
-        SEEN = i + 1
-        
-        # process DL batch
-        if len(BATCH) in (BATCH_SIZE, TOTAL) or SEEN == TOTAL:
-            DL_BATCH = []
-
-            # get DL records using DL search API
-            pre = '035__a:(DHL)' if args.type == 'bib' else '035__a:(DHLAUTH)'
-            terms = ' OR '.join([f'{pre}{r.id}' for r in BATCH])
-            url = f'{API_SEARCH_URL}?search_id=&p={terms}&format=xml' #'&ot=035,998'
-            
-            if args.type == 'auth':
-                url += '&c=Authorities'
-                
-            response = requests.get(url, headers=HEADERS)
-            retries = 0
-            
-            while response.status_code != 200:
-                print(f'retrying: {url}\n{response.text}')  
-                      
-                if retries > 5: 
-                    raise Exception(f'search API error: {response.text}')
-                
-                if 'Max 100 requests per 5 minutes' in json.loads(response.text).get('error'):
-                    print('API rate limit exceeded. waiting 5 minutes')
-                    time.sleep(310)
-                else:
-                    time.sleep((retries if retries else 1) * 5)
-                
-                retries += 1
-                response = requests.get(url, headers=HEADERS)
-            
-            root = ElementTree.fromstring(response.text)
-            #search_id = root.find('search_id').text
-            col = root.find(f'{NS}collection')
-        
-            # process DL XML
-            for r in col or []:
-                dl_record = Bib.from_xml_raw(r, auth_control=False, delete_subfield_zero=False) # doesn't matter if Bib or Auth
-                _035 = next(filter(lambda x: re.match(r'^\(DHL', x), dl_record.get_values('035', 'a')), '')
-
-                if match := re.match(r'^\((DHL|DHLAUTH)\)(.*)', _035):
-                    dl_record.id = int(match.group(2))
-                    DL_BATCH.append(dl_record)
-
-            # record not in DL
-            for dlx_record in BATCH:
-                if dlx_record.get_value('245', 'a')[0:16].lower() == 'work in progress':
-                    continue
+        if fields:
+            # only these fields
+            url += f'&ot={fields}'
+
+        if args.type == 'auth':
+            url += '&c=Authorities'
+
+        return url
+
+    def search_records(ids, fields=None, *, adapt=True):
+        # the DL records for the IDs, following the pages of results. the records are parsed as they are downloaded
+        url = search_url(ids, fields=fields)
+        seen = 0
+
+        while ids:
+            start = time.perf_counter()
+
+            # retries and rate limit waits are handled by the client
+            with args.metrics.stage('Search'), args.metrics.timed('SearchLatency'):
+                response = client.get(url, headers=HEADERS, stream=True)
+
+            args.metrics.count('SearchRequests')
+
+            if response.status_code != 200:
+                batch_size.record(seconds=time.perf_counter() - start, nbytes=len(response.content), retried=getattr(response, 'retried', []), ok=False)
+
+                raise Exception(f'search API error: {response.text}')
+
+            results = SearchResults(response)
+
+            with args.metrics.stage('Parse'):
+                for r in results:
+                    dl_record = Bib.from_xml_raw(r, auth_control=False, delete_subfield_zero=False) # doesn't matter if Bib or Auth
+                    _035 = next(filter(lambda x: re.match(r'^\(DHL', x), dl_record.get_values('035', 'a')), '')
+
+                    if match := re.match(r'^\((DHL|DHLAUTH)\)(.*)', _035):
+                        dl_record.id = int(match.group(2))
+
+                        yield dl_record, r
+
+            if adapt:
+                # the batch size follows the requests that the whole batch is searched with
+                batch_size.record(seconds=time.perf_counter() - start, nbytes=results.nbytes, retried=getattr(response, 'retried', []))
+
+            seen += results.count
+
+            if results.count == 0 or seen >= (results.total or 0):
+                break
+            elif seen == results.count and adapt:
+                # bigger batches than the page size don't save requests
+                batch_size.cap(results.count)
+
+            url = search_url([], search_id=results.search_id or '', fields=fields)
+
+    def batches():
+        # the first TOTAL records; `marcset.records` may already include the deleted records
+        seens = []
+        url_length = len(search_url([], fields=CHECK_FIELDS if args.two_phase else None))
+
+        for i, record in enumerate(islice(chain(marcset.records, deleted), TOTAL)):
+            if record.user is None:
+                record.user = 'system'
+
+            if record.user[:10] == 'batch_edit':
+                # skip syncing batch edited records for now so as not to overwhelm DL queue
+                args.metrics.count('RecordsSkipped')
+                continue
+
+            pending.append(record)
+            seens.append(i + 1)
+            args.metrics.count('RecordsScanned')
+            # as sent, with spaces encoded
+            url_length += len(quote(f'{pre}{record.id} OR ', safe='():'))
+
+            if batch_size.full(len(pending), url_length):
+                batch = (pending[:], seens)
+                pending.clear()
+                seens = []
+                url_length = len(search_url([], fields=CHECK_FIELDS if args.two_phase else None))
+
+                yield batch
+
+        if pending:
+            batch = (pending[:], seens)
+            pending.clear()
+
+            yield batch
+
+    def prepare(batch):
+        BATCH, seens = batch
+        # auth headings and latest files for the whole batch
+        args.metrics.count('AuthsPrefetched', args.xrefs.prefetch(BATCH))
+        files = FileResolver(BATCH, index=args.file_index) if args.type == 'bib' else None
+        unchanged = set()
+
+        if args.fingerprints:
+            # records that haven't changed since they were last in sync
+            fingerprints = {r.id: record_fingerprint(r, files) for r in BATCH}
+            unchanged = args.fingerprints.unchanged(fingerprints)
+            args.fingerprinted.update({k: v for k, v in fingerprints.items() if k not in unchanged})
+            args.metrics.count('FingerprintHits', len(unchanged))
+
+        to_compare = [r for r in BATCH if r.id not in unchanged]
+        # DL records that haven't changed since they were last fetched
+        cached = args.mirror.get(to_compare) if args.use_mirror else {}
+        to_fetch = [r for r in to_compare if r.id not in cached]
+        args.metrics.count('MirrorHits', len(cached))
+
+        return BATCH, seens, files, unchanged, cached, to_fetch
+
+    def search(prepared):
+        BATCH, seens, files, unchanged, cached, to_fetch = prepared
+        DL_BATCH = list(cached.values())
+
+        if args.two_phase and to_fetch:
+            # the records that are in DL and up to date by their 005 and 998 don't need to be fetched in full
+            checked = {dl_record.id: dl_record for dl_record, _ in search_records([r.id for r in to_fetch], CHECK_FIELDS)}
+            stale = [r for r in to_fetch if r.id in checked and is_stale(r, checked[r.id], files)]
+            up_to_date = {r.id for r in to_fetch if r.id in checked} - {r.id for r in stale}
+            unchanged = unchanged | up_to_date
+            args.metrics.count('CheckHits', len(up_to_date))
+            # the records not in DL don't need to be fetched either
+            to_fetch = stale
+
+        fetched = []
+
+        for dl_record, r in search_records([r.id for r in to_fetch], adapt=not args.two_phase):
+            DL_BATCH.append(dl_record)
+            # serialized before the element is cleared
+            fetched.append((dl_record.id, ElementTree.tostring(r)))
+
+        args.mirror.put(fetched)
+
+        return BATCH, seens, DL_BATCH, files, unchanged
+
+    def status(SEEN):
+        print('\b' * (len(str(SEEN)) + 4 + len(str(TOTAL))) + f'{SEEN} / {TOTAL} ', end='', flush=True)
+
+    # with --prefetch, the cursor is drained and the next batches are searched and parsed in
+    # other threads while the current batch is compared
+    pipeline = Pipeline(batches(), prepare, search, depth=args.prefetch)
+
+    try:
+        for BATCH, seens, DL_BATCH, files, unchanged in pipeline:
+            for SEEN in seens[:-1]:
+                status(SEEN)
+
+            with args.metrics.stage('Compare'):
+                # the DL records by ID, in order
+                dl_by_id = {}
+
+                for dl_record in DL_BATCH:
+                    dl_by_id.setdefault(dl_record.id, []).append(dl_record)
+
+                # record not in DL
+                for dlx_record in BATCH:
+                    if dlx_record.id in unchanged:
+                        # in sync with DL since it was last compared or exported
+                        to_remove.append(dlx_record.id)
+                        continue
+
+                    if dlx_record.get_value('245', 'a')[0:16].lower() == 'work in progress':
+                        continue
                 
-                if dlx_record.get_value('980', 'a') == 'DELETED':
-                    if dl_record := next(filter(lambda x: x.id == dlx_record.id, DL_BATCH), None):
-                        if dl_record.get_value('980', 'a') != 'DELETED':
-                            print(f'{dlx_record.id}: RECORD DELETED')
-                            export_whole_record(args, dlx_record, export_type='DELETE')
-                            UPDATED_COUNT += 1
+                    if dlx_record.get_value('980', 'a') == 'DELETED':
+                        if dl_record := next(iter(dl_by_id.get(dlx_record.id, [])), None):
+                            if dl_record.get_value('980', 'a') != 'DELETED':
+                                print(f'{dlx_record.id}: RECORD DELETED')
+                                export_whole_record(args, dlx_record, export_type='DELETE', files=files)
+                                args.metrics.count('DecisionDelete')
+                                UPDATED_COUNT += 1
                         
-                        # remove record from list of DL records to compare
-                        DL_BATCH.remove(dl_record)
-                elif dlx_record.id not in [x.id for x in DL_BATCH]:
-                    print(f'{dlx_record.id}: NOT FOUND IN DL')
-                    export_whole_record(args, dlx_record, export_type='NEW')
-                    UPDATED_COUNT += 1
+                            # remove record from list of DL records to compare
+                            DL_BATCH.remove(dl_record)
+                            dl_by_id[dlx_record.id].remove(dl_record)
+                    elif not dl_by_id.get(dlx_record.id):
+                        print(f'{dlx_record.id}: NOT FOUND IN DL')
+                        export_whole_record(args, dlx_record, export_type='NEW', files=files)
+                        args.metrics.count('DecisionNew')
+                        UPDATED_COUNT += 1
                     
-                # remove from queue
-                to_remove.append(dlx_record.id)
+                    # remove from queue
+                    to_remove.append(dlx_record.id)
 
-            # end here if only adding missing records
-            if args.missing_only:
-                # clear batch
-                BATCH = []
-                continue
-            
-            # scan and compare DL records
-            for dl_record in DL_BATCH:
-                dlx_record = next(filter(lambda x: x.id == dl_record.id, BATCH), None)
+                # the first DLX record with each ID
+                dlx_by_id = {}
+
+                for dlx_record in BATCH:
+                    dlx_by_id.setdefault(dlx_record.id, dlx_record)
+
+                in_sync = [] # (record ID, fingerprint, DL 005, export ID)
+
+                # scan and compare DL records, unless only adding missing records
+                for dl_record in [] if args.missing_only else DL_BATCH:
+                    dlx_record = dlx_by_id.get(dl_record.id)
                 
-                if dlx_record is None:
-                    raise Exception(f'Error matching {dl_record.id} with dlx record. This shouldn\'t be possible. Possible network error.\n{dl_record.to_mrk()}')
+                    if dlx_record is None:
+                        raise Exception(f'Error matching {dl_record.id} with dlx record. This shouldn\'t be possible. Possible network error.\n{dl_record.to_mrk()}')
                 
-                # correct fields    
-                result = compare_and_update(args, dlx_record=dlx_record, dl_record=dl_record)
-                # remove from queue
-                to_remove.append(dlx_record.id)
-                    
-                if result:
-                    UPDATED_COUNT += 1
+                    # correct fields    
+                    result = compare_and_update(args, dlx_record=dlx_record, dl_record=dl_record, files=files)
+                    # remove from queue
+                    to_remove.append(dlx_record.id)
                     
-            # clear batch
-            BATCH = []
+                    if result:
+                        args.metrics.count('DecisionUpdate')
+                        UPDATED_COUNT += 1
+                    else:
+                        args.metrics.count('DecisionUnchanged')
+
+                        if fingerprint := args.fingerprinted.pop(dlx_record.id, None):
+                            in_sync.append((dlx_record.id, fingerprint, dl_record.get_value('005'), None))
+
+                if args.fingerprints:
+                    args.fingerprints.put(in_sync)
             
             # do the queue removals
-            DB.handle[export.QUEUE_COLLECTION].bulk_write([DeleteOne({'type': args.type, 'record_id': x}) for x in to_remove])
+            queue.ack(to_remove)
             to_remove = []
-            
-        # status
-        print('\b' * (len(str(SEEN)) + 4 + len(str(TOTAL))) + f'{SEEN} / {TOTAL} ', end='', flush=True)
-
-        # limits
-        if args.limit != 0 and UPDATED_COUNT >= args.limit:
-            print('\nReached max exports')
-            enqueue = True if args.queue else False
-            break
-        if args.time_limit and datetime.now(timezone.utc) > args.START + timedelta(seconds=args.time_limit):
-            print('\nTime limit exceeded')
-            enqueue = True if args.queue else False
-            break
-
-        # end
-        if SEEN == TOTAL:
-            break
+            status(seens[-1])
+
+            # limits
+            if args.limit != 0 and UPDATED_COUNT >= args.limit:
+                print('\nReached max exports')
+                enqueue = True if args.queue else False
+                break
+            if args.time_limit and datetime.now(timezone.utc) > args.START + timedelta(seconds=args.time_limit):
+                print('\nTime limit exceeded')
+                enqueue = True if args.queue else False
+                break
+    finally:
+        # batches taken from the cursor but not compared
+        leftover = [record for batch in pipeline.close() for record in batch[0]]
 
     if enqueue:
         print('Submitting remaining records to the queue... ', end='', flush=True)
-        updates = []
+        # the unprocessed records are left over in the cursor from the loop break
+        with args.metrics.stage('Enqueue'):
+            added = queue.enqueue(chain(leftover, pending, marcset))
 
-        for i, record in enumerate(marcset):
-            # records is a map object so the unprocessed records will be left over from the loop break
-            data = {'time': datetime.now(timezone.utc), 'source': args.source, 'type': args.type, 'record_id': record.id}
-            updates.append(UpdateOne({'source': args.source, 'type': args.type, 'record_id': record.id}, {'$setOnInsert': data}, upsert=True))
-
-        if updates:
-            result = DB.handle[export.QUEUE_COLLECTION].bulk_write(updates)
-            print(f'{result.upserted_count} added. {i + 1 - result.upserted_count} were already in the queue')
+        print(f'{added} added. The rest were already in the queue')
 
     print(f'Updated {UPDATED_COUNT} records')
 
@@ -397,36 +569,10 @@ def get_records_by_date(cls, date_from, date_to=None, delete_only=False):
         fft_symbols = None
 
     fft_uris = export._new_file_uris(date_from, date_to)
+    query = date_query(cls, date_from, date_to, fft_symbols=fft_symbols, fft_uris=fft_uris)
     
-    if date_to:
-        criteria = {'$and': [{'updated': {'$gte': date_from}}, {'updated': {'$lte': date_to}}]}
-        history_criteria = {'$and': [{'deleted.time': {'$gte': date_from}}, {'deleted.time': {'$lte': date_to}}, {'deleted.user': {'$ne': 'HZN'}}]}
-    else:
-        criteria = {'updated': {'$gte': date_from}}
-        history_criteria = {'deleted.time': {'$gte': date_from}, 'deleted.user': {'$ne': 'HZN'}}
-
-    if cls == BibSet:
-        if fft_symbols:
-            query = {
-                '$or': [
-                    criteria, 
-                    {'191.subfields.value': {'$in': fft_symbols}},
-                    {'561.subfields.value': {'$in': fft_uris}},
-                ]
-            }
-        else:
-            query = criteria
-    else:
-        query = criteria
-    
-    # records to delete
-    history = DB.handle['bib_history'] if cls == BibSet else DB.handle['auth_history']
-    # filter out records that have been restored since they were last deleted. it's easier
-    # to do that here than with MQL
-    deleted = [
-        x for x in history.find(history_criteria)
-            if x.get('restored', {}).get('time') or datetime(1970, 1, 1) < x['deleted']['time']
-    ]
+    # records to delete, not including records that have been restored since
+    deleted = deleted_since('bib' if cls == BibSet else 'auth', date_from, date_to, exclude_user='HZN')
                
     # sort to ensure latest updates are checked first
     if delete_only:
@@ -435,18 +581,9 @@ def get_records_by_date(cls, date_from, date_to=None, delete_only=False):
     else:
         rset = cls.from_query(query, sort=[('updated', -1)], collation=Config.marc_index_default_collation)
 
-    to_delete = []
-
-    if deleted:
-        rcls = Bib if cls == BibSet else Auth
-        
-        for d in deleted:
-            r = rcls({'_id': d['_id']})
-            r.set('980', 'a', 'DELETED')
-            r.updated = d['deleted']['time']
-            r.user = d['deleted']['user']
-            to_delete.append(r)
+    to_delete = deleted_records(cls, deleted)
 
+    if to_delete:
         rset.records = (r for r in chain((r for r in rset.records), (d for d in  to_delete))) # program is expecting an iterable
         
     print(f'Checking {len(to_delete)} deleted records')
@@ -455,6 +592,41 @@ def get_records_by_date(cls, date_from, date_to=None, delete_only=False):
   
     return [rset, to_delete]
 
+def date_query(cls, date_from, date_to=None, *, fft_symbols=None, fft_uris=None) -> dict:
+    """The query for the records updated in the time range, and for bibs, the
+    records with files updated in it"""
+
+    if date_to:
+        criteria = {'$and': [{'updated': {'$gte': date_from}}, {'updated': {'$lte': date_to}}]}
+    else:
+        criteria = {'updated': {'$gte': date_from}}
+
+    if cls == BibSet and fft_symbols:
+        return {
+            '$or': [
+                criteria, 
+                {'191.subfields.value': {'$in': fft_symbols}},
+                {'561.subfields.value': {'$in': fft_uris or []}},
+            ]
+        }
+
+    return criteria
+
+def deleted_records(cls, history):
+    """Builds the records to export as DELETED from their history docs"""
+
+    rcls = Bib if cls == BibSet else Auth
+    to_delete = []
+
+    for d in history:
+        r = rcls({'_id': d['_id']})
+        r.set('980', 'a', 'DELETED')
+        r.updated = d['deleted']['time']
+        r.user = d['deleted']['user']
+        to_delete.append(r)
+
+    return to_delete
+
 def get_records(args, log=None, queue=None):
     cls = BibSet if args.type == 'bib' else AuthSet
     since, to = None, None
@@ -507,37 +679,92 @@ def get_records(args, log=None, queue=None):
         raise Exception('One of the criteria arguments is required')
 
     if args.queue:
-        queue = DB.handle[export.QUEUE_COLLECTION]
-        qids = [x['record_id'] for x in queue.find({'source': args.source, 'type': args.type})]
-        print(f'Taking {len(qids)} from queue')
+        queue = queue or ExportQueue(type=args.type, source=args.source)
+        lease = queue.lease()
+        print(f'Taking {len(lease.items)} from queue')
         q_args, q_kwargs = marcset.query_params
-        marcset = cls.from_query({'$or': [{'_id': {'$in': list(qids)}}, q_args[0]]}, sort=[('updated', 1)])
+        marcset = cls.from_query({'$or': [{'_id': {'$in': lease.record_ids}}, q_args[0]]}, sort=[('updated', 1)])
+
+        if delete_ids := lease.ids_by_priority('DELETE'):
+            history = DB.handle['bib_history'] if cls == BibSet else DB.handle['auth_history']
+            deleted += deleted_records(cls, history.find({'_id': {'$in': delete_ids}, 'deleted': {'$exists': True}}))
 
     return [marcset, deleted]
 
+def dl_005_utc(value: str) -> datetime:
+    """The DL 005, which is in US Eastern time, as a naive UTC datetime"""
+
+    dl_updated = datetime.strptime(str(int(float(value))), '%Y%m%d%H%M%S')
+
+    return dl_updated + timedelta(hours=4 if pytz.timezone('US/Eastern').localize(dl_updated).dst() else 5)
+
+def is_stale(dlx_record, dl_record, files=None) -> bool:
+    """Whether the DL record, which only needs the 005, 980 and 998, may be
+    out of date: the DLX record or one of its files was updated after the DL
+    005, the DLX 998 is not the one in DL, or the record was deleted in DLX
+    but not in DL"""
+
+    try:
+        dl_updated = dl_005_utc(dl_record.get_value('005'))
+    except (TypeError, ValueError):
+        # no 005
+        return True
+
+    dlx_updated = dlx_record.updated
+
+    if dlx_updated is None:
+        return True
+    elif dlx_updated.tzinfo:
+        dlx_updated = dlx_updated.astimezone(timezone.utc).replace(tzinfo=None)
+
+    if dlx_updated > dl_updated:
+        return True
+
+    for f in (files.files(dlx_record) if files else []):
+        timestamp = f.timestamp.astimezone(timezone.utc).replace(tzinfo=None) if f.timestamp.tzinfo else f.timestamp
+
+        if timestamp > dl_updated:
+            return True
+
+    if _998 := dlx_record.get_field('998'):
+        # the 998 is sent with every export
+        dl_998 = dl_record.get_field('998')
+
+        if dl_998 is None or [(x.code, x.value) for x in _998.subfields] != [(x.code, x.value) for x in dl_998.subfields]:
+            return True
+
+    if dlx_record.get_value('980', 'a') == 'DELETED' and 'DELETED' not in dl_record.get_values('980', 'a'):
+        return True
+
+    return False
+
 def normalize(string):
     return unicodedata.normalize('NFD', string)
     
 def clean_dlx_values(record):
-    for field in record.datafields:
-        for sub in filter(lambda x: not hasattr(x, 'xref'), field.subfields):
-            if re.match(r'^-+$', sub.value):
-                # value can't start with '-'
-                sub.value.replace('-', '_')
-            elif sub.value == '' or re.match(r'^\s+$', sub.value):
-                # value can't be blank
-                field.subfields.remove(sub)
-                        
-        if len(field.subfields) == 0:
-            # field must contain subfields
-            record.fields.remove(field)
+    # values can't be blank and fields must contain subfields
+    export.clean(record)
 
+    for field in record.datafields:
         field.ind1 = ' ' if field.ind1 == '_' else field.ind1
         field.ind2 = ' ' if field.ind2 == '_' else field.ind2
     
     return record
 
-def export_whole_record(args, record, *, export_type):
+def record_fingerprint(record, files=None):
+    """The fingerprint of the fields and files that are compared with DL, after
+    the same transformations as in `compare_and_update`"""
+
+    record = export._980(clean_dlx_values(deepcopy(record)))
+    fields = []
+
+    for field in filter(lambda x: x.tag not in SKIP_FIELDS, record.datafields):
+        field.subfields = list(filter(lambda x: x.value is not None, field.subfields))
+        fields.append(field.to_mrk())
+
+    return Fingerprints.fingerprint(fields, files.files(record) if files else [])
+
+def export_whole_record(args, record, *, export_type, files=None):
     if export_type not in ['NEW', 'UPDATE', 'DELETE']:
         raise Exception('invalid "export_type"')
 
@@ -546,7 +773,7 @@ def export_whole_record(args, record, *, export_type):
 
     # no comp with DL data performed
     if args.type == 'bib':
-        record = export.process_bib(record, blacklisted=args.blacklisted, files_only=False)
+        record = export.process_bib(record, blacklisted=args.blacklisted, files_only=False, files=files)
     else:
         record = export.process_auth(record)
 
@@ -563,15 +790,16 @@ def delete_file(args, record, filename):
 
     submit_to_dl(args, deletion_record, mode='correct', export_start=args.START, export_type='UPDATE')
 
-def compare_and_update(args, *, dlx_record, dl_record):
+def compare_and_update(args, *, dlx_record, dl_record, files=None):
+    if files is None and args.type == 'bib':
+        files = FileResolver([dlx_record])
+
     dlx_record = clean_dlx_values(dlx_record)
     dlx_record = export._980(dlx_record) # add the 980 to dlx record for comparison
     
-    skip_fields = ['035', '909', '949', '998']
-    dlx_fields = list(filter(lambda x: x.tag not in skip_fields, dlx_record.datafields))
-    dl_fields = list(filter(lambda x: x.tag not in skip_fields, dl_record.datafields))
+    dlx_fields = list(filter(lambda x: x.tag not in SKIP_FIELDS, dlx_record.datafields))
+    dl_fields = list(filter(lambda x: x.tag not in SKIP_FIELDS, dl_record.datafields))
     take_tags = set()
-    delete_fields = []
 
     # obsolete xrefs
     for field in dl_fields:
@@ -587,61 +815,16 @@ def compare_and_update(args, *, dlx_record, dl_record):
     for field in dlx_fields:
         field.subfields = list(filter(lambda x: x.value is not None, field.subfields))
 
-    # serialize to text for comparison
-    dlx_fields_serialized = [x.to_mrk() for x in dlx_fields]
-    dl_fields_serialized = [x.to_mrk() for x in dl_fields]
+    # compare the fields
+    diff = diff_fields(dlx_fields, dl_fields, whitelist=export.WHITELIST, take_tags=take_tags)
 
-    # dlx -> dl
-    for field in dlx_fields:      
-        if field.tag == '856':
-            url = field.get_value('u')
-            
-            if urlparse(url).netloc in export.WHITELIST:
-                # files in these fields have been sent as FFT
-                continue
-
-        if normalize(field.to_mrk()) not in [normalize(x) for x in dl_fields_serialized]:
-            print(f'{dlx_record.id}: UPDATE: {field.to_mrk()}')
-            take_tags.add(field.tag)
-
-    # dl -> dlx
-    for field in dl_fields:
-        if field.tag == '856':
-            if 'digitallibrary.un.org' in field.get_value('u'):
-                # FFT file
-                continue
-
-        if normalize(field.to_mrk()) not in [normalize(x) for x in dlx_fields_serialized]:
-            # compare tag + indicators
-            if field.tag + ''.join(field.indicators) in [x.tag + ''.join(x.indicators) for x in dlx_fields]:
-                if field.tag not in take_tags:
-                    # this should already be taken care of in dlx->dl
-                    print(f'{dlx_record.id}: SUPERSEDED: {field.to_mrk()}')
-                    take_tags.add(field.tag)
-            else:
-                # delete fields where the tag + indicators combo does not exist in dl record
-                print(f'{dlx_record.id}: TO DELETE: {field.to_mrk()}')
-
-                # use the field in the export to delete the field in DL by setting values to empty string
-                for subfield in field.subfields:
-                    if hasattr(subfield, 'xref'):
-                        subfield.xref == None
-                    
-                    subfield.value = ""
-
-                delete_fields.append(field)
+    for kind, mrk in diff.changes:
+        print(f'{dlx_record.id}: {kind}: {mrk}')
 
-    # duplicated dl fields
-    dlx_counts = Counter(dlx_fields_serialized)
-    dl_counts = Counter(dl_fields_serialized)
+    for dup in diff.duplicates:
+        print(f'{dlx_record.id}: DUPLICATED FIELD: {dup}')
 
-    for dup in filter(lambda x: x[1] > 1, dl_counts.items()):
-        # check if field is also duplicated in dlx
-        # `dup` is a Counter object
-        if dlx_counts[dup[0]] != dup[1]:
-            print(f'{dlx_record.id}: DUPLICATED FIELD: {dup}')
-            tag = dup[0][1:4]
-            take_tags.add(tag)
+    take_tags, delete_fields = diff.take_tags, diff.delete_fields
 
     # for comparing the filenames from dl record 856 with dlx filename
     def _get_dl_856(fn):
@@ -686,14 +869,14 @@ def compare_and_update(args, *, dlx_record, dl_record):
             if len(list(filter(lambda x: 'digitallibrary.un.org' in x, dl_record.get_values('856', 'u')))) == 0:
                 print(f'{dlx_record.id}: FILE NOT FOUND ' + url)
                 
-                return export_whole_record(args, dlx_record, export_type='UPDATE')
+                return export_whole_record(args, dlx_record, export_type='UPDATE', files=files)
 
             fn = url.split('/')[-1]
             
             if export.clean_fn(fn) not in _get_dl_856(fn):
                 print(f'{dlx_record.id}: FILE NOT FOUND ' + url)
 
-                return export_whole_record(args, dlx_record, export_type='UPDATE')
+                return export_whole_record(args, dlx_record, export_type='UPDATE', files=files)
 
     # for comparing number of files in each system
     all_dlx_files = []
@@ -701,9 +884,12 @@ def compare_and_update(args, *, dlx_record, dl_record):
     # records with file URI in 561
     uris = dlx_record.get_values('561', 'u')
 
+    if uris and files is None:
+        # auths are only looked up if they have file URIs
+        files = FileResolver([dlx_record])
+
     for uri in uris:
-        if files := list(File.find_by_identifier(Identifier('uri', uri))):
-            latest = sorted(files, key=lambda x: x.timestamp, reverse=True)[0]
+        if latest := files.latest_by_identifier(Identifier('uri', uri)):
             
             if latest.id not in [x.id for x in all_dlx_files]:
                 all_dlx_files.append(latest)
@@ -714,7 +900,7 @@ def compare_and_update(args, *, dlx_record, dl_record):
             if export.clean_fn(fn) not in _get_dl_856(fn):
                 print(f'{dlx_record.id}: FILE NOT FOUND ' + uri)
 
-                return export_whole_record(args, dlx_record, export_type='UPDATE')
+                return export_whole_record(args, dlx_record, export_type='UPDATE', files=files)
     
     # official doc files
     symbols = (dlx_record.get_values('191', 'a') + dlx_record.get_values('191', 'z')) if args.type == 'bib' else []
@@ -722,8 +908,8 @@ def compare_and_update(args, *, dlx_record, dl_record):
     for symbol in set(symbols):
         if symbol == '' or symbol == ' ' or symbol == '***': continue # note: clean these up in db
 
-        for lang in ('AR', 'ZH', 'EN', 'FR', 'RU', 'ES', 'DE'):
-            if f := File.latest_by_identifier_language(Identifier('symbol', symbol), lang):
+        for lang in FILE_LANGUAGES:
+            if f := files.latest_by_identifier_language(Identifier('symbol', symbol), lang):
                 if f.id not in [x.id for x in all_dlx_files]:
                     all_dlx_files.append(f)
 
@@ -738,12 +924,12 @@ def compare_and_update(args, *, dlx_record, dl_record):
                     if size != f.size:
                         print(f'{dlx_record.id}: FILE SIZE NOT MATCHING - {symbol}-{lang}')
                         #print([size, f.to_dict()])
-                        return export_whole_record(args, dlx_record, export_type='UPDATE')
+                        return export_whole_record(args, dlx_record, export_type='UPDATE', files=files)
 
                 if field is None and 'RES' not in dlx_record.get_values('091', 'a') and symbol not in args.blacklisted:
                     print(f'{dlx_record.id}: FILE NOT FOUND - {symbol}-{lang}')
                     
-                    return export_whole_record(args, dlx_record, export_type='UPDATE')
+                    return export_whole_record(args, dlx_record, export_type='UPDATE', files=files)
 
     # check if there are a different number of files in DL than DLX
     dl_files = [x for x in dl_record.get_fields('856') if re.match(r'http[s]?://digitallibrary.un.org', x.get_value('u'))]
@@ -753,7 +939,7 @@ def compare_and_update(args, *, dlx_record, dl_record):
     # skip this for now. does not delete extra files in DL
     if False: #dl_file_count != len(all_dlx_files):
         #print(f'EXTRA FILES DETECTED - {[x.to_mrk() for x in dl_files]}\n{[f.to_dict() for f in all_dlx_files]}')
-        #return export_whole_record(args, dlx_record, export_type='UPDATE')
+        #return export_whole_record(args, dlx_record, export_type='UPDATE', files=files)
         pass
     
     # run api submission
@@ -783,13 +969,18 @@ def submit_to_dl(args, record, *, mode, export_start, export_type):
 
     export_id = str(uuid.uuid4()) # random uuid
     xml = record.to_xml(xref_prefix='(DHLAUTH)', write_id=False)
-    
+    dispatcher = getattr(args, 'dispatcher', None) or Dispatcher()
+
+    # logged when the response is received
+    return dispatcher.submit(record.id, _post_and_log, args, record.id, xml, mode=mode, export_start=export_start, export_type=export_type, export_id=export_id)
+
+def _post_and_log(args, record_id, xml, *, mode, export_start, export_type, export_id):
     headers = {
         'Authorization': 'Token ' + args.api_key,
         'Content-Type': 'application/xml; charset=utf-8',
     }
 
-    nonce = {'type': args.type, 'id': record.id, 'export_start': str(export_start), 'export_id': export_id,'key': args.nonce_key}
+    nonce = {'type': args.type, 'id': record_id, 'export_start': str(export_start), 'export_id': export_id,'key': args.nonce_key}
     
     params = {
         'mode': mode,
@@ -798,7 +989,21 @@ def submit_to_dl(args, record, *, mode, export_start, export_type):
         'nonce': json.dumps(nonce)
     } 
 
-    response = requests.post(API_RECORD_URL, params=params, headers=headers, data=xml.encode('utf-8'))
+    if mirror := getattr(args, 'mirror', None):
+        # the DL record is about to change
+        mirror.invalidate([record_id])
+
+    start = time.perf_counter()
+    response = client.post(API_RECORD_URL, params=params, headers=headers, data=xml.encode('utf-8'))
+
+    if metrics := getattr(args, 'metrics', None):
+        metrics.timing('SubmitLatency', time.perf_counter() - start)
+        metrics.count(f'Response{response.status_code}')
+
+    if (fingerprints := getattr(args, 'fingerprints', None)) and response.status_code == 200:
+        # in sync once DL imports the export
+        if fingerprint := args.fingerprinted.pop(record_id, None):
+            fingerprints.put([(record_id, fingerprint, None, export_id)])
     
     logdata = {
         'export_start': export_start,
@@ -807,13 +1012,19 @@ def submit_to_dl(args, record, *, mode, export_start, export_type):
         'time': datetime.now(timezone.utc),
         'source': args.source,
         'record_type': args.type, 
-        'record_id': record.id, 
+        'record_id': record_id, 
         'response_code': response.status_code, 
         'response_text': response.text.replace('\n', ''),
         'xml': xml
     }
 
-    DB.handle[export.LOG_COLLECTION].insert_one(logdata)
+    entry = compress_log_entry(logdata)
+
+    if buffer := getattr(args, 'buffer', None):
+        buffer.insert(DB.handle[export.LOG_COLLECTION], entry)
+    else:
+        DB.handle[export.LOG_COLLECTION].insert_one(entry)
+
     logdata['export_start'] = logdata['export_start'].isoformat()
     logdata['time'] = logdata['time'].isoformat()
     logdata.pop('_id', None)
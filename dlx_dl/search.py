@@ -0,0 +1,78 @@
+'''Parses DL search API responses incrementally from the response stream'''
+
+from io import BytesIO
+from xml.etree import ElementTree
+import requests
+
+NS = '{http://www.loc.gov/MARC21/slim}'
+CHUNK_SIZE = 64 * 1024
+
+class SearchResults():
+    def __init__(self, response: requests.Response):
+        """The MARCXML records in a search API response, parsed as they are
+        iterated. Each record element is cleared once the next one is taken,
+        so it has to be used or serialized before then. `search_id` and
+        `total` are set once their elements have been parsed, and `count` and
+        `nbytes` are the number of records and bytes read so far. The response
+        should be requested with `stream=True` for the parsing to overlap the
+        download"""
+
+        self.response = response
+        self.search_id = None
+        self.total = None
+        self.count = 0
+        self.nbytes = 0
+
+    def __iter__(self):
+        collection = None
+
+        try:
+            for event, elem in ElementTree.iterparse(_Reader(self), events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == f'{NS}collection':
+                        collection = elem
+
+                    continue
+
+                if elem.tag == f'{NS}record':
+                    self.count += 1
+
+                    yield elem
+
+                    # free the record. the collection would otherwise keep the cleared element
+                    elem.clear()
+
+                    if collection is not None and len(collection) and collection[0] is elem:
+                        del collection[0]
+                elif elem.tag == 'search_id':
+                    self.search_id = elem.text
+                elif elem.tag == 'total':
+                    self.total = int(elem.text or 0)
+        finally:
+            self.response.close()
+
+    def first(self) -> ElementTree.Element | None:
+        """The first record, which is not cleared. The rest of the response is
+        not read"""
+
+        return next(iter(self), None)
+
+class _Reader():
+    def __init__(self, results: SearchResults):
+        # iterparse reads from this as the response arrives
+        self.results = results
+        response = results.response
+
+        if response.raw is None or getattr(response, '_content_consumed', False):
+            # the body has already been read
+            self.stream = BytesIO(response.content)
+            self.decode = {}
+        else:
+            self.stream = response.raw
+            self.decode = {'decode_content': True}
+
+    def read(self, n: int = CHUNK_SIZE) -> bytes:
+        data = self.stream.read(n if n and n > 0 else CHUNK_SIZE, **self.decode)
+        self.results.nbytes += len(data)
+
+        return data
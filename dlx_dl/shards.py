@@ -0,0 +1,154 @@
+'''Shards of a sync job, stored as lease documents (`dlx_dl_shard`) that worker processes claim, so that the shard of a worker that stops is taken up by another'''
+
+import json
+from datetime import datetime, timezone, timedelta
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from dlx import DB
+
+SHARD_COLLECTION = 'dlx_dl_shard'
+LEASE_TIME = 600 # seconds a claim lasts unless it is renewed
+MAX_ATTEMPTS = 5 # claims of a shard before it is marked as failed
+STATUSES = ('pending', 'running', 'done', 'failed')
+
+class ShardLeases():
+    def __init__(self, *, job: str, lease_time: int = LEASE_TIME, max_attempts: int = MAX_ATTEMPTS):
+        """The shards of `job`, unique by (job, number). A shard is claimed by
+        one worker at a time, for `lease_time` seconds. The worker renews the
+        claim while it is working on the shard. If the claim expires, the shard
+        can be claimed again by any worker"""
+
+        if not DB.connected:
+            raise Exception('Not connected to DB')
+
+        self.job = job
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.collection = DB.handle[SHARD_COLLECTION]
+        self.collection.create_index([('job', ASCENDING), ('number', ASCENDING)], unique=True)
+        self.collection.create_index([('job', ASCENDING), ('status', ASCENDING)])
+
+    def create(self, shards: list[dict]) -> int:
+        """Adds the shards, as the sync arguments that select each shard's
+        records, numbered in order. Shards already in the job are left as they
+        are, so that a job can be resumed. Returns the number of shards added"""
+
+        if not shards:
+            return 0
+
+        now = datetime.now(timezone.utc)
+        updates = [
+            UpdateOne(
+                {'job': self.job, 'number': i},
+                {'$setOnInsert': {'job': self.job, 'number': i, 'criteria': criteria, 'status': 'pending', 'attempts': 0, 'available': now, 'created': now}},
+                upsert=True
+            )
+            for i, criteria in enumerate(shards)
+        ]
+
+        return self.collection.bulk_write(updates, ordered=False).upserted_count
+
+    def claim(self, worker: str) -> dict | None:
+        """Takes the lowest numbered shard that is pending, or whose claim has
+        expired. Returns the shard, or None if there are none to take"""
+
+        now = datetime.now(timezone.utc)
+        # shards that have been claimed too many times without finishing
+        self.collection.update_many(
+            {'job': self.job, 'status': 'running', 'lease_until': {'$lt': now}, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {'status': 'failed', 'finished': now}, '$unset': {'worker': '', 'lease_until': ''}}
+        )
+
+        return self.collection.find_one_and_update(
+            {
+                'job': self.job,
+                '$or': [
+                    {'status': 'pending', 'available': {'$lte': now}},
+                    {'status': 'running', 'lease_until': {'$lt': now}}
+                ]
+            },
+            {'$set': {'status': 'running', 'worker': worker, 'lease_until': now + timedelta(seconds=self.lease_time)}, '$inc': {'attempts': 1}},
+            sort=[('number', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def renew(self, shard: dict, worker: str) -> bool:
+        """Extends the claim. Returns False if the worker no longer holds it"""
+
+        result = self.collection.update_one(
+            {'_id': shard['_id'], 'status': 'running', 'worker': worker},
+            {'$set': {'lease_until': datetime.now(timezone.utc) + timedelta(seconds=self.lease_time)}}
+        )
+
+        return result.modified_count == 1
+
+    def complete(self, shard: dict, worker: str, result: dict = None) -> bool:
+        """Marks the shard as done, with the `result` of processing it. Returns
+        False if the worker no longer holds the claim"""
+
+        updated = self.collection.update_one(
+            {'_id': shard['_id'], 'status': 'running', 'worker': worker},
+            {'$set': {'status': 'done', 'result': result or {}, 'finished': datetime.now(timezone.utc)}, '$unset': {'lease_until': ''}}
+        )
+
+        return updated.modified_count == 1
+
+    def release(self, shard: dict, worker: str, *, error: str = None, delay: int = 0) -> None:
+        """Gives up the claim. The shard can be claimed again after `delay`
+        seconds. If there was an `error` and the shard has been claimed
+        `max_attempts` times, it is marked as failed instead"""
+
+        now = datetime.now(timezone.utc)
+        held = {'_id': shard['_id'], 'status': 'running', 'worker': worker}
+        update = {'$unset': {'worker': '', 'lease_until': ''}}
+
+        if not error:
+            # only claims that failed or expired count as attempts
+            update['$set'] = {'status': 'pending', 'available': now + timedelta(seconds=delay)}
+            update['$inc'] = {'attempts': -1}
+        elif shard.get('attempts', 0) >= self.max_attempts:
+            update['$set'] = {'status': 'failed', 'error': error, 'finished': now}
+        else:
+            update['$set'] = {'status': 'pending', 'error': error, 'available': now + timedelta(seconds=delay)}
+
+        self.collection.update_one(held, update)
+
+    def progress(self) -> dict[str, int]:
+        """The number of shards in each status"""
+
+        counts = dict.fromkeys(STATUSES, 0)
+
+        for group in self.collection.aggregate([{'$match': {'job': self.job}}, {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[group['_id']] = group['count']
+
+        return counts
+
+    def unfinished(self) -> int:
+        """The number of shards that are pending or running"""
+
+        return self.collection.count_documents({'job': self.job, 'status': {'$in': ['pending', 'running']}})
+
+def id_shards(start: int, end: int, size: int) -> list[dict]:
+    """Shards of `size` record IDs from `start` to `end`, inclusive, as sync
+    queries"""
+
+    if size < 1: raise Exception('"size" must be at least 1')
+
+    return [
+        {'query': json.dumps({'$and': [{'_id': {'$gte': i}}, {'_id': {'$lt': min(i + size, end + 1)}}]})}
+        for i in range(start, end + 1, size)
+    ]
+
+def date_shards(since: datetime, to: datetime, window: timedelta) -> list[dict]:
+    """Shards of records updated in consecutive `window`s from `since` to
+    `to`, as sync date arguments"""
+
+    if window <= timedelta(0): raise Exception('"window" must be positive')
+
+    shards = []
+
+    while since < to:
+        until = min(since + window, to)
+        shards.append({'modified_from': since.isoformat(), 'modified_to': until.isoformat()})
+        since = until
+
+    return shards
@@ -1,6 +1,14 @@
+import zlib
 from datetime import datetime, timezone, timedelta
 from dlx import DB
 from dlx.marc import Marc, Bib, BibSet, Auth, AuthSet
+from dlx.file import File, Identifier
+from pymongo import InsertOne, ReplaceOne
+
+FILE_LANGUAGES = ('AR', 'ZH', 'EN', 'FR', 'RU', 'ES', 'DE')
+FILE_INDEX_COLLECTION = 'dlx_dl_file_index'
+FILE_INDEX_STATUS_COLLECTION = 'dlx_dl_file_index_status'
+FILE_FIELDS = ('identifiers', 'filename', 'languages', 'mimetype', 'size', 'source', 'timestamp', 'updated', 'uri') # kept with the latest files, to build `File`s without reading `DB.files`
 
 # functions
 def elapsed(since: datetime, until: datetime = datetime.now(timezone.utc)) -> timedelta:
@@ -11,6 +19,80 @@ def elapsed(since: datetime, until: datetime = datetime.now(timezone.utc)) -> ti
 
     return until - since
 
+def compress_log_entry(logdata: dict) -> dict:
+    """Returns a copy of the log entry with the XML zlib-compressed for 
+    storage. Use `log_xml` to read it back"""
+
+    entry = dict(logdata)
+
+    if isinstance(entry.get('xml'), str):
+        entry['xml'] = zlib.compress(entry['xml'].encode('utf-8'))
+
+    return entry
+
+def log_xml(entry: dict) -> str | None:
+    """Returns the XML of a log entry, decompressing it if it was stored
+    compressed"""
+
+    xml = entry.get('xml')
+
+    if isinstance(xml, bytes):
+        return zlib.decompress(xml).decode('utf-8')
+
+    return xml
+
+def latest_files(criteria: list[dict] = None):
+    """Aggregates the latest file per (identifier type, value, language) in 
+    `DB.files`, optionally only for identifiers matching any of `criteria`.
+    The file's `FILE_FIELDS` are returned as `file`"""
+
+    match = [{'$match': {'$or': criteria}}] if criteria else []
+    # the file as it is before the unwinds
+    keep = [{'$addFields': {'file': dict({'_id': '$_id'}, **{k: f'${k}' for k in FILE_FIELDS})}}]
+    pipeline = match + keep + [{'$unwind': '$identifiers'}] + match + [
+        {'$unwind': {'path': '$languages', 'preserveNullAndEmptyArrays': True}},
+        {'$sort': {'timestamp': -1}},
+        {
+            '$group': {
+                '_id': {'type': '$identifiers.type', 'value': '$identifiers.value', 'language': '$languages'},
+                'file_id': {'$first': '$_id'},
+                'uri': {'$first': '$uri'},
+                'size': {'$first': '$size'},
+                'timestamp': {'$first': '$timestamp'},
+                'updated': {'$first': '$updated'},
+                'file': {'$first': '$file'}
+            }
+        }
+    ]
+
+    return DB.files.aggregate(pipeline, allowDiskUse=True)
+
+def deleted_since(record_type: str, date_from: datetime, date_to: datetime = None, *, exclude_user: str = None):
+    """Returns a cursor over the history docs of records deleted in the time
+    range that have not been restored, as `{'_id', 'deleted': {'time', 'user'}}`.
+    Restored records are excluded server-side by looking them up in the live
+    collection"""
+
+    if record_type not in ('bib', 'auth'): raise Exception('"record_type" must be "bib" or "auth"')
+
+    return DB.handle[f'{record_type}_history'].aggregate(deleted_since_pipeline(record_type, date_from, date_to, exclude_user=exclude_user), allowDiskUse=True)
+
+def deleted_since_pipeline(record_type: str, date_from: datetime, date_to: datetime = None, *, exclude_user: str = None) -> list[dict]:
+    """The aggregation pipeline run by `deleted_since` on the history collection"""
+
+    criteria = {'deleted.time': {'$gte': date_from}}
+    date_to and criteria['deleted.time'].update({'$lte': date_to})
+    exclude_user and criteria.update({'deleted.user': {'$ne': exclude_user}})
+    live = 'bibs' if record_type == 'bib' else 'auths'
+
+    return [
+        {'$match': criteria},
+        {'$project': {'deleted.time': 1, 'deleted.user': 1}},
+        {'$lookup': {'from': live, 'localField': '_id', 'foreignField': '_id', 'as': 'live'}},
+        {'$match': {'live': {'$size': 0}}},
+        {'$project': {'live': 0}}
+    ]
+
 # classes
 class PendingStatus():
     def __init__(self, *, connection_string: str = None, database: str = None, collection: str):
@@ -51,3 +133,233 @@ class PendingStatus():
     def pending_records(self) -> list[Marc]:
         """The number of seconds that exports from the collection have been pending"""
         return self._pending_records
+
+class FileResolver():
+    def __init__(self, records: list[Marc] = [], *, index: 'FileIndex' = None):
+        """Resolves the latest file for every 191 $a/$z symbol and 561 $u URI in 
+        a batch of records in one aggregation (or one read of the file index, if
+        given), and serves the lookups from memory. The files are built from
+        the aggregation or index entries, without reading `DB.files`"""
+
+        self.index = index
+        self._latest = {} # (type, value, language) -> File
+        self._latest_any = {} # (type, value) -> File
+        self._resolved = set() # (type, value)
+        self.resolve(records)
+
+    @staticmethod
+    def identifiers(record: Marc) -> list[Identifier]:
+        symbols = record.get_values('191', 'a') + record.get_values('191', 'z')
+        uris = record.get_values('561', 'u')
+        
+        return [Identifier('symbol', x) for x in symbols if x not in ('', ' ', '***')] \
+            + [Identifier('uri', x) for x in uris if x]
+
+    def resolve(self, records: list[Marc]) -> None:
+        """Fetches the latest file per (identifier, language) for the records' 
+        identifiers that have not already been resolved"""
+
+        wanted = {}
+
+        for record in records:
+            for idx in self.identifiers(record):
+                if (idx.type, idx.value) not in self._resolved:
+                    wanted.setdefault(idx.type, set()).add(idx.value)
+
+        if not wanted:
+            return
+
+        if self.index:
+            latest = [(x['type'], x['value'], x['language'], x['file_id'], x.get('file')) for x in self.index.find(wanted)]
+        else:
+            criteria = [{'identifiers.type': t, 'identifiers.value': {'$in': list(vals)}} for t, vals in wanted.items()]
+            latest = [(x['_id']['type'], x['_id']['value'], x['_id'].get('language'), x['file_id'], x.get('file')) for x in latest_files(criteria)]
+
+        # index entries written before the file fields were kept in the index
+        missing = list({x[3] for x in latest if x[4] is None})
+        docs = {doc['_id']: doc for doc in DB.files.find({'_id': {'$in': missing}})} if missing else {}
+        files = {}
+
+        for *_, file_id, doc in latest:
+            if file_id not in files and (doc := doc or docs.get(file_id)):
+                files[file_id] = File(doc)
+
+        for itype, value, language, file_id, _ in latest:
+            if f := files.get(file_id):
+                key = (itype, value)
+                self._latest[key + (language,)] = f
+
+                if key not in self._latest_any or f.timestamp > self._latest_any[key].timestamp:
+                    self._latest_any[key] = f
+
+        for t, vals in wanted.items():
+            self._resolved.update([(t, v) for v in vals])
+    
+    def files(self, record: Marc) -> list[File]:
+        """The latest files for the record: per language for each symbol, and
+        in any language for each URI"""
+
+        found = {}
+
+        for idx in self.identifiers(record):
+            if idx.type == 'symbol':
+                for lang in FILE_LANGUAGES:
+                    if f := self.latest_by_identifier_language(idx, lang):
+                        found[f.id] = f
+            elif f := self.latest_by_identifier(idx):
+                found[f.id] = f
+
+        return list(found.values())
+
+    def latest_by_identifier_language(self, identifier: Identifier, language: str) -> File | None:
+        if (identifier.type, identifier.value) not in self._resolved:
+            # not in the batch
+            return File.latest_by_identifier_language(identifier, language)
+
+        return self._latest.get((identifier.type, identifier.value, language.upper()))
+
+    def latest_by_identifier(self, identifier: Identifier) -> File | None:
+        """The latest file with the identifier in any language"""
+
+        if (identifier.type, identifier.value) not in self._resolved:
+            if files := list(File.find_by_identifier(identifier)):
+                return sorted(files, key=lambda x: x.timestamp, reverse=True)[0]
+            
+            return
+
+        return self._latest_any.get((identifier.type, identifier.value))
+
+class FileIndex():
+    def __init__(self):
+        """Materialized index of the latest file per (identifier type, value, 
+        language), with the fields of the file, kept current from the
+        `timestamp`/`updated` high-watermark of `DB.files`"""
+
+        if not DB.connected:
+            raise Exception('Not connected to DB')
+
+        self.collection = DB.handle[FILE_INDEX_COLLECTION]
+        self.status = DB.handle[FILE_INDEX_STATUS_COLLECTION]
+
+    @classmethod
+    def current(cls, *, refresh: bool = True) -> 'FileIndex | None':
+        """Returns the index, refreshed unless `refresh` is False (e.g. when
+        it was refreshed by the process that started this one), or None if the
+        index has not been built"""
+
+        index = cls()
+
+        if index.watermark is None:
+            return
+
+        if refresh:
+            index.refresh()
+
+        return index
+
+    @property
+    def watermark(self) -> datetime | None:
+        """The latest file `timestamp`/`updated` time the index is current to"""
+
+        if status := self.status.find_one({'_id': FILE_INDEX_COLLECTION}):
+            return status['watermark']
+
+    def find(self, identifiers: dict[str, set]):
+        """Index entries for the given {identifier type: values}"""
+
+        return self.collection.find({'$or': [{'type': t, 'value': {'$in': list(vals)}} for t, vals in identifiers.items()]})
+
+    def rebuild(self) -> int:
+        """Rebuilds the whole index from `DB.files`. Returns the number of
+        entries. The index is built in another collection and swapped in when
+        it is complete, so that runs using the index meanwhile see the old one"""
+
+        times = list(DB.files.find({}, projection={'timestamp': 1, 'updated': 1}))
+        watermark = self._max_time(times)
+        building = DB.handle[FILE_INDEX_COLLECTION + '_rebuild']
+        building.drop()
+        building.create_index([('type', 1), ('value', 1), ('language', 1)], unique=True)
+        building.create_index('file_id')
+        count = self._write(latest_files(), replace=False, collection=building)
+        building.rename(FILE_INDEX_COLLECTION, dropTarget=True)
+        # the files at the watermark are not processed again by `refresh`
+        done = [x['_id'] for x in times if self._max_time([x]) == watermark]
+        self.status.replace_one({'_id': FILE_INDEX_COLLECTION}, {'watermark': watermark, 'file_ids': done, 'time': datetime.now(timezone.utc)}, upsert=True)
+
+        return count
+
+    def refresh(self) -> int:
+        """Updates the entries affected by files added or updated since the
+        watermark. Returns the number of entries written"""
+
+        if (status := self.status.find_one({'_id': FILE_INDEX_COLLECTION})) is None:
+            raise Exception('The file index has not been built. Run `rebuild` first')
+
+        watermark, done = status['watermark'], status.get('file_ids', [])
+        criteria = {'$gte': watermark}
+        changed = DB.files.find({'$or': [{'timestamp': criteria}, {'updated': criteria}]}, projection={'identifiers': 1, 'timestamp': 1, 'updated': 1})
+        # the files at the watermark that were already indexed
+        changed = [f for f in changed if not (self._max_time([f]) == watermark and f['_id'] in done)]
+
+        if not changed:
+            return 0
+
+        # keys identified by the changed files, plus keys currently pointing to them
+        # in case an identifier was removed from the file
+        keys = {}
+
+        for f in changed:
+            for idx in f.get('identifiers', []):
+                keys.setdefault(idx['type'], set()).add(idx['value'])
+
+        for entry in self.collection.find({'file_id': {'$in': [x['_id'] for x in changed]}}):
+            keys.setdefault(entry['type'], set()).add(entry['value'])
+
+        # the entries are replaced in place, and only the keys that no longer have a file are deleted
+        written = set()
+        criteria = [{'identifiers.type': t, 'identifiers.value': {'$in': list(vals)}} for t, vals in keys.items()]
+        count = self._write(latest_files(criteria), replace=True, keys=written)
+        entries = self.collection.find({'$or': [{'type': t, 'value': {'$in': list(vals)}} for t, vals in keys.items()]}, projection={'type': 1, 'value': 1, 'language': 1})
+
+        if gone := [x['_id'] for x in entries if (x['type'], x['value'], x.get('language')) not in written]:
+            self.collection.delete_many({'_id': {'$in': gone}})
+
+        latest = self._max_time(changed)
+
+        if latest > watermark:
+            watermark, done = latest, []
+
+        done = done + [f['_id'] for f in changed if self._max_time([f]) == watermark]
+        self.status.update_one({'_id': FILE_INDEX_COLLECTION}, {'$set': {'watermark': watermark, 'file_ids': done, 'time': datetime.now(timezone.utc)}})
+
+        return count
+
+    def _write(self, latest, *, replace: bool, chunk_size: int = 1000, collection=None, keys: set = None) -> int:
+        collection = self.collection if collection is None else collection
+        ops, count = [], 0
+
+        for x in latest:
+            key = {'type': x['_id']['type'], 'value': x['_id']['value'], 'language': x['_id'].get('language')}
+
+            if keys is not None:
+                keys.add(tuple(key.values()))
+
+            entry = dict(key, **{k: x.get(k) for k in ('file_id', 'uri', 'size', 'timestamp', 'updated', 'file')})
+            ops.append(ReplaceOne(key, entry, upsert=True) if replace else InsertOne(entry))
+
+            if len(ops) == chunk_size:
+                collection.bulk_write(ops, ordered=False)
+                count += len(ops)
+                ops = []
+
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+            count += len(ops)
+
+        return count
+
+    @staticmethod
+    def _max_time(docs) -> datetime:
+        times = [t for doc in docs for t in (doc.get('timestamp'), doc.get('updated')) if t]
+
+        return max(times) if times else datetime.min
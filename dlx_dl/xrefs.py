@@ -0,0 +1,132 @@
+'''Resolves the auth headings referenced by a batch of records in one query, into a bounded cache'''
+
+import threading
+from collections import OrderedDict
+from importlib.metadata import version, PackageNotFoundError
+from warnings import warn
+from dlx import DB
+from dlx.marc import Auth, Marc
+
+MAX_SIZE = 100000 # auths
+DLX_VERSION = '1.6' # the dlx version pinned in requirements.txt, whose `Auth._cache` is xref -> {subfield code: value} and is only read with `in`, `[]` and `get`
+
+class LRUCache(OrderedDict):
+    def __init__(self, max_size: int = MAX_SIZE):
+        """A dict that discards the least recently used keys beyond `max_size`"""
+
+        super().__init__()
+        self.max_size = max_size
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return super().__contains__(key)
+
+    def __len__(self):
+        with self._lock:
+            return super().__len__()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = super().__getitem__(key)
+            self.move_to_end(key)
+
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+
+            while len(self) > self.max_size:
+                self.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if key not in self:
+                self[key] = default
+
+            return self[key]
+
+    def pop(self, key, *default):
+        with self._lock:
+            return super().pop(key, *default)
+
+    def popitem(self, last=True):
+        with self._lock:
+            return super().popitem(last=last)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+class XrefPrefetcher():
+    def __init__(self, *, max_size: int = MAX_SIZE):
+        """Takes the place of the auth heading cache that dlx serves xref
+        lookups from (`Auth._cache`, xref -> {subfield code: value}) with an LRU
+        cache of `max_size` auths that lives across batches. Lookups of auths
+        that were not prefetched are still added to the cache by dlx. The
+        original cache is put back by `restore`"""
+
+        if not isinstance(getattr(Auth, '_cache', None), dict):
+            raise Exception(f'dlx has no `Auth._cache` to replace. dlx {DLX_VERSION} is required')
+
+        try:
+            if not version('dlx').startswith(DLX_VERSION):
+                warn(f'The xref cache relies on the `Auth._cache` of dlx {DLX_VERSION}, not {version("dlx")}')
+        except PackageNotFoundError:
+            pass
+
+        self.cache = LRUCache(max_size)
+        self.original = Auth._cache
+        Auth._cache = self.cache
+
+    def restore(self) -> None:
+        """Puts back the cache that was replaced"""
+
+        if Auth._cache is self.cache:
+            Auth._cache = self.original
+
+    def prefetch(self, records: list[Marc]) -> int:
+        """Resolves the headings of the auths referenced by the records that
+        are not already cached, in one query. Returns the number of auths
+        fetched"""
+
+        wanted = set()
+
+        for record in records:
+            for field in record.datafields:
+                for subfield in field.subfields:
+                    if (xref := getattr(subfield, 'xref', None)) is not None and xref not in self.cache:
+                        wanted.add(xref)
+
+        if not wanted:
+            return 0
+
+        fetched = 0
+        # only the heading fields
+        projection = {tag: 1 for tag in ('100', '110', '111', '130', '150', '151', '190', '191')}
+
+        for doc in DB.auths.find({'_id': {'$in': list(wanted)}}, projection=projection):
+            heading = next((doc[tag][0] for tag in projection if doc.get(tag)), None)
+
+            if heading:
+                values = {}
+
+                for subfield in heading.get('subfields', []):
+                    values.setdefault(subfield['code'], subfield['value'])
+
+                self.cache[doc['_id']] = values
+                fetched += 1
+
+        return fetched
@@ -26,7 +26,10 @@ setup(
             'dlx-dl=dlx_dl.scripts.export:run', # to deprecate
             'dlx-dl-export=dlx_dl.scripts.export:run',
             'dlx-dl-sync=dlx_dl.scripts.sync:run',
-            'dlx-dl-alert=dlx_dl.scripts.alert:run'
+            'dlx-dl-alert=dlx_dl.scripts.alert:run',
+            'dlx-dl-file-index=dlx_dl.scripts.file_index:run',
+            'dlx-dl-indexes=dlx_dl.scripts.indexes:run',
+            'dlx-dl-shard=dlx_dl.scripts.shard:run'
         ]
     }
 )
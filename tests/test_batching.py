@@ -0,0 +1,39 @@
+import pytest
+from dlx_dl.batching import AdaptiveBatchSize
+
+def test_grow():
+    sizer = AdaptiveBatchSize(100, maximum=150)
+    assert sizer.record(seconds=1, nbytes=1000) == 125
+    assert sizer.record(seconds=1, nbytes=1000) == 150 # capped at maximum
+
+    # neither fast nor slow
+    assert sizer.record(seconds=7, nbytes=1000) == 150
+
+def test_shrink():
+    sizer = AdaptiveBatchSize(100, minimum=10, target_seconds=10, max_bytes=1000)
+    assert sizer.record(seconds=11, nbytes=100) == 75
+    assert sizer.record(seconds=1, nbytes=3000) == 25
+    assert sizer.record(seconds=1, nbytes=100, retried=['ReadTimeout']) == 12
+    assert sizer.record(seconds=1, nbytes=100, ok=False) == 10 # floored at minimum
+
+def test_rate_limited():
+    sizer = AdaptiveBatchSize(100, maximum=500)
+    # fewer, bigger requests when requests are rate limited
+    assert sizer.record(seconds=1, nbytes=100, retried=[429]) == 200
+    # 5xx takes precedence
+    assert sizer.record(seconds=1, nbytes=100, retried=[429, 503]) == 100
+
+def test_full():
+    sizer = AdaptiveBatchSize(100, max_url=1000)
+    assert not sizer.full(99, 999)
+    assert sizer.full(100, 500)
+    assert sizer.full(10, 1000)
+
+def test_cap():
+    sizer = AdaptiveBatchSize(200, minimum=10, maximum=500)
+    sizer.cap(100)
+    assert sizer.size == 100
+    assert sizer.record(seconds=1, nbytes=100) == 100
+
+    with pytest.raises(Exception):
+        AdaptiveBatchSize(5, minimum=10)
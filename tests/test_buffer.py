@@ -0,0 +1,40 @@
+import pytest
+from mongomock import MongoClient
+from pymongo import DeleteMany
+
+def test_flush_by_count():
+    from dlx_dl.buffer import BulkBuffer
+
+    log = MongoClient()['testing']['log']
+    buffer = BulkBuffer(max_ops=3, max_seconds=60)
+    doc = {'record_id': 1}
+    buffer.insert(log, doc)
+    doc['record_id'] = 2 # the buffered doc is a copy
+    buffer.insert(log, doc)
+    assert log.count_documents({}) == 0
+
+    buffer.insert(log, {'record_id': 3})
+    assert sorted(x['record_id'] for x in log.find()) == [1, 2, 3]
+
+def test_flush_by_time():
+    from dlx_dl.buffer import BulkBuffer
+
+    log = MongoClient()['testing']['log']
+    buffer = BulkBuffer(max_ops=100, max_seconds=0)
+    buffer.insert(log, {'record_id': 1})
+    assert log.count_documents({}) == 1
+
+def test_flush_on_exit():
+    from dlx_dl.buffer import BulkBuffer
+
+    db = MongoClient()['testing']
+    db['queue'].insert_many([{'record_id': 1}, {'record_id': 2}])
+
+    with pytest.raises(Exception):
+        with BulkBuffer() as buffer:
+            buffer.insert(db['log'], {'record_id': 1})
+            buffer.add(db['queue'], DeleteMany({'record_id': 1}))
+            raise Exception('error')
+
+    assert db['log'].count_documents({}) == 1
+    assert [x['record_id'] for x in db['queue'].find()] == [2]
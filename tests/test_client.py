@@ -0,0 +1,113 @@
+import gzip, pytest, responses
+from dlx_dl import client
+
+URL = 'http://127.0.0.1:9090/search'
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    waits = []
+    monkeypatch.setattr(client.time, 'sleep', lambda x: waits.append(x))
+    client.reset_latency()
+
+    return waits
+
+@responses.activate
+def test_retry(no_sleep):
+    responses.add(responses.GET, URL, status=502)
+    responses.add(responses.GET, URL, status=429, headers={'Retry-After': '7'})
+    responses.add(responses.GET, URL, status=429, json={'error': 'Max 100 requests per 5 minutes'})
+    responses.add(responses.GET, URL, body='OK')
+
+    response = client.get(URL)
+    assert response.text == 'OK'
+    assert no_sleep == [client.BACKOFF, 7, client.RATE_LIMIT_WAIT]
+    assert response.retried == [502, 429, 429]
+
+    stats = client.latency()['/search']
+    assert stats['count'] == 4
+    assert stats['errors'] == 3
+    assert stats['retries'] == 3
+
+@responses.activate
+def test_retries_exhausted(no_sleep):
+    responses.add(responses.GET, URL, status=500)
+
+    assert client.get(URL, max_retries=2).status_code == 500
+    assert len(no_sleep) == 2
+
+@responses.activate
+def test_no_retry(no_sleep):
+    responses.add(responses.GET, URL, status=400, body='bad request')
+
+    assert client.get(URL).status_code == 400
+    assert no_sleep == []
+
+@responses.activate
+def test_compress():
+    responses.add(responses.POST, URL, body='OK')
+
+    client.post(URL, data='<record></record>', compress=True)
+    request = responses.calls[0].request
+    assert request.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(request.body) == b'<record></record>'
+
+    client.post(URL, data='<record></record>')
+    assert responses.calls[1].request.body == '<record></record>'
+
+class Limiter():
+    def __init__(self):
+        self.calls = []
+
+    def acquire(self):
+        self.calls.append('acquire')
+
+    def record(self, ok):
+        self.calls.append(ok)
+
+    def drain(self, seconds=0):
+        self.calls.append(('drain', seconds))
+
+@responses.activate
+def test_limiter(no_sleep):
+    responses.add(responses.GET, URL, status=503)
+    responses.add(responses.GET, URL, status=429)
+    responses.add(responses.GET, URL, body='OK')
+    record_url = 'http://127.0.0.1:9090/record/'
+    responses.add(responses.POST, record_url, status=429)
+    responses.add(responses.POST, record_url, body='OK')
+
+    limiter = Limiter()
+    client.set_limiter(limiter)
+
+    try:
+        assert client.get(URL).text == 'OK'
+        assert limiter.calls == ['acquire', False, 'acquire', True, ('drain', client.RATE_LIMIT_WAIT), 'acquire', True]
+        # the rate limit wait is in the limiter
+        assert no_sleep == [client.BACKOFF, 0]
+
+        # submissions are not limited
+        limiter.calls = []
+        assert client.post(record_url, data='<record></record>').text == 'OK'
+        assert limiter.calls == []
+        assert no_sleep[-1] == client.RATE_LIMIT_WAIT
+    finally:
+        client.set_limiter(None)
+
+@responses.activate
+def test_limiter_retry_after(no_sleep):
+    responses.add(responses.GET, URL, status=429, headers={'Retry-After': '7'})
+    responses.add(responses.GET, URL, status=429, json={'error': 'Max 100 requests per 5 minutes'})
+    responses.add(responses.GET, URL, body='OK')
+
+    limiter = Limiter()
+    client.set_limiter(limiter)
+
+    try:
+        assert client.get(URL).text == 'OK'
+        drained = [x[1] for x in limiter.calls if isinstance(x, tuple)]
+        assert drained[0] == 7
+        # without a Retry-After, the penalty is waited out in the limiter
+        assert drained[1] >= client.RATE_LIMIT_WAIT
+        assert no_sleep == [7, 0]
+    finally:
+        client.set_limiter(None)
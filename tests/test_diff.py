@@ -0,0 +1,38 @@
+from dlx.marc import Bib
+
+def test_diff_fields():
+    from dlx_dl.diff import diff_fields
+
+    dlx = Bib().set('245', 'a', 'title').set('246', 'a', 'other title').set('269', 'a', '2020').set('500', 'a', 'Café')
+    # the é in DL is decomposed
+    dl = Bib().set('245', 'a', 'old title').set('269', 'a', '2020').set('500', 'a', 'Café').set('520', 'a', 'abstract')
+    dl.set('650', 'a', 'x').set('650', 'a', 'x', address=['+'])
+
+    diff = diff_fields(dlx.datafields, dl.datafields, whitelist=[])
+    assert diff.changes == [
+        ('UPDATE', '=245  \\\\$atitle'),
+        ('UPDATE', '=246  \\\\$aother title'),
+        ('TO DELETE', '=520  \\\\$aabstract'),
+        ('TO DELETE', '=650  \\\\$ax'),
+        ('TO DELETE', '=650  \\\\$ax')
+    ]
+    assert diff.take_tags == {'245', '246', '650'}
+    assert [x.tag for x in diff.delete_fields] == ['520', '650', '650']
+    assert diff.delete_fields[0].get_value('a') == ''
+    assert diff.duplicates == [('=650  \\\\$ax', 2)]
+
+def test_superseded():
+    from dlx_dl.diff import diff_fields
+
+    dlx = Bib().set('245', 'a', 'title')
+    dl = Bib().set('245', 'a', 'title').set('245', 'a', 'old title', address=['+'])
+
+    diff = diff_fields(dlx.datafields, dl.datafields, whitelist=[])
+    assert diff.changes == [('SUPERSEDED', '=245  \\\\$aold title')]
+    assert diff.take_tags == {'245'}
+
+    # already being sent
+    dl = Bib().set('245', 'a', 'title').set('245', 'a', 'old title', address=['+'])
+    diff = diff_fields(dlx.datafields, dl.datafields, whitelist=[], take_tags=['245'])
+    assert diff.changes == []
+    assert diff.take_tags == {'245'}
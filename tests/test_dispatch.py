@@ -0,0 +1,50 @@
+import time, threading, pytest
+
+def test_inline():
+    from dlx_dl.dispatch import Dispatcher
+
+    with Dispatcher() as dispatcher:
+        future = dispatcher.submit(1, lambda x: x * 2, 21)
+        assert future.done()
+        assert future.result() == 42
+
+def test_concurrent():
+    from dlx_dl.dispatch import Dispatcher
+
+    in_flight, max_in_flight, order = [0], [0], []
+    lock = threading.Lock()
+
+    def post(record_id, n):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+
+        time.sleep(.01 if n == 0 else 0)
+
+        with lock:
+            in_flight[0] -= 1
+            order.append((record_id, n))
+
+    with Dispatcher(4) as dispatcher:
+        for record_id in range(10):
+            for n in range(3):
+                dispatcher.submit(record_id, post, record_id, n)
+
+    assert len(order) == 30
+    assert max_in_flight[0] <= 4
+
+    # same record submissions complete in order
+    for record_id in range(10):
+        assert [n for i, n in order if i == record_id] == [0, 1, 2]
+
+def test_error():
+    from dlx_dl.dispatch import Dispatcher
+
+    def fail():
+        raise Exception('failed')
+
+    dispatcher = Dispatcher(2)
+    dispatcher.submit(1, fail)
+
+    with pytest.raises(Exception):
+        dispatcher.close()
@@ -2,6 +2,7 @@ import sys, os, pytest, responses
 from moto import mock_aws
 from datetime import datetime
 from dlx_dl.scripts import export, sync
+from dlx_dl.util import log_xml
 
 os.environ['DLX_DL_TESTING'] = "true"
 START = datetime.now()
@@ -23,6 +24,8 @@ def db():
     DB.auths.drop()
     DB.files.drop()
     DB.handle['dlx_dl_log'].drop()
+    DB.handle['dlx_dl_file_index'].drop()
+    DB.handle['dlx_dl_file_index_status'].drop()
     
     Auth().set('100', 'a', 'name_1').commit()
     Auth().set('100', 'a', 'name_2').commit()
@@ -137,7 +140,7 @@ def test_post_and_log(db, capsys, excel_export, mock_post):
     assert isinstance(entry['time'], datetime)
     
     control = '<record><datafield tag="035" ind1=" " ind2=" "><subfield code="a">(DHL)1</subfield></datafield><datafield tag="191" ind1=" " ind2=" "><subfield code="a">TEST/1</subfield></datafield><datafield tag="245" ind1=" " ind2=" "><subfield code="a">title_1</subfield></datafield><datafield tag="700" ind1=" " ind2=" "><subfield code="a">name_1</subfield><subfield code="0">(DHLAUTH)1</subfield></datafield><datafield tag="980" ind1=" " ind2=" "><subfield code="a">BIB</subfield></datafield><datafield tag="FFT" ind1=" " ind2=" "><subfield code="a">https://mock_bucket.s3.amazonaws.com/1e50210a0202497fb79bc38b6ade6c34</subfield><subfield code="d">English</subfield><subfield code="n">TEST_1-EN.pdf</subfield></datafield></record>'
-    assert diff_texts(entry['xml'], control) == []
+    assert diff_texts(log_xml(entry), control) == []
     
     entry = DB.handle['dlx_dl_log'].find_one({'source': 'test'})
     assert isinstance(entry['export_start'], datetime)
@@ -157,7 +160,7 @@ def test_modified_since_log(db, capsys, mock_post):
     export.run(connect=db, source='test', type='bib', modified_since_log=True, use_api=True, api_key='x')
     entry = DB.handle['dlx_dl_log'].find_one({'record_id': 3})
     control = '<record><datafield tag="035" ind1=" " ind2=" "><subfield code="a">(DHL)3</subfield></datafield><datafield tag="980" ind1=" " ind2=" "><subfield code="a">BIB</subfield></datafield><datafield tag="999" ind1=" " ind2=" "><subfield code="a">new</subfield></datafield></record>'
-    assert diff_texts(entry['xml'], control) == []
+    assert diff_texts(log_xml(entry), control) == []
     
 def test_blacklist(db, capsys, mock_post):
     from dlx import DB
@@ -169,7 +172,7 @@ def test_blacklist(db, capsys, mock_post):
     control = '<record><datafield tag="035" ind1=" " ind2=" "><subfield code="a">(DHL)1</subfield></datafield><datafield tag="191" ind1=" " ind2=" "><subfield code="a">TEST/1</subfield></datafield><datafield tag="245" ind1=" " ind2=" "><subfield code="a">title_1</subfield></datafield><datafield tag="700" ind1=" " ind2=" "><subfield code="a">name_1</subfield><subfield code="0">(DHLAUTH)1</subfield></datafield><datafield tag="980" ind1=" " ind2=" "><subfield code="a">BIB</subfield></datafield></record>'
     export.run(connect=db, source='test', type='bib', modified_within=100, use_api=True, api_key='x')
     entry = DB.handle['dlx_dl_log'].find_one({'record_id': 1})
-    assert diff_texts(entry['xml'], control) == []
+    assert diff_texts(log_xml(entry), control) == []
   
 def test_queue(db, capsys, mock_post):
     import time, json
@@ -210,6 +213,24 @@ def test_delete(db, capsys, mock_post):
     #assert len(data) == 3
     #assert json.loads(data[2])['record_id'] == 3
 
+def test_batch(db, capsys, mock_post):
+    from dlx import DB
+
+    export.run(connect=db, source='test', type='bib', modified_within=100, use_api=True, api_key='x', batch=True, email='x', batch_size=1)
+    entries = list(DB.handle['dlx_dl_log'].find({'batch': {'$exists': 1}}, sort=[('batch', 1)]))
+    assert [x['record_ids'] for x in entries] == [[1], [2]]
+    assert entries[0]['response_code'] == 200
+
+    # size cap
+    DB.handle['dlx_dl_log'].drop()
+    export.run(connect=db, source='test', type='bib', modified_within=100, use_api=True, api_key='x', batch=True, email='x', batch_bytes=1)
+    assert DB.handle['dlx_dl_log'].count_documents({'batch': {'$exists': 1}}) == 2
+
+    DB.handle['dlx_dl_log'].drop()
+    export.run(connect=db, source='test', type='bib', modified_within=100, use_api=True, api_key='x', batch=True, email='x')
+    entry = DB.handle['dlx_dl_log'].find_one({'batch': 1})
+    assert entry['record_ids'] == [1, 2]
+
 def test_561(db, tmp_path):
     from io import BytesIO
     from xmldiff.main import diff_texts
@@ -222,6 +243,115 @@ def test_561(db, tmp_path):
     export.run(connect=db, source='test', type='bib', id=bib.id, xml=out)
     assert diff_texts(out.read_text(), control) == []
 
+def test_035_856(db, tmp_path):
+    from xmldiff.main import diff_texts
+    from dlx.marc import Bib
+
+    bib = Bib().set('035', 'a', 'A123').set('245', 'a', 'title').set('856', 'u', 'https://undl-js.s3.amazonaws.com/A B.pdf').set('856', '3', 'Eng')
+    bib.commit()
+    control = '<collection><record><datafield tag="035" ind1=" " ind2=" "><subfield code="a">A3X</subfield><subfield code="z">A123</subfield></datafield><datafield tag="035" ind1=" " ind2=" "><subfield code="a">(DHL)3</subfield></datafield><datafield tag="245" ind1=" " ind2=" "><subfield code="a">title</subfield></datafield><datafield tag="980" ind1=" " ind2=" "><subfield code="a">BIB</subfield></datafield><datafield tag="FFT" ind1=" " ind2=" "><subfield code="a">https://undl-js.s3.amazonaws.com/A%20B.pdf</subfield><subfield code="n">A_B.pdf</subfield><subfield code="d">English</subfield></datafield></record></collection>'
+    out = tmp_path / 'out.xml'
+    export.run(connect=db, source='test', type='bib', id=bib.id, xml=out)
+    assert diff_texts(out.read_text(), control) == []
+
+def test_file_resolver(db):
+    from dlx.marc import Bib
+    from dlx.file import Identifier
+    from dlx_dl.util import FileResolver
+
+    bib = Bib().set('191', 'a', 'TEST/1').set('561', 'u', 'test uri identifier')
+    files = FileResolver([bib])
+    f = files.latest_by_identifier_language(Identifier('symbol', 'TEST/1'), 'EN')
+    assert f.uri == 'mock_bucket.s3.amazonaws.com/1e50210a0202497fb79bc38b6ade6c34'
+    assert files.latest_by_identifier_language(Identifier('symbol', 'TEST/1'), 'FR') is None
+    assert files.latest_by_identifier(Identifier('uri', 'test uri identifier')).id == f.id
+    assert files.latest_by_identifier(Identifier('uri', 'not a uri')) is None
+
+def test_file_index(db, tmp_path):
+    from dlx import DB
+    from dlx.marc import Bib
+    from dlx.file import Identifier
+    from dlx_dl.util import FileIndex, FileResolver
+    from xmldiff.main import diff_texts
+
+    assert FileIndex.current() is None
+
+    index = FileIndex()
+    assert index.rebuild() == 2 # symbol and uri, both EN
+    entry = DB.handle['dlx_dl_file_index'].find_one({'type': 'symbol', 'value': 'TEST/1', 'language': 'EN'})
+    assert entry['uri'] == 'mock_bucket.s3.amazonaws.com/1e50210a0202497fb79bc38b6ade6c34'
+    assert entry['size'] == 9
+    assert entry['file']['_id'] == entry['file_id']
+    assert entry['file']['languages'] == ['EN']
+    assert index.refresh() == 0 # the file at the watermark was already indexed
+
+    # only the files changed since are processed, and their entries are replaced in place
+    from datetime import timedelta
+    f = DB.files.find_one({'_id': entry['file_id']})
+    DB.files.update_one({'_id': f['_id']}, {'$set': {'updated': f['timestamp'] + timedelta(seconds=1)}})
+    assert index.refresh() == 2
+    assert DB.handle['dlx_dl_file_index'].find_one({'type': 'symbol', 'value': 'TEST/1', 'language': 'EN'})['_id'] == entry['_id']
+    assert index.refresh() == 0
+
+    # rebuilt in another collection and swapped in
+    assert index.rebuild() == 2
+    assert 'dlx_dl_file_index_rebuild' not in DB.handle.list_collection_names()
+    assert DB.handle['dlx_dl_file_index'].count_documents({}) == 2
+
+    files = FileResolver([Bib().set('191', 'a', 'TEST/1')], index=FileIndex.current())
+    assert files.latest_by_identifier_language(Identifier('symbol', 'TEST/1'), 'EN').id == entry['file_id']
+
+    # export uses the index once built
+    control = '<collection><record><datafield tag="035" ind1=" " ind2=" "><subfield code="a">(DHL)1</subfield></datafield><datafield tag="191" ind1=" " ind2=" "><subfield code="a">TEST/1</subfield></datafield><datafield tag="245" ind1=" " ind2=" "><subfield code="a">title_1</subfield></datafield><datafield tag="700" ind1=" " ind2=" "><subfield code="a">name_1</subfield><subfield code="0">(DHLAUTH)1</subfield></datafield><datafield tag="980" ind1=" " ind2=" "><subfield code="a">BIB</subfield></datafield><datafield tag="FFT" ind1=" " ind2=" "><subfield code="a">https://mock_bucket.s3.amazonaws.com/1e50210a0202497fb79bc38b6ade6c34</subfield><subfield code="d">English</subfield><subfield code="n">TEST_1-EN.pdf</subfield></datafield></record></collection>'
+    out = tmp_path / 'out.xml'
+    export.run(connect=db, source='test', type='bib', id='1', xml=out)
+    assert diff_texts(out.read_text(), control) == []
+
+def test_indexes(db):
+    from dlx import DB
+    from dlx_dl.scripts.indexes import ensure_indexes, collscans
+
+    ensure_indexes()
+    ensure_indexes() # idempotent
+    keys = [x['key'] for x in DB.handle['dlx_dl_log'].list_indexes()]
+    assert {'source': 1, 'time': -1} in keys
+    assert any('deleted.time' in x['key'] for x in DB.handle['bib_history'].list_indexes())
+    # for the queries run with the default collation
+    assert '191.subfields.value_1_collated' in [x['name'] for x in DB.handle['bibs'].list_indexes()]
+
+    plan = {'stage': 'LIMIT', 'inputStage': {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}}
+    assert collscans(plan) == [{'stage': 'COLLSCAN'}]
+    plan = {'stage': 'SUBPLAN', 'inputStage': {'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]}}
+    assert len(collscans(plan)) == 1
+    assert collscans({'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}) == []
+
+def test_profile(db, tmp_path, capsys):
+    out, profile = tmp_path / 'out.xml', tmp_path / 'profile.txt'
+    export.run(connect=db, source='test', type='bib', id='1', xml=out, profile=str(profile))
+    report = profile.read_text()
+    assert '### hotspots by cumulative time' in report
+    assert '### memory' in report
+    assert 'Profile written to' in capsys.readouterr().err
+
+    export.run(connect=db, source='test', type='bib', id='1', xml=out, profile=True)
+    captured = capsys.readouterr()
+    assert '### hotspots by tottime time' in captured.err
+    assert '### hotspots' not in captured.out
+
+    # threads started during the run are profiled
+    import threading
+    from dlx_dl.profiling import profiled
+
+    def in_thread():
+        return sum(range(1000))
+
+    with profiled(str(profile)):
+        thread = threading.Thread(target=in_thread)
+        thread.start()
+        thread.join()
+
+    assert 'in_thread' in profile.read_text()
+
 def test_sync(db, capsys, mock_get_post):
     # todo: expand this test
     import json
@@ -234,12 +364,19 @@ def test_sync(db, capsys, mock_get_post):
 
     sync.run(connect=db, source='test', type='bib', modified_within=100, force=True)
     
-    data = list(filter(None, capsys.readouterr().out.split('\n')))
+    captured = capsys.readouterr()
+    data = list(filter(None, captured.out.split('\n')))
     logged = json.loads(data[4])
     assert logged.get('record_id') == bib.id
     assert logged.get('response_code') == 200
     assert DB.handle['dlx_dl_log'].find_one({'record_id': bib.id})
 
+    # metrics are written to STDERR
+    metrics = json.loads(captured.err.strip().split('\n')[-1])
+    assert metrics['Script'] == 'sync'
+    assert metrics['RecordsScanned'] >= 1
+    assert 'SearchLatencyP50' in metrics
+
     # no files
     DB.handle['files'].delete_many({})
     sync.run(connect=db, source='test', type='bib', modified_within=100, force=True)
@@ -259,5 +396,116 @@ def test_sync(db, capsys, mock_get_post):
     sync.run(connect=db, source='test', type='bib', id=bib.id, force=True)
     data = list(filter(None, capsys.readouterr().out.split('\n')))
     assert DB.handle['dlx_dl_log'].find_one({'record_id': bib.id})
+
+    # records found to be in sync or exported are skipped while they are unchanged
+    sync.run(connect=db, source='test', type='bib', modified_within=100, force=True, use_fingerprints=True)
+    assert 'NOT FOUND IN DL' in capsys.readouterr().out
+    assert DB.handle['dlx_dl_fingerprint'].count_documents({})
+    sync.run(connect=db, source='test', type='bib', modified_within=100, force=True, use_fingerprints=True)
+    assert 'NOT FOUND IN DL' not in capsys.readouterr().out
+
+def dl_xml(*records):
+    # a search API response
+    return '<collection xmlns="http://www.loc.gov/MARC21/slim">' + ''.join(x.to_xml(xref_prefix='(DHLAUTH)', write_id=False) for x in records) + '</collection>'
+
+def test_sync_prefetch(db, capsys):
+    import json
+    from dlx import DB
+    from dlx.marc import Bib
+
+    # the DL records are out of date
+    dl_records = []
+
+    for bib in Bib.from_query({}, sort=[('_id', 1)]):
+        dl = Bib().set('035', 'a', f'(DHL){bib.id}').set('245', 'a', f'old title {bib.id}').set('980', 'a', 'BIB')
+        dl.set('005', None, '20000101000000.0')
+        dl_records.append(dl)
+
+    def run(source, **kwargs):
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.GET, 'http://127.0.0.1:9090/search', body=dl_xml(*dl_records), status=200)
+            rsps.add(responses.POST, 'http://127.0.0.1:9090/record', body='test OK')
+            sync.run(connect=db, source=source, type='bib', ids=[str(x.id) for x in dl_records], force=True, **kwargs)
+
+        # the log entries are printed with their times
+        output = [x for x in capsys.readouterr().out.split('\n') if x and x[0] != '{']
+        logged = [(x['record_id'], x['export_type']) for x in DB.handle['dlx_dl_log'].find({'source': source}, sort=[('time', 1)])]
+
+        return output, logged
+
+    sequential = run('sequential')
+    assert any(': UPDATE: =245' in x for x in sequential[0])
+    assert len(sequential[1]) == len(dl_records)
+
+    # pipelined runs have the same result
+    assert run('pipelined', prefetch=2) == sequential
+
+def test_sync_two_phase(db, capsys):
+    import json
+    from datetime import timedelta
+    from urllib.parse import unquote
+    from dlx import DB
+    from dlx.marc import Bib
+
+    up_to_date, stale = Bib.from_query({}, sort=[('_id', 1)])
+    # the 005 is in US Eastern time
+    checked = [
+        Bib().set('035', 'a', f'(DHL){up_to_date.id}').set('005', None, (datetime.utcnow() + timedelta(days=1)).strftime('%Y%m%d%H%M%S.0')),
+        Bib().set('035', 'a', f'(DHL){stale.id}').set('005', None, '20000101000000.0')
+    ]
+    full = Bib().set('035', 'a', f'(DHL){stale.id}').set('245', 'a', 'old title').set('980', 'a', 'BIB').set('005', None, '20000101000000.0')
+    urls = []
+
+    def search(request):
+        urls.append(unquote(request.url))
+
+        return (200, {}, dl_xml(*checked) if '&ot=' in request.url else dl_xml(full))
+
+    with responses.RequestsMock() as rsps:
+        rsps.add_callback(responses.GET, 'http://127.0.0.1:9090/search', callback=search)
+        rsps.add(responses.POST, 'http://127.0.0.1:9090/record', body='test OK')
+        sync.run(connect=db, source='test', type='bib', ids=[str(up_to_date.id), str(stale.id)], force=True, two_phase=True)
+
+    # only the stale record is fetched in full
+    assert len(urls) == 2
+    assert f'(DHL){up_to_date.id}' in urls[0] and f'(DHL){stale.id}' in urls[0]
+    assert f'(DHL){stale.id}' in urls[1] and f'(DHL){up_to_date.id}' not in urls[1]
+
+    # and only the stale record is compared
+    captured = capsys.readouterr()
+    assert f'{stale.id}: UPDATE: =245' in captured.out
+    assert not any(x.startswith(f'{up_to_date.id}: ') for x in captured.out.split('\n'))
+    metrics = json.loads(captured.err.strip().split('\n')[-1])
+    assert metrics['CheckHits'] == 1
+    assert metrics['DecisionUpdate'] == 1
+    assert DB.handle['dlx_dl_log'].count_documents({'record_id': up_to_date.id}) == 0
+
+def test_is_stale():
+    from dlx.marc import Bib
+    from dlx_dl.scripts.sync import dl_005_utc, is_stale
+
+    # 005 is in US Eastern time
+    assert dl_005_utc('20240115120000.0') == datetime(2024, 1, 15, 17)
+    assert dl_005_utc('20240715120000.0') == datetime(2024, 7, 15, 16)
+
+    dlx = Bib().set('245', 'a', 'title').set('998', 'c', '20240115160000')
+    dlx.updated = datetime(2024, 1, 15, 16)
+    dl = Bib().set('005', None, '20240115120000.0').set('998', 'c', '20240115160000')
+    assert not is_stale(dlx, dl)
+
+    # updated in dlx since
+    dlx.updated = datetime(2024, 1, 15, 18)
+    assert is_stale(dlx, dl)
+
+    # the last export has not reached DL
+    dlx.updated = datetime(2024, 1, 15, 16)
+    dlx.set('998', 'c', '20240115170000')
+    assert is_stale(dlx, dl)
+
+    # deleted in dlx
+    dl.set('998', 'c', '20240115170000')
+    assert not is_stale(dlx, dl)
+    dlx.set('980', 'a', 'DELETED')
+    assert is_stale(dlx, dl)
     
 ### end
\ No newline at end of file
@@ -0,0 +1,63 @@
+import pytest
+from dlx import DB
+from dlx.marc import Bib
+
+@pytest.fixture
+def db():
+    DB.connect('mongomock://localhost') # mock DB
+    DB.handle['dlx_dl_queue'].drop()
+
+    return DB.client
+
+def test_enqueue(db):
+    from dlx_dl.export_queue import ExportQueue, PRIORITY
+
+    queue = ExportQueue(type='bib', source='test')
+    assert queue.enqueue([1, 2, 3]) == 3
+    assert queue.enqueue([2, 3, 4]) == 1
+    assert queue.count() == 4
+
+    # deleted records go in the DELETE lane
+    deleted = Bib({'_id': 3}).set('980', 'a', 'DELETED')
+    assert queue.enqueue([deleted]) == 0
+    assert DB.handle['dlx_dl_queue'].find_one({'record_id': 3})['priority'] == PRIORITY['DELETE']
+
+    # auths are queued separately
+    assert ExportQueue(type='auth').enqueue([1]) == 1
+    assert queue.count() == 4
+
+def test_lease(db):
+    from dlx_dl.export_queue import ExportQueue, queued
+
+    queue = ExportQueue(type='bib', source='test')
+    queue.enqueue([1, 2])
+    queue.enqueue([3], priority='NEW')
+    queue.enqueue([4], priority='DELETE')
+
+    lease = queue.lease(3)
+    assert lease.record_ids == [4, 3, 1]
+    assert lease.ids_by_priority('DELETE') == [4]
+
+    # leased items are not available to other leases
+    other = ExportQueue(type='bib', source='test').lease()
+    assert other.record_ids == [2]
+
+    queue.ack([4, 3])
+    assert queued() == 2
+    queue.release()
+    assert ExportQueue(type='bib', source='test').lease().record_ids == [1]
+
+    # expired leases
+    other.release()
+    assert ExportQueue(type='bib', source='test').lease(visibility_timeout=-1).record_ids == [2]
+    assert ExportQueue(type='bib', source='test').lease().record_ids == [2]
+
+def test_lease_priorities(db):
+    from dlx_dl.export_queue import ExportQueue
+
+    queue = ExportQueue(type='bib', source='test')
+    queue.enqueue([1])
+    queue.enqueue([2], priority='DELETE')
+
+    assert queue.lease(priorities=['NEW', 'UPDATE']).record_ids == [1]
+    assert queue.lease().record_ids == [2]
@@ -0,0 +1,48 @@
+import pytest, time
+from datetime import datetime, timezone, timedelta
+from dlx import DB
+
+@pytest.fixture
+def db():
+    DB.connect('mongomock://localhost') # mock DB
+    
+    for col in ('dlx_dl_fingerprint', 'dlx_dl_mirror', 'undl_callback_log'):
+        DB.handle[col].drop()
+
+    return DB.client
+
+def test_fingerprint():
+    from dlx_dl.fingerprint import Fingerprints
+
+    class File():
+        def __init__(self, id, size):
+            self.id, self.size = id, size
+
+    fp = Fingerprints.fingerprint(['=245  \\\\$atitle', '=269  \\\\$a2020'], [File('x', 1)])
+    # in any order, and NFD-normalized
+    assert Fingerprints.fingerprint(['=269  \\\\$a2020', '=245  \\\\$atitle'], [File('x', 1)]) == fp
+    assert Fingerprints.fingerprint(['=245  \\\\$aCaf\u00e9'], []) == Fingerprints.fingerprint(['=245  \\\\$aCafe\u0301'], [])
+    assert Fingerprints.fingerprint(['=245  \\\\$atitle', '=269  \\\\$a2020'], [File('x', 2)]) != fp
+
+def test_unchanged(db):
+    from dlx_dl.fingerprint import Fingerprints
+
+    fingerprints = Fingerprints(type='bib')
+    fingerprints.put([(1, 'a', '20240101000000.0', None), (2, 'b', '20240101000000.0', None), (3, 'c', None, 'export-3'), (4, 'd', None, 'export-4'), (5, 'e', '20240101000000.0', None)])
+    assert fingerprints.unchanged({1: 'a', 2: 'x', 3: 'c', 4: 'd', 5: 'e', 6: 'f'}) == {1, 3, 4, 5}
+
+    later = datetime.now(timezone.utc) + timedelta(minutes=1)
+    # the callback for the export that brought the record in sync
+    DB.handle['undl_callback_log'].insert_one({'record_type': 'bib', 'record_id': 3, 'time': later, 'nonce': {'export_id': 'export-3'}, 'results': [{'success': True}]})
+    # the export failed in DL
+    DB.handle['undl_callback_log'].insert_one({'record_type': 'bib', 'record_id': 4, 'time': later, 'nonce': {'export_id': 'export-4'}, 'results': [{'success': False}]})
+    # DL record changed since
+    DB.handle['dlx_dl_mirror'].insert_one({'type': 'bib', 'record_id': 5, '005': '20250101000000.0', 'time': later})
+    assert fingerprints.unchanged({1: 'a', 3: 'c', 4: 'd', 5: 'e'}) == {1, 3}
+
+    fingerprints.invalidate([1])
+    assert fingerprints.unchanged({1: 'a'}) == set()
+
+    # too old
+    fingerprints.max_age = -1
+    assert fingerprints.unchanged({3: 'c'}) == set()
@@ -0,0 +1,40 @@
+import io, json, time
+
+def test_emit():
+    from dlx_dl.metrics import Metrics
+
+    stream = io.StringIO()
+    metrics = Metrics(dimensions={'Script': 'sync', 'Source': 'test', 'RecordType': 'bib'}, stream=stream)
+    metrics.count('RecordsScanned', 10)
+    metrics.count('DecisionUpdate')
+
+    for ms in range(1, 101):
+        metrics.timing('SearchLatency', ms / 1000)
+
+    with metrics.stage('Compare'):
+        time.sleep(.01)
+
+    doc = metrics.emit()
+    assert json.loads(stream.getvalue()) == doc
+
+    emf = doc['_aws']['CloudWatchMetrics'][0]
+    assert emf['Namespace'] == 'dlx-dl'
+    assert emf['Dimensions'] == [['Script', 'Source', 'RecordType']]
+    assert {'Name': 'SearchLatencyP90', 'Unit': 'Milliseconds'} in emf['Metrics']
+    assert all(x['Name'] in doc for x in emf['Metrics'])
+
+    assert doc['Source'] == 'test'
+    assert doc['RecordsScanned'] == 10
+    assert doc['DecisionUpdate'] == 1
+    assert doc['SearchLatencyP50'] == 50
+    assert doc['SearchLatencyP99'] == 99
+    assert doc['SearchLatencyCount'] == 100
+    assert doc['CompareSeconds'] >= .01
+    assert doc['RecordsPerSecond'] > 0
+
+def test_percentile():
+    from dlx_dl.metrics import percentile
+
+    assert percentile([], 50) == 0
+    assert percentile([5], 99) == 5
+    assert percentile([1, 2, 3, 4], 50) == 2
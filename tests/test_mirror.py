@@ -0,0 +1,55 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+from xml.etree import ElementTree
+from dlx import DB
+from dlx.marc import Bib
+
+DL_XML = '<record xmlns="http://www.loc.gov/MARC21/slim"><controlfield tag="005">20240101000000.0</controlfield><datafield tag="035" ind1=" " ind2=" "><subfield code="a">(DHL){}</subfield></datafield><datafield tag="245" ind1=" " ind2=" "><subfield code="a">title</subfield></datafield></record>'
+
+@pytest.fixture
+def db():
+    DB.connect('mongomock://localhost') # mock DB
+    DB.handle['dlx_dl_mirror'].drop()
+    DB.handle['undl_callback_log'].drop()
+
+    return DB.client
+
+def _bib(record_id, updated):
+    bib = Bib({'_id': record_id})
+    bib.updated = updated
+
+    return bib
+
+def test_mirror(db):
+    from dlx_dl.mirror import DLMirror
+
+    mirror = DLMirror(type='bib')
+    before = datetime.now(timezone.utc) - timedelta(minutes=1)
+    mirror.put([(x, ElementTree.fromstring(DL_XML.format(x))) for x in (1, 2, 3)])
+    entry = DB.handle['dlx_dl_mirror'].find_one({'record_id': 1})
+    assert entry['005'] == '20240101000000.0'
+
+    # serialized
+    mirror.put([(5, ElementTree.tostring(ElementTree.fromstring(DL_XML.format(5))))])
+    assert DB.handle['dlx_dl_mirror'].find_one({'record_id': 5})['005'] == '20240101000000.0'
+
+    # record 2 was updated in dlx after it was fetched from DL
+    found = mirror.get([_bib(1, before), _bib(2, datetime.now(timezone.utc) + timedelta(minutes=1)), _bib(4, before)])
+    assert list(found.keys()) == [1]
+    assert found[1].get_value('245', 'a') == 'title'
+    assert found[1].get_value('035', 'a') == '(DHL)1'
+
+    # submitted since it was fetched
+    mirror.invalidate([1])
+    assert mirror.get([_bib(1, before)]) == {}
+
+    # DL called back since it was fetched
+    DB.handle['undl_callback_log'].insert_one({'record_type': 'bib', 'record_id': 3, 'time': datetime.now(timezone.utc) + timedelta(minutes=1)})
+    assert mirror.get([_bib(3, before)]) == {}
+
+    # too old
+    assert DLMirror(type='bib', max_age=0).get([_bib(2, before)]) == {}
+    assert list(mirror.get([_bib(2, before)]).keys()) == [2]
+
+    # auths are mirrored separately
+    assert DLMirror(type='auth').get([_bib(2, before)]) == {}
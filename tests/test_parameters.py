@@ -0,0 +1,39 @@
+import pytest
+from argparse import Namespace
+from moto import mock_aws
+
+@pytest.fixture
+def ssm():
+    from boto3 import client
+    from dlx_dl import parameters
+
+    with mock_aws():
+        parameters._ssm = None
+        parameters.clear_cache()
+        ssm = client('ssm', region_name='us-east-1')
+        ssm.put_parameter(Name='one', Value='1', Type='String')
+        ssm.put_parameter(Name='two', Value='2', Type='String')
+
+        yield ssm
+
+        parameters._ssm = None
+        parameters.clear_cache()
+
+def test_get_parameters(ssm):
+    from dlx_dl.parameters import get_parameters, get_parameter
+
+    assert get_parameters(['one', 'two', 'three']) == {'one': '1', 'two': '2', 'three': None}
+
+    # cached
+    ssm.put_parameter(Name='one', Value='changed', Type='String', Overwrite=True)
+    assert get_parameter('one') == '1'
+
+    # expired
+    assert get_parameter('one', ttl=0) == 'changed'
+
+def test_resolve(ssm):
+    from dlx_dl.parameters import resolve
+
+    args = Namespace(a=None, b='given')
+    resolve(args, {'a': 'one', 'b': 'two'})
+    assert (args.a, args.b) == ('1', 'given')
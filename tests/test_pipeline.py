@@ -0,0 +1,88 @@
+import time, threading, pytest
+
+def test_inline():
+    from dlx_dl.pipeline import Pipeline
+
+    threads = set()
+
+    def stage(x):
+        threads.add(threading.current_thread())
+        return x * 2
+
+    with Pipeline(range(5), stage, lambda x: x + 1) as pipeline:
+        assert list(pipeline) == [1, 3, 5, 7, 9]
+
+    assert threads == {threading.current_thread()}
+
+def test_pipelined():
+    from dlx_dl.pipeline import Pipeline
+
+    def slow(x):
+        time.sleep(.01)
+        return x
+
+    with Pipeline(range(50), slow, lambda x: x * 2, depth=2) as pipeline:
+        assert list(pipeline) == [x * 2 for x in range(50)]
+
+def test_overlap():
+    from dlx_dl.pipeline import Pipeline
+
+    def wait(x):
+        time.sleep(.05)
+        return x
+
+    start = time.perf_counter()
+
+    with Pipeline(range(10), wait, depth=2) as pipeline:
+        for x in pipeline:
+            # the next waits happen while this item is being handled
+            time.sleep(.05)
+
+    assert time.perf_counter() - start < .05 * 20 * .8
+
+def test_leftover():
+    from dlx_dl.pipeline import Pipeline
+
+    source = iter(range(100))
+    pipeline = Pipeline(source, lambda x: x, lambda x: x, depth=2)
+    taken = []
+
+    for x in pipeline:
+        taken.append(x)
+
+        if x == 10:
+            break
+
+    leftover = pipeline.close()
+    # every item is either yielded, left over, or still in the source
+    assert taken + leftover + list(source) == list(range(100))
+
+    # inline
+    source = iter(range(100))
+    pipeline = Pipeline(source, lambda x: x)
+    taken = []
+
+    for x in pipeline:
+        taken.append(x)
+
+        if x == 10:
+            break
+
+    assert taken + pipeline.close() + list(source) == list(range(100))
+
+def test_error():
+    from dlx_dl.pipeline import Pipeline
+
+    def fail(x):
+        if x == 3:
+            raise Exception('test')
+
+        return x
+
+    pipeline = Pipeline(range(10), fail, depth=2)
+
+    with pytest.raises(Exception, match='test'):
+        list(pipeline)
+
+    leftover = pipeline.close()
+    assert leftover[0] == 3
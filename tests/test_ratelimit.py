@@ -0,0 +1,88 @@
+import pytest
+from dlx import DB
+
+@pytest.fixture
+def db():
+    DB.connect('mongomock://localhost') # mock DB
+    DB.handle['dlx_dl_rate_limit'].drop()
+
+    return DB.client
+
+@pytest.fixture
+def clock(monkeypatch):
+    from dlx_dl import ratelimit
+
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'time', lambda: now[0])
+    monkeypatch.setattr(ratelimit.time, 'sleep', lambda x: now.__setitem__(0, now[0] + x))
+
+    return now
+
+def test_window(db, clock):
+    from dlx_dl.ratelimit import RateLimiter
+
+    limiter = RateLimiter(capacity=2, period=10)
+    assert limiter.try_acquire() == 0
+    clock[0] += 4
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == pytest.approx(6)
+
+    # shared by limiters with the same key
+    other = RateLimiter(capacity=2, period=10)
+    assert other.try_acquire() == pytest.approx(6)
+    assert other.acquire() == pytest.approx(6)
+    assert clock[0] == pytest.approx(1010)
+    assert limiter.try_acquire() == pytest.approx(4)
+
+    # the whole capacity is available again after a period without requests
+    clock[0] += 100
+    assert [limiter.try_acquire() for _ in range(3)][:2] == [0, 0]
+
+def test_limit(db, clock):
+    from dlx_dl.ratelimit import RateLimiter, CAPACITY, PERIOD
+
+    limiter = RateLimiter()
+    acquired = []
+
+    # requests as fast as they are allowed, over several periods
+    while clock[0] < 1000 + PERIOD * 3:
+        limiter.acquire()
+        acquired.append(clock[0])
+        clock[0] += .5
+
+    assert len(acquired) >= CAPACITY * 3
+
+    for t in acquired:
+        assert len([x for x in acquired if t <= x < t + PERIOD]) <= CAPACITY
+
+def test_drain(db, clock):
+    from dlx_dl.ratelimit import RateLimiter
+
+    limiter = RateLimiter(capacity=10, period=10)
+    limiter.drain(seconds=5)
+    assert limiter.try_acquire() == pytest.approx(5)
+
+    # a shorter hold doesn't shorten the wait
+    limiter.drain(seconds=1)
+    assert limiter.acquire() == pytest.approx(5)
+
+def test_circuit_breaker(db, clock):
+    from dlx_dl.ratelimit import RateLimiter
+
+    limiter = RateLimiter(failure_threshold=2, cooldown=30, max_cooldown=50)
+    limiter.record(ok=False)
+    assert limiter.try_acquire() == 0
+
+    limiter.record(ok=False)
+    assert limiter.try_acquire() == pytest.approx(30)
+
+    # opens for longer if it fails again without a success
+    clock[0] += 30
+    limiter.record(ok=False)
+    limiter.record(ok=False)
+    assert limiter.try_acquire() == pytest.approx(50)
+
+    clock[0] += 50
+    limiter.record(ok=True)
+    doc = DB.handle['dlx_dl_rate_limit'].find_one()
+    assert doc['failures'] == 0 and doc['trips'] == 0
@@ -0,0 +1,34 @@
+import gzip, responses
+from xml.etree import ElementTree
+from dlx_dl import client
+from dlx_dl.search import SearchResults, NS
+
+URL = 'http://127.0.0.1:9090/search'
+RECORD = '<record><controlfield tag="001">{}</controlfield></record>'
+XML = '<response><search_id>abc</search_id><total>3</total><collection xmlns="http://www.loc.gov/MARC21/slim">{}</collection></response>'
+
+@responses.activate
+def test_stream():
+    body = XML.format(''.join(RECORD.format(x) for x in range(3)))
+    responses.add(responses.GET, URL, body=gzip.compress(body.encode()), headers={'Content-Encoding': 'gzip'})
+
+    results = SearchResults(client.get(URL, stream=True))
+    ids = []
+
+    for record in results:
+        ids.append(record.find(f'{NS}controlfield').text)
+
+    assert ids == ['0', '1', '2']
+    assert results.search_id == 'abc'
+    assert results.total == 3
+    assert results.nbytes == len(body)
+
+@responses.activate
+def test_first():
+    responses.add(responses.GET, URL, body=XML.format(RECORD.format(1) + RECORD.format(2)))
+
+    record = SearchResults(client.get(URL)).first()
+    assert ElementTree.tostring(record).count(b'controlfield') == 2
+
+    responses.add(responses.GET, URL + '/empty', body=XML.format(''))
+    assert SearchResults(client.get(URL + '/empty')).first() is None
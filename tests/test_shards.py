@@ -0,0 +1,68 @@
+import pytest, json
+from datetime import datetime, timedelta, timezone
+from dlx import DB
+
+@pytest.fixture
+def db():
+    DB.connect('mongomock://localhost') # mock DB
+    DB.handle['dlx_dl_shard'].drop()
+
+    return DB.client
+
+def test_shards():
+    from dlx_dl.shards import id_shards, date_shards
+
+    shards = id_shards(1, 25, 10)
+    assert len(shards) == 3
+    assert json.loads(shards[0]['query']) == {'$and': [{'_id': {'$gte': 1}}, {'_id': {'$lt': 11}}]}
+    assert json.loads(shards[2]['query']) == {'$and': [{'_id': {'$gte': 21}}, {'_id': {'$lt': 26}}]}
+
+    shards = date_shards(datetime(2025, 1, 1), datetime(2025, 1, 2, 12), timedelta(days=1))
+    assert shards == [
+        {'modified_from': '2025-01-01T00:00:00', 'modified_to': '2025-01-02T00:00:00'},
+        {'modified_from': '2025-01-02T00:00:00', 'modified_to': '2025-01-02T12:00:00'}
+    ]
+
+def test_claim(db):
+    from dlx_dl.shards import ShardLeases, id_shards
+
+    leases = ShardLeases(job='test')
+    assert leases.create(id_shards(1, 30, 10)) == 3
+    # resumed
+    assert leases.create(id_shards(1, 30, 10)) == 0
+
+    one = leases.claim('worker-1')
+    two = leases.claim('worker-2')
+    assert (one['number'], two['number']) == (0, 1)
+    assert leases.renew(one, 'worker-1')
+    assert not leases.renew(one, 'worker-2')
+
+    assert leases.complete(one, 'worker-1', {'updated': 5})
+    assert leases.progress() == {'pending': 1, 'running': 1, 'done': 1, 'failed': 0}
+
+    # released without an error, e.g. when the sync was aborted
+    leases.release(two, 'worker-2', delay=3600)
+    assert leases.claim('worker-2')['number'] == 2
+    assert leases.claim('worker-2') is None
+    assert DB.handle['dlx_dl_shard'].find_one({'number': 1})['attempts'] == 0
+    assert leases.unfinished() == 2
+
+def test_reclaim(db):
+    from dlx_dl.shards import ShardLeases, id_shards
+
+    leases = ShardLeases(job='test', max_attempts=2)
+    leases.create(id_shards(1, 10, 10))
+    shard = leases.claim('worker-1')
+    assert leases.claim('worker-2') is None
+
+    # the worker stopped without renewing its claim
+    DB.handle['dlx_dl_shard'].update_one({'_id': shard['_id']}, {'$set': {'lease_until': datetime.now(timezone.utc) - timedelta(seconds=1)}})
+    shard = leases.claim('worker-2')
+    assert shard['worker'] == 'worker-2' and shard['attempts'] == 2
+    # the first worker's claim is gone
+    assert not leases.complete(shard, 'worker-1')
+
+    leases.release(shard, 'worker-2', error='Exception()')
+    assert leases.progress()['failed'] == 1
+    assert leases.claim('worker-2') is None
+    assert leases.unfinished() == 0
@@ -47,4 +47,41 @@ def test_pending_status(db):
 
     status = PendingStatus(collection='bibs')
     assert status.pending_time == 0
-    assert len(status.pending_records) == 0
\ No newline at end of file
+    assert len(status.pending_records) == 0
+
+def test_log_xml():
+    from dlx_dl.util import compress_log_entry, log_xml
+
+    xml = '<record><datafield tag="245" ind1=" " ind2=" "><subfield code="a">title</subfield></datafield></record>'
+    logdata = {'record_id': 1, 'xml': xml}
+    entry = compress_log_entry(logdata)
+    assert isinstance(entry['xml'], bytes)
+    assert logdata['xml'] == xml
+    assert log_xml(entry) == xml
+    # entries logged before compression
+    assert log_xml(logdata) == xml
+    assert log_xml({}) is None
+
+def test_deleted_since(db):
+    from dlx_dl.util import deleted_since
+
+    now = datetime.now(timezone.utc)
+    DB.handle['bib_history'].insert_many(
+        [
+            # restored
+            {'_id': 1, 'deleted': {'time': now - timedelta(hours=2), 'user': 'user'}},
+            {'_id': 3, 'deleted': {'time': now - timedelta(hours=2), 'user': 'user'}},
+            {'_id': 4, 'deleted': {'time': now - timedelta(hours=2), 'user': 'HZN'}},
+            # out of range
+            {'_id': 5, 'deleted': {'time': now - timedelta(days=2), 'user': 'user'}},
+        ]
+    )
+
+    since = now - timedelta(days=1)
+    assert sorted(x['_id'] for x in deleted_since('bib', since)) == [3, 4]
+    assert [x['_id'] for x in deleted_since('bib', since, exclude_user='HZN')] == [3]
+    assert [x['_id'] for x in deleted_since('bib', since, now - timedelta(hours=3))] == []
+
+    deleted = next(deleted_since('bib', since, exclude_user='HZN'))
+    assert deleted['deleted']['user'] == 'user'
+    assert 'live' not in deleted
@@ -0,0 +1,44 @@
+import pytest
+from dlx import DB
+from dlx.marc import Bib, Auth
+
+@pytest.fixture
+def db():
+    DB.connect('mongomock://localhost') # mock DB
+    DB.auths.drop()
+    DB.bibs.drop()
+    Auth({'_id': 1}).set('100', 'a', 'name_1').commit()
+    Auth({'_id': 2}).set('110', 'a', 'name_2').commit()
+
+    return DB.client
+
+def test_lru():
+    from dlx_dl.xrefs import LRUCache
+
+    cache = LRUCache(2)
+    cache[1] = 'a'
+    cache[2] = 'b'
+    cache.get(1)
+    cache[3] = 'c'
+    assert list(cache.keys()) == [1, 3]
+    assert cache.setdefault(4, 'd') == 'd'
+    assert list(cache.keys()) == [3, 4]
+
+def test_prefetch(db):
+    from dlx_dl.xrefs import XrefPrefetcher
+
+    original = Auth._cache
+    prefetcher = XrefPrefetcher(max_size=10)
+    assert Auth._cache is prefetcher.cache
+
+    bibs = [Bib().set('700', 'a', 1), Bib().set('710', 'a', 2).set('700', 'a', 1), Bib().set('700', 'a', 3)]
+    assert prefetcher.prefetch(bibs) == 2
+    assert prefetcher.cache[1] == {'a': 'name_1'}
+    assert prefetcher.cache[2] == {'a': 'name_2'}
+
+    # already cached
+    assert prefetcher.prefetch(bibs[:2]) == 0
+    assert bibs[1].get_value('710', 'a') == 'name_2'
+
+    prefetcher.restore()
+    assert Auth._cache is original